@@ -13,4 +13,5 @@ from .novelty import novelty
 from .build_table_mem_efficient import build_table as build_table_mem_efficient
 # from .par_build_table import build_table as par_build_table
 from .build_table_full_backtrace import build_table as build_table_full_backtrace
+from .build_table_sparse import build_table as build_table_sparse
 import retarget
@@ -0,0 +1,178 @@
+"""Analyze a library of songs in parallel, storing the analyses in a
+:py:class:`radiotool.composer.Song` cache directory.
+
+Usage: python -m radiotool.algorithms.batch_analysis cache_dir path [path ...]
+
+where each path is an audio file or a directory to search for audio
+files.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import librosa_analysis
+from ..analysis_store import AnalysisStore, ChecksumIndex, params_hash
+
+AUDIO_EXTENSIONS = (".wav", ".mp3")
+
+
+def find_audio_files(paths, extensions=AUDIO_EXTENSIONS):
+    """Get the audio files in a list of files and directories
+
+    :param paths: Audio files, and directories to search (recursively)
+        for audio files
+    :type paths: list of str
+    :param extensions: File extensions of audio files
+    :returns: Paths of audio files, sorted within each directory
+    :rtype: list of str
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, fns in os.walk(path):
+                dirnames.sort()
+                filenames.extend(
+                    os.path.join(dirpath, fn) for fn in sorted(fns)
+                    if os.path.splitext(fn)[1].lower() in extensions)
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def is_cached(filename, cache_dir, profile="full", full_checksum=False,
+              block_duration=None):
+    """Check whether a song's analysis is in the cache, like
+    :py:meth:`radiotool.composer.Song.features_cached`, without
+    decoding the song"""
+    checksum = ChecksumIndex(cache_dir).checksum(filename, full=full_checksum)
+    return AnalysisStore(cache_dir).contains(
+        checksum, params_hash(librosa_analysis.analysis_params(
+            profile, block_duration)))
+
+
+def _analyze_song(job):
+    from ..composer import Song
+
+    (filename, cache_dir, profile, refresh, cache_size, full_checksum,
+     block_duration) = job
+    start = time.time()
+    try:
+        song = Song(filename, cache_dir=cache_dir, refresh_cache=refresh,
+                    cache_size=cache_size, full_checksum=full_checksum,
+                    analysis_profile=profile,
+                    analysis_block_duration=block_duration)
+        song.analysis
+    except Exception as e:
+        return filename, time.time() - start, "{}: {}".format(
+            type(e).__name__, e)
+    return filename, time.time() - start, None
+
+
+def analyze_songs(filenames, cache_dir, processes=None, profile="full",
+                  refresh=False, cache_size=None, full_checksum=False,
+                  block_duration=None, verbose=True):
+    """Analyze songs across a process pool, storing the analyses in
+    ``cache_dir``. Songs whose analyses are already stored are skipped.
+
+    :param filenames: Audio files to analyze
+    :type filenames: list of str
+    :param str. cache_dir: Song cache directory
+    :param integer processes: Number of processes (default is the number
+        of CPUs)
+    :param str. profile: Analysis profile (see
+        :py:data:`radiotool.algorithms.librosa_analysis.PROFILES`)
+    :param bool. refresh: Analyze songs even if their analyses are
+        stored
+    :param integer cache_size: Maximum size of the cache (in bytes)
+    :param bool. full_checksum: Identify songs by a sha256 of the entire
+        file
+    :param float block_duration: Analyze each song in blocks of this
+        many seconds to bound memory use (see
+        :py:func:`radiotool.algorithms.librosa_analysis.analyze_chunked`)
+    :param bool. verbose: Print progress and per-song timing
+    :returns: List of (filename, seconds, error message or ``None``) for
+        each analyzed song, in the order they finished
+    """
+    if refresh:
+        todo = list(filenames)
+    else:
+        # checksums are computed (and indexed) here, before the workers
+        # need them
+        todo = [fn for fn in filenames
+                if not is_cached(fn, cache_dir, profile, full_checksum,
+                                 block_duration)]
+
+    if verbose:
+        print "Analyzing {} songs ({} already cached)".format(
+            len(todo), len(filenames) - len(todo))
+
+    jobs = [(fn, cache_dir, profile, refresh, cache_size, full_checksum,
+             block_duration) for fn in todo]
+    results = []
+    if len(jobs) == 0:
+        return results
+
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for i, result in enumerate(
+                pool.imap_unordered(_analyze_song, jobs)):
+            results.append(result)
+            if verbose:
+                filename, elapsed, error = result
+                status = "{:.1f} s".format(elapsed)
+                if error is not None:
+                    status = "failed ({})".format(error)
+                print "[{}/{}] {} {}".format(i + 1, len(jobs),
+                                             filename, status)
+                sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    if verbose:
+        n_failed = len([r for r in results if r[2] is not None])
+        print "Analyzed {} songs in {:.1f} s ({} failed)".format(
+            len(results) - n_failed, time.time() - start, n_failed)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Analyze songs into a radiotool cache directory")
+    parser.add_argument("cache_dir", help="Song cache directory")
+    parser.add_argument("paths", nargs="+",
+                        help="Audio files or directories of audio files")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="Number of processes (default: number of CPUs)")
+    parser.add_argument("--profile", default="full",
+                        choices=sorted(librosa_analysis.PROFILES),
+                        help="Analysis profile")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Analyze songs even if they are cached")
+    parser.add_argument("--cache-size", type=int, default=None,
+                        help="Maximum cache size in bytes")
+    parser.add_argument("--full-checksum", action="store_true",
+                        help="Identify songs by a sha256 of the entire file")
+    parser.add_argument("--block-duration", type=float, default=None,
+                        help="Analyze songs in blocks of this many seconds "
+                        "to bound memory use")
+    args = parser.parse_args(argv)
+
+    results = analyze_songs(
+        find_audio_files(args.paths), args.cache_dir,
+        processes=args.processes, profile=args.profile,
+        refresh=args.refresh, cache_size=args.cache_size,
+        full_checksum=args.full_checksum,
+        block_duration=args.block_duration)
+
+    if any(error is not None for _, _, error in results):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
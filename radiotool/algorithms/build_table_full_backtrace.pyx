@@ -1,10 +1,12 @@
 #cython: infer_types=True
-#cython: boundscheck=True
+#cython: boundscheck=False
 #cython: wraparound=False
 #cython: cdivision=True
 import cython
+from cython.parallel cimport prange
 from cpython.array cimport array, clone
 from libc.stdlib cimport malloc, free
+from libc.math cimport ceil, sqrt
 
 cdef struct Params:
     double pen_val
@@ -17,11 +19,12 @@ cdef struct Params:
     int all_full
     int no_max_beats
     int n_song_starts
+    int n_threads
 
 cdef int MAX_BEATS = 0
 cdef int NO_MAX_BEATS = 1
 
-cdef double get_pen_value(double[:, :] pen, int i, int l, int global_start_l, Params p):
+cdef double get_pen_value(double[:, :] pen, int i, int l, int global_start_l, Params p) nogil:
     cdef int pen_index = 0
     if i >= p.p0_full:
         pen_index = p.n_beats + (i - p.p0_full)
@@ -42,7 +45,7 @@ cdef double get_pen_value(double[:, :] pen, int i, int l, int global_start_l, Pa
     return new_pen
 
 
-cdef void get_pen_column(double[:, :] pen, int column, double[:] new_pen, int global_start_l, Params p):
+cdef void get_pen_column(double[:, :] pen, int column, double[:] new_pen, int global_start_l, Params p) nogil:
     cdef int i, j
 
     for i in range(p.max_beats):
@@ -65,45 +68,48 @@ cdef void get_pen_column(double[:, :] pen, int column, double[:] new_pen, int gl
                 new_pen[i] += p.pen_val
 
 
-cdef void backward_build_table(
-    double[:, :] tc, double[:, :] pen, int start_beat, int end_beat, int global_start_l, Params p,
-    int[:] song_starts, int[:] song_ends,
-    double[:] cost, double[:] pen_val, double[:] vals_col, double[:] min_vals, int[:] global_path,
-    double[:] global_path_cost):
-    
-    cdef int l, idx, i, beat_seg_i, seg_start_beat, j, full_j, orig_beat_j, min_idx, song_i
+cdef void backward_step(
+    double[:, :] tc, double[:, :] pen, int l, Params p,
+    int[:] song_starts, int[:] song_ends, double[:] pen_val,
+    double *next_cost, double *cost, int *prev_node) nogil:
+    # Cost (and best next node) of every node at output beat l, from the
+    # costs at output beat l + 1. The cost of every node only depends on
+    # the costs at the next output beat, so the nodes are computed in
+    # parallel (with p.n_threads threads).
+    cdef int idx, beat_seg_i, seg_start_beat, j, orig_beat_i, min_idx, song_i
     cdef double minval, tmpval
 
-    cdef double *full_cost = <double *>malloc(p.all_full * pen.shape[1] * sizeof(double))
-    cdef int *prev_node = <int *>malloc(p.all_full * pen.shape[1] * sizeof(int))
+    get_pen_column(pen, l, pen_val, l, p)
 
-    # print "full cost size", p.all_full, "x", pen.shape[1], "=", p.all_full * pen.shape[1]
-    
-    min_idx = 0
-    cdef int rowlen = pen.shape[1]
+    # categories of beats we could be at before this one
 
-    # generate initial cost
-    if end_beat != -1:
-        cost[:] = 99999999  # N.inf
-        cost[end_beat] = get_pen_value(pen, end_beat, pen.shape[1] - 1, global_start_l + pen.shape[1] - 1, p)
-    else:
-        get_pen_column(pen, pen.shape[1] - 1, cost, global_start_l + pen.shape[1] - 1, p)
+    # beat segment before min_beat
+    for idx in prange(p.n_beats * (p.min_beats - 1), schedule='static', num_threads=p.n_threads):
+        beat_seg_i = idx / p.n_beats
+        orig_beat_i = idx % p.n_beats
 
-    for i in range(cost.shape[0]):
-        # print i, i * rowlen + (pen.shape[1] - 1)
-        full_cost[i * rowlen + (pen.shape[1] - 1)] = cost[i]
-        # ??
-        # prev_node[i, pen.shape[1] - 1] = 0
+        song_i = 0
+        for j in range(p.n_song_starts):
+            if song_starts[j] <= orig_beat_i < song_ends[j]:
+                song_i = j
+                break
 
-    # optimize
-    # should this be  -2 or -1?
-    for l in xrange(pen.shape[1] - 2, -1, -1):
-        get_pen_column(pen, l, pen_val, global_start_l + l, p)
+        # could only be going to beat_seg_i + 1
+        seg_start_beat = (beat_seg_i + 1) * p.n_beats
+        minval = -1
+        min_idx = 0
+        for j in range(song_starts[song_i], song_ends[song_i]):
+            tmpval = tc[orig_beat_i, j] + pen_val[idx] + next_cost[seg_start_beat + j]
+            if minval == -1 or tmpval < minval:
+                minval = tmpval
+                min_idx = seg_start_beat + j
 
-        # categories of beats we could be at before this one
+        cost[idx] = minval
+        prev_node[idx] = min_idx
 
-        # beat segment before min_beat
-        for idx in range(p.n_beats * (p.min_beats - 1)):
+    if p.no_max_beats == MAX_BEATS:
+        # beat segment between min beat and max beat
+        for idx in prange(p.n_beats * (p.min_beats - 1), p.n_beats * (p.max_beats - 1), schedule='static', num_threads=p.n_threads):
             beat_seg_i = idx / p.n_beats
             orig_beat_i = idx % p.n_beats
 
@@ -113,172 +119,265 @@ cdef void backward_build_table(
                     song_i = j
                     break
 
-            # could only be going to beat_seg_i + 1
+            # could be going to beat_seg_i + 1
             seg_start_beat = (beat_seg_i + 1) * p.n_beats
+
             minval = -1
+            min_idx = 0
             for j in range(song_starts[song_i], song_ends[song_i]):
-            # for j in range(p.n_beats):
-                tmpval = tc[orig_beat_i, j] + pen_val[idx] + full_cost[(seg_start_beat + j) * rowlen + (l + 1)]
+                tmpval = tc[orig_beat_i, j] + pen_val[idx] + next_cost[seg_start_beat + j]
                 if minval == -1 or tmpval < minval:
                     minval = tmpval
                     min_idx = seg_start_beat + j
+            # or could be going to first pause beat
+            tmpval = tc[orig_beat_i, p.p0] + pen_val[idx] + next_cost[p.p0_full]
+            if minval == -1 or tmpval < minval:
+                minval = tmpval
+                min_idx = p.p0_full
 
-            min_vals[idx] = minval
-
-            full_cost[idx * rowlen + l] = minval
-            prev_node[idx * rowlen + l] = min_idx
-
-        if p.no_max_beats == MAX_BEATS:
-            # beat segment between min beat and max beat
-            for idx in range(p.n_beats * (p.min_beats - 1), p.n_beats * (p.max_beats - 1)):
-                beat_seg_i = idx / p.n_beats
-                orig_beat_i = idx % p.n_beats
-
-                song_i = 0
-                for j in range(p.n_song_starts):
-                    if song_starts[j] <= orig_beat_i < song_ends[j]:
-                        song_i = j
-                        break
-
-                # could be going to beat_seg_i + 1
-                seg_start_beat = (beat_seg_i + 1) * p.n_beats
-
-                minval = -1
-                for j in range(song_starts[song_i], song_ends[song_i]):
-                # for j in range(p.n_beats):
-                    tmpval = tc[orig_beat_i, j] + pen_val[idx] + full_cost[(seg_start_beat + j) * rowlen + (l + 1)]
-                    if minval == -1 or tmpval < minval:
-                        minval = tmpval
-                        min_idx = seg_start_beat + j
-                # or could be going to first pause beat
-                tmpval = tc[orig_beat_i, p.p0] + pen_val[idx] + full_cost[p.p0_full * rowlen + (l + 1)]
-                if minval == -1 or tmpval < minval:
-                    minval = tmpval
-                    min_idx = p.p0_full
+            cost[idx] = minval
+            prev_node[idx] = min_idx
 
-                min_vals[idx] = minval
+        # max beat segment
+        for idx in prange(p.n_beats * (p.max_beats - 1), p.n_beats * p.max_beats, schedule='static', num_threads=p.n_threads):
+            orig_beat_i = idx % p.n_beats
 
-                full_cost[idx * rowlen + l] = minval
-                prev_node[idx * rowlen + l] = min_idx
+            # must be going to first pause beat
+            cost[idx] = tc[orig_beat_i, p.p0] + pen_val[idx] + next_cost[p.p0_full]
+            prev_node[idx] = p.p0_full
 
-            # max beat segment
-            for idx in range(p.n_beats * (p.max_beats - 1), p.n_beats * p.max_beats):
-                orig_beat_i = idx % p.n_beats
+    else:
+        # no maximum beat
 
-                # must be going to first pause beat
-                min_vals[idx] = tc[orig_beat_i, p.p0] + pen_val[idx] + full_cost[p.p0_full * rowlen + (l + 1)]
+        # max beat segment
+        for idx in prange(p.n_beats * (p.max_beats - 1), p.n_beats * p.max_beats, schedule='static', num_threads=p.n_threads):
+            beat_seg_i = idx / p.n_beats
+            orig_beat_i = idx % p.n_beats
 
-                full_cost[idx * rowlen + l] = tc[orig_beat_i, p.p0] + pen_val[idx] + full_cost[p.p0_full * rowlen + (l + 1)]
-                prev_node[idx * rowlen + l] = p.p0_full
+            song_i = 0
+            for j in range(p.n_song_starts):
+                if song_starts[j] <= orig_beat_i < song_ends[j]:
+                    song_i = j
+                    break
+
+            # could be going to same beat segment
+            seg_start_beat = beat_seg_i * p.n_beats
 
-        else:
-            # no maximum beat
-
-            # max beat segment
-            for idx in range(p.n_beats * (p.max_beats - 1), p.n_beats * p.max_beats):
-                beat_seg_i = idx / p.n_beats
-                orig_beat_i = idx % p.n_beats
-
-                song_i = 0
-                for j in range(p.n_song_starts):
-                    if song_starts[j] <= orig_beat_i < song_ends[j]:
-                        song_i = j
-                        break
-
-                # could be going to same beat
-                seg_start_beat = beat_seg_i
-
-                minval = -1
-                for j in range(song_starts[song_i], song_ends[song_i]):
-                # for j in range(p.n_beats):
-                    tmpval = tc[orig_beat_i, j] + pen_val[idx] + full_cost[(seg_start_beat + j) * rowlen + (l + 1)]
-                    if minval == -1 or tmpval < minval:
-                        minval = tmpval
-                        min_idx = seg_start_beat + j
-
-                if p.n_pauses > 0:
-                    # or could be going to first pause beat
-                    tmpval = tc[orig_beat_i, p.p0] + pen_val[idx] + full_cost[p.p0_full * rowlen + (l + 1)]
-                    if minval == -1 or tmpval < minval:
-                        minval = tmpval
-                        min_idx = p.p0_full
-
-                min_vals[idx] = minval
-
-                full_cost[idx * rowlen + l] = minval
-                prev_node[idx * rowlen + l] = min_idx
-
-        # pause beats except the last one
-        for idx in range(p.p0_full, p.all_full - 1):
-            orig_beat_i = p.p0 + (idx - p.p0_full)
-
-            # could only be going to another pause beat
             minval = -1
-            for j in range(p.n_pauses):
-                tmpval = tc[orig_beat_i, p.p0 + j] + pen_val[idx] + full_cost[(p.p0_full + j) * rowlen + (l + 1)]
+            min_idx = 0
+            for j in range(song_starts[song_i], song_ends[song_i]):
+                tmpval = tc[orig_beat_i, j] + pen_val[idx] + next_cost[seg_start_beat + j]
                 if minval == -1 or tmpval < minval:
                     minval = tmpval
-                    min_idx = p.p0_full + j
-            min_vals[idx] = minval
-
-            full_cost[idx * rowlen + l] = minval
-            prev_node[idx * rowlen + l] = min_idx
+                    min_idx = seg_start_beat + j
 
-        if p.n_pauses > 0:
-            # last pause beat
-            minval = -1
-            for j in range(p.n_beats):
-                tmpval = tc[p.p0 + p.n_pauses - 1, j] + pen_val[p.all_full - 1] + full_cost[j * rowlen + (l + 1)]
+            if p.n_pauses > 0:
+                # or could be going to first pause beat
+                tmpval = tc[orig_beat_i, p.p0] + pen_val[idx] + next_cost[p.p0_full]
                 if minval == -1 or tmpval < minval:
                     minval = tmpval
-                    min_idx = j
-            min_vals[p.all_full - 1] = minval
-
-        full_cost[(p.all_full - 1) * rowlen + l] = minval
-        prev_node[(p.all_full - 1) * rowlen + l] = min_idx
-
-        # cost[:] = min_vals
+                    min_idx = p.p0_full
 
-    # find the optimal path
+            cost[idx] = minval
+            prev_node[idx] = min_idx
+
+    # pause beats except the last one
+    for idx in prange(p.p0_full, p.all_full - 1, schedule='static', num_threads=p.n_threads):
+        orig_beat_i = p.p0 + (idx - p.p0_full)
+
+        # could only be going to another pause beat
+        minval = -1
+        min_idx = 0
+        for j in range(p.n_pauses):
+            tmpval = tc[orig_beat_i, p.p0 + j] + pen_val[idx] + next_cost[p.p0_full + j]
+            if minval == -1 or tmpval < minval:
+                minval = tmpval
+                min_idx = p.p0_full + j
+
+        cost[idx] = minval
+        prev_node[idx] = min_idx
+
+    if p.n_pauses > 0:
+        # last pause beat
+        minval = -1
+        min_idx = 0
+        for j in range(p.n_beats):
+            tmpval = tc[p.p0 + p.n_pauses - 1, j] + pen_val[p.all_full - 1] + next_cost[j]
+            if minval == -1 or tmpval < minval:
+                minval = tmpval
+                min_idx = j
+
+        cost[p.all_full - 1] = minval
+        prev_node[p.all_full - 1] = min_idx
+
+
+cdef void trace_stretch(
+    double[:, :] tc, double[:, :] pen, Params p,
+    int[:] song_starts, int[:] song_ends, double[:] pen_val,
+    int start, int end, double *end_cost, int start_node,
+    int[:] path, double[:] to_go) nogil:
+    # Trace the path from output beat start (from start_node, or from the
+    # cheapest node if it is -1) to output beat end, given the costs at
+    # end. Keeps the costs and best next nodes of every node at every
+    # output beat in between.
+    cdef int n = end - start
+    cdef int i, l, node
+    cdef double *cost = <double *>malloc((n + 1) * p.all_full * sizeof(double))
+    cdef int *prev_node = <int *>malloc((n + 1) * p.all_full * sizeof(int))
 
-    # find start node
-    minval = -1
     for i in range(p.all_full):
-        # print i, full_cost[i * rowlen + 0]
-        if minval == -1 or full_cost[i * rowlen + 0] < minval:
-            minval = full_cost[i * rowlen + 0]
-            min_idx = i
-    global_path[0] = min_idx
-
-    cdef double total_cost_remaining = minval
-    cdef int node = min_idx
+        cost[n * p.all_full + i] = end_cost[i]
+
+    for l in range(end - 1, start - 1, -1):
+        backward_step(tc, pen, l, p, song_starts, song_ends, pen_val,
+                      cost + (l - start + 1) * p.all_full,
+                      cost + (l - start) * p.all_full,
+                      prev_node + (l - start) * p.all_full)
+
+    node = start_node
+    if node == -1:
+        node = 0
+        for i in range(1, p.all_full):
+            if cost[i] < cost[node]:
+                node = i
+
+    path[start] = node
+    to_go[start] = cost[node]
+    for l in range(start, end):
+        node = prev_node[(l - start) * p.all_full + node]
+        path[l + 1] = node
+        to_go[l + 1] = cost[(l - start + 1) * p.all_full + node]
+
+    free(cost)
+    free(prev_node)
+
+
+cdef void trace_checkpointed(
+    double[:, :] tc, double[:, :] pen, Params p,
+    int[:] song_starts, int[:] song_ends, double[:] pen_val,
+    double *last_cost, int every, int[:] path, double[:] to_go) nogil:
+    # Like trace_stretch over all output beats, but only keeping the costs
+    # at every every-th output beat, and tracing the path one stretch
+    # between those at a time
+    cdef int n_out = pen.shape[1]
+    cdef int i, l, start, end, node
+    cdef double *checkpoints = <double *>malloc((n_out / every + 1) * p.all_full * sizeof(double))
+    cdef double *next_cost = <double *>malloc(p.all_full * sizeof(double))
+    cdef double *cost = <double *>malloc(p.all_full * sizeof(double))
+    cdef double *tmp
+    cdef int *prev_node = <int *>malloc(p.all_full * sizeof(int))
 
-    for l in range(pen.shape[1] - 1):
-        node = prev_node[node * rowlen + l]
-        global_path[l + 1] = node
-        global_path_cost[l] = total_cost_remaining - full_cost[node * rowlen + (l + 1)]
-        total_cost_remaining -= global_path_cost[l]
-
-    # not sure what to grab for the initial cost
-    global_path_cost[pen.shape[1] - 1] = total_cost_remaining
-
-    free( full_cost )
-    free( prev_node )
+    for i in range(p.all_full):
+        next_cost[i] = last_cost[i]
+    for l in range(n_out - 2, -1, -1):
+        backward_step(tc, pen, l, p, song_starts, song_ends, pen_val,
+                      next_cost, cost, prev_node)
+        if l % every == 0:
+            for i in range(p.all_full):
+                checkpoints[(l / every) * p.all_full + i] = cost[i]
+        tmp = next_cost
+        next_cost = cost
+        cost = tmp
+    free(next_cost)
+    free(cost)
+    free(prev_node)
+
+    node = -1
+    start = 0
+    while start < n_out - 1:
+        end = start + every
+        if end >= n_out - 1:
+            end = n_out - 1
+            trace_stretch(tc, pen, p, song_starts, song_ends, pen_val,
+                          start, end, last_cost, node, path, to_go)
+        else:
+            trace_stretch(tc, pen, p, song_starts, song_ends, pen_val,
+                          start, end, checkpoints + (end / every) * p.all_full,
+                          node, path, to_go)
+        node = path[end]
+        start = end
+
+    free(checkpoints)
+
+
+cdef void trace_divided(
+    double[:, :] tc, double[:, :] pen, Params p,
+    int[:] song_starts, int[:] song_ends, double[:] pen_val,
+    int start, int end, double *end_cost, int start_node,
+    int[:] path, double[:] to_go) nogil:
+    # Like trace_stretch, but only keeping the costs at the middle output
+    # beat, and tracing each half recursively
+    cdef int l, middle
+    cdef double *next_cost
+    cdef double *cost
+    cdef double *tmp
+    cdef int *prev_node
+
+    if end - start <= 2:
+        trace_stretch(tc, pen, p, song_starts, song_ends, pen_val,
+                      start, end, end_cost, start_node, path, to_go)
+        return
+
+    middle = (start + end) / 2
+    next_cost = <double *>malloc(p.all_full * sizeof(double))
+    cost = <double *>malloc(p.all_full * sizeof(double))
+    prev_node = <int *>malloc(p.all_full * sizeof(int))
+    for l in range(p.all_full):
+        next_cost[l] = end_cost[l]
+    for l in range(end - 1, middle - 1, -1):
+        backward_step(tc, pen, l, p, song_starts, song_ends, pen_val,
+                      next_cost, cost, prev_node)
+        tmp = next_cost
+        next_cost = cost
+        cost = tmp
+    free(cost)
+    free(prev_node)
+
+    # next_cost now holds the costs at the middle output beat
+    trace_divided(tc, pen, p, song_starts, song_ends, pen_val,
+                  start, middle, next_cost, start_node, path, to_go)
+    free(next_cost)
+    trace_divided(tc, pen, p, song_starts, song_ends, pen_val,
+                  middle, end, end_cost, path[middle], path, to_go)
+
+
+cdef int FULL = 0
+cdef int CHECKPOINT = 1
+cdef int DIVIDE = 2
+STRATEGIES = ("full", "checkpoint", "divide")
 
 
 def build_table(double[:, :] trans_cost, double[:, :] penalty,
     int[:] song_starts, int[:] song_ends,
-    int min_beats=-1, int max_beats=-1, int first_pause=-1):
-    
-    cdef int i
+    int min_beats=-1, int max_beats=-1, int first_pause=-1, int n_threads=1,
+    strategy="full"):
+    """Find the cheapest path through the retargeting graph. The nodes of
+    each output beat are computed on ``n_threads`` threads (when built
+    with OpenMP); the result does not depend on the number of threads.
+
+    ``strategy`` sets how the path is traced back through the table, as
+    in :py:func:`radiotool.algorithms.build_table_sparse.build_table`
+    (``"full"``, ``"checkpoint"`` or ``"divide"``). They all find the
+    same path."""
+
+    cdef int i, l, code, every
+    cdef double remaining
 
     cdef Params p
 
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown strategy: {}".format(strategy))
+    code = STRATEGIES.index(strategy)
+
     if max_beats == -1:
         p.no_max_beats = NO_MAX_BEATS
         max_beats = min_beats + 1
     else:
         p.no_max_beats = MAX_BEATS
+        # the table is not bounds checked
+        if min_beats < 1 or trans_cost.shape[0] <= first_pause:
+            raise ValueError(
+                "max_beats needs min_beats >= 1 and at least one pause beat")
 
     p.pen_val = 99999999.0
     p.p0 = first_pause
@@ -290,28 +389,42 @@ def build_table(double[:, :] trans_cost, double[:, :] penalty,
     p.all_full = p.p0_full + p.n_pauses
 
     p.n_song_starts = len(song_starts)
+    p.n_threads = max(n_threads, 1)
+
+    cdef int n_out = penalty.shape[1]
+    # same checkpoint spacing as build_table_sparse
+    every = max(<int>ceil(sqrt(n_out)), 1)
 
     # double arrays for use throughout the computation
     cdef array dtemplate = array('d')
-    cdef array array1, array2, array3, array4, array5
-    cdef double[:] mv1, mv2, mv3, mv4, global_path_cost
-    array1 = clone(dtemplate, p.all_full, False)
-    array2 = clone(dtemplate, p.all_full, False)
-    array3 = clone(dtemplate, p.all_full, False)
-    array4 = clone(dtemplate, p.all_full, False)
-    mv1 = array1
-    mv2 = array2
-    mv3 = array3
-    mv4 = array4
-
-    array5 = clone(dtemplate, penalty.shape[1], False)
-    global_path_cost = array5
-
-    cdef array ar, template = array('i')
-    ar = clone(template, penalty.shape[1], False)
-    cdef int[:] global_path = ar
-
-    backward_build_table(
-        trans_cost, penalty, -1, -1, 0, p, song_starts, song_ends, mv1, mv2, mv3, mv4, global_path, global_path_cost)
+    cdef double[:] pen_val = clone(dtemplate, p.all_full, False)
+    cdef double[:] last_cost = clone(dtemplate, p.all_full, False)
+    cdef double[:] to_go = clone(dtemplate, n_out, False)
+    cdef double[:] global_path_cost = clone(dtemplate, n_out, False)
+
+    cdef array template = array('i')
+    cdef int[:] global_path = clone(template, n_out, False)
+
+    with nogil:
+        get_pen_column(penalty, n_out - 1, last_cost, n_out - 1, p)
+        if code == FULL or n_out == 1:
+            trace_stretch(trans_cost, penalty, p, song_starts, song_ends,
+                          pen_val, 0, n_out - 1, &last_cost[0], -1,
+                          global_path, to_go)
+        elif code == CHECKPOINT:
+            trace_checkpointed(trans_cost, penalty, p, song_starts,
+                               song_ends, pen_val, &last_cost[0], every,
+                               global_path, to_go)
+        else:
+            trace_divided(trans_cost, penalty, p, song_starts, song_ends,
+                          pen_val, 0, n_out - 1, &last_cost[0], -1,
+                          global_path, to_go)
+
+        # cost of each step of the path
+        remaining = to_go[0]
+        for l in range(n_out - 1):
+            global_path_cost[l] = remaining - to_go[l + 1]
+            remaining -= global_path_cost[l]
+        global_path_cost[n_out - 1] = remaining
 
     return [x for x in global_path], [x for x in global_path_cost]
@@ -0,0 +1,566 @@
+"""Retargeting dynamic program over a sparse transition graph.
+
+This is the dynamic program of ``build_table_full_backtrace``, but each
+music beat only considers its ``n_neighbors`` cheapest transitions to
+other beats of the same song (see :py:func:`sparse_transitions`),
+instead of every beat of the song. Transitions to and between pause
+beats are always kept. Each output beat then costs O(N * K) instead of
+O(N^2) for N music beats, which makes retargeting playlists of many
+songs feasible.
+
+With ``n_neighbors=None`` every transition is kept, and the result is
+the same as ``build_table_full_backtrace.build_table``.
+
+:py:func:`beam_search` walks the same graph forward, keeping only the
+cheapest partial paths, for fast approximate results (e.g. previews).
+"""
+import numpy as np
+
+# added to the penalty of nodes that break the segment constraints
+PEN_VAL = 99999999.0
+
+
+def sparse_transitions(trans_cost, song_starts, song_ends, n_beats,
+                       n_neighbors=None):
+    """Keep the cheapest transitions from each music beat to the beats
+    of its song
+
+    :param trans_cost: Transition cost table
+    :type trans_cost: 2d numpy array
+    :param song_starts: First beat of each song
+    :param song_ends: End (exclusive) of each song's beats
+    :param integer n_beats: Number of music beats
+    :param integer n_neighbors: Number of transitions to keep from each
+        beat (``None`` keeps them all)
+    :returns: ``(neighbors, costs)``, each with a row per music beat.
+        Each row lists the kept transitions in beat order, and is padded
+        at the end with transitions to beat 0 at infinite cost.
+    :rtype: (2d int numpy array, 2d numpy array)
+    """
+    widths = np.asarray(song_ends) - np.asarray(song_starts)
+    width = int(np.max(widths))
+    if n_neighbors is not None:
+        width = min(n_neighbors, width)
+
+    neighbors = np.zeros((n_beats, width), dtype=np.intp)
+    costs = np.empty((n_beats, width))
+    costs.fill(np.inf)
+
+    for start, end in zip(song_starts, song_ends):
+        n = end - start
+        block = trans_cost[start:end, start:end]
+        if n <= width:
+            kept = np.tile(np.arange(n), (n, 1))
+        else:
+            kept = np.sort(
+                np.argpartition(block, width - 1, axis=1)[:, :width], axis=1)
+        neighbors[start:end, :kept.shape[1]] = start + kept
+        costs[start:end, :kept.shape[1]] =\
+            block[np.arange(n)[:, np.newaxis], kept]
+
+    return neighbors, costs
+
+
+STRATEGIES = ("full", "checkpoint", "divide")
+
+
+def table_bytes(n_nodes, n_out, strategy="full"):
+    """Estimate the memory the dynamic program's tables take
+
+    :param integer n_nodes: Number of nodes in the (expanded) graph
+    :param integer n_out: Number of output beats
+    :param str. strategy: Backtrace strategy (see :py:func:`build_table`)
+    :returns: Size of the tables (in bytes)
+    """
+    # a cost column is 8 bytes per node, a predecessor column 4
+    if strategy == "full":
+        n_cost, n_prev = n_out, n_out
+    elif strategy == "checkpoint":
+        every = _checkpoint_every(n_out)
+        n_cost = -(-n_out // every) + every
+        n_prev = every
+    elif strategy == "divide":
+        n_cost = int(np.ceil(np.log2(max(n_out, 2)))) + 2
+        n_prev = 1
+    else:
+        raise ValueError("Unknown strategy: {}".format(strategy))
+    return n_nodes * (8 * n_cost + 4 * n_prev)
+
+
+def choose_strategy(n_nodes, n_out, memory_budget=None):
+    """Get the fastest backtrace strategy whose tables fit in a memory
+    budget. If none of them fit, the one that takes the least memory
+    ("divide").
+
+    :param integer n_nodes: Number of nodes in the (expanded) graph
+    :param integer n_out: Number of output beats
+    :param integer memory_budget: Maximum size of the tables (in bytes).
+        ``None`` means no limit.
+    :rtype: str
+    """
+    if memory_budget is not None:
+        for strategy in STRATEGIES:
+            if table_bytes(n_nodes, n_out, strategy) <= memory_budget:
+                return strategy
+        return STRATEGIES[-1]
+    return STRATEGIES[0]
+
+
+def _checkpoint_every(n_out):
+    return max(int(np.ceil(np.sqrt(n_out))), 1)
+
+
+def build_table(trans_cost, penalty, song_starts, song_ends,
+                min_beats=-1, max_beats=-1, first_pause=-1,
+                n_neighbors=None, strategy="full"):
+    """Find the cheapest path through the retargeting graph
+
+    Takes the same arguments as
+    ``build_table_full_backtrace.build_table``, plus ``n_neighbors`` and
+    ``strategy``.
+
+    The strategy sets how the path is traced back through the table.
+    They all find the same path:
+
+    * ``"full"`` keeps the cost and predecessor of every node at every
+      output beat, like ``build_table_full_backtrace``.
+    * ``"checkpoint"`` keeps the costs at every sqrt(L)-th output beat
+      (for L output beats), and recomputes the rest of the table one
+      stretch between checkpoints at a time while tracing the path. It
+      takes about twice as long as ``"full"``.
+    * ``"divide"`` recursively splits the output in half, keeping only
+      the costs at the split points. It takes about log2(L) times as
+      long as ``"full"``, in memory that barely grows with L.
+
+    :param integer n_neighbors: Number of transitions to keep from each
+        music beat (``None`` keeps them all)
+    :param str. strategy: ``"full"``, ``"checkpoint"`` or ``"divide"``
+    :returns: Node of each output beat, and the cost of each step of
+        the path
+    :rtype: (list of int, list of float)
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown strategy: {}".format(strategy))
+
+    graph = _Graph(trans_cost, penalty, song_starts, song_ends,
+                   min_beats, max_beats, first_pause, n_neighbors)
+    step = graph.step
+    n_out = graph.n_out
+
+    last_cost = graph.pen_column(n_out - 1)
+
+    # costs of impossible transitions may overflow to inf
+    with np.errstate(over='ignore', invalid='ignore'):
+        if n_out == 1:
+            node = int(np.argmin(last_cost))
+            path = [(node, last_cost[node])]
+        elif strategy == "full":
+            path = _trace(step, 0, n_out - 1, last_cost, None)
+        elif strategy == "checkpoint":
+            path = _trace_checkpointed(step, n_out, last_cost)
+        else:
+            path = _trace_divided(step, 0, n_out - 1, last_cost, None)
+
+    # cost of each step of the path
+    nodes = [node for node, _ in path]
+    path_cost = []
+    remaining = path[0][1]
+    for _, node_cost in path[1:]:
+        path_cost.append(remaining - node_cost)
+        remaining -= path_cost[-1]
+    path_cost.append(remaining)
+
+    return nodes, path_cost
+
+
+class _Graph(object):
+    """The retargeting graph of ``build_table_full_backtrace``: every
+    music beat is repeated in max_beats segments (a beat in segment s
+    has been played after s other beats since the last pause), followed
+    by the pause beats"""
+
+    def __init__(self, trans_cost, penalty, song_starts, song_ends,
+                 min_beats, max_beats, first_pause, n_neighbors):
+        self.trans_cost = np.asarray(trans_cost, dtype=np.float64)
+        self.penalty = np.asarray(penalty, dtype=np.float64)
+
+        self.no_max_beats = max_beats == -1
+        if self.no_max_beats:
+            max_beats = min_beats + 1
+        self.min_beats = min_beats
+        self.max_beats = max_beats
+
+        self.n_beats = self.p0 = first_pause
+        self.n_pauses = self.trans_cost.shape[0] - self.p0
+        self.p0_full = self.n_beats * max_beats
+        self.all_full = self.p0_full + self.n_pauses
+        self.n_out = self.penalty.shape[1]
+
+        self.neighbors, self.costs = sparse_transitions(
+            self.trans_cost, song_starts, song_ends, self.n_beats,
+            n_neighbors)
+        # song of each beat, and whether every transition in the song is
+        # kept (so that all of its beats have the same neighbors)
+        widths = np.asarray(song_ends) - np.asarray(song_starts)
+        self.beat_song = np.repeat(np.arange(len(widths)), widths)
+        self.song_kept_all = widths <= self.neighbors.shape[1]
+        self.to_pause = None
+        if self.n_pauses > 0:
+            self.to_pause = self.trans_cost[:self.n_beats, self.p0]
+
+    def pen_column(self, l):
+        """Penalty of every node at output beat l"""
+        column = np.empty(self.all_full)
+        column[:self.p0_full] = np.tile(self.penalty[:self.p0, l],
+                                        self.max_beats)
+        column[self.p0_full:] = self.penalty[self.p0:, l]
+        if not self.no_max_beats:
+            # don't start in a segment beat other than the first
+            if l == 0:
+                column[self.n_beats:self.p0_full] += PEN_VAL
+            # don't end in a segment beat before min_beats
+            if l == self.n_out - 1:
+                column[:self.n_beats * self.min_beats] += PEN_VAL
+        return column
+
+    def _can_pause(self, seg):
+        # whether beats in segment seg may go to the first pause beat
+        if self.n_pauses == 0:
+            return False
+        if self.no_max_beats:
+            return seg == self.max_beats - 1
+        return seg >= self.min_beats - 1
+
+    def _next_segment_start(self, seg):
+        # first node of the segment that beats in segment seg go on to
+        # (None if they must go to a pause)
+        if seg < self.max_beats - 1:
+            return (seg + 1) * self.n_beats
+        if self.no_max_beats:
+            return seg * self.n_beats
+        return None
+
+    def step(self, l, next_cost):
+        """Cost and best next node of every node at output beat l, from
+        the costs at output beat l + 1"""
+        n_beats, p0, p0_full = self.n_beats, self.p0, self.p0_full
+        all_full, n_pauses = self.all_full, self.n_pauses
+        pen = self.pen_column(l)
+        cost = np.empty(all_full)
+        prev_node = np.zeros(all_full, dtype=np.int32)
+        rows = np.arange(n_beats)
+
+        for seg in xrange(self.max_beats):
+            lo = seg * n_beats
+            hi = lo + n_beats
+            seg_pen = pen[lo:hi]
+            next_lo = self._next_segment_start(seg)
+
+            if next_lo is None:
+                # must go to the first pause beat
+                cost[lo:hi] = self.to_pause + seg_pen + next_cost[p0_full]
+                prev_node[lo:hi] = p0_full
+                continue
+
+            # cheapest kept transition of each beat, first in beat order
+            # on ties (like the full table)
+            vals = (self.costs + seg_pen[:, np.newaxis] +
+                    next_cost[next_lo + self.neighbors])
+            k = np.argmin(vals, axis=1)
+            vals = vals[rows, k]
+            nodes = next_lo + self.neighbors[rows, k]
+
+            if self._can_pause(seg):
+                # or go to the first pause beat
+                pause_vals = self.to_pause + seg_pen + next_cost[p0_full]
+                to_p = pause_vals < vals
+                vals[to_p] = pause_vals[to_p]
+                nodes[to_p] = p0_full
+
+            cost[lo:hi] = vals
+            prev_node[lo:hi] = nodes
+
+        if n_pauses > 0:
+            # pause beats other than the last go to pause beats
+            vals = (self.trans_cost[p0:p0 + n_pauses - 1, p0:] +
+                    pen[p0_full:all_full - 1, np.newaxis] +
+                    next_cost[p0_full:])
+            k = np.argmin(vals, axis=1)
+            cost[p0_full:all_full - 1] = vals[np.arange(n_pauses - 1), k]
+            prev_node[p0_full:all_full - 1] = p0_full + k
+
+            # the last pause beat goes back to a first segment beat
+            vals = (self.trans_cost[p0 + n_pauses - 1, :n_beats] +
+                    pen[all_full - 1] + next_cost[:n_beats])
+            k = np.argmin(vals)
+            cost[all_full - 1] = vals[k]
+            prev_node[all_full - 1] = k
+
+        return cost, prev_node
+
+    def extend(self, nodes, cost):
+        """Extend paths ending at distinct nodes by each (kept) transition
+        out of their last node. Paths from beats of a song whose
+        transitions are all kept only reach the same beats, so only the
+        cheapest one from each song and segment to each beat is kept.
+
+        :param nodes: Last node of each path
+        :param cost: Cost of each path
+        :returns: (index into ``nodes``, next node, cost) of each extended
+            path
+        """
+        n_beats, p0, p0_full = self.n_beats, self.p0, self.p0_full
+        n_pauses = self.n_pauses
+        parents, succs, costs = [], [], []
+
+        # music beats go on to the next segment (or stay in the last one
+        # without max_beats) ...
+        beat_idx = np.where(nodes < p0_full)[0]
+        segs = nodes[beat_idx] // n_beats
+        beats = nodes[beat_idx] % n_beats
+        next_lo = (segs + 1) * n_beats
+        if self.no_max_beats:
+            stays = segs == self.max_beats - 1
+            next_lo[stays] = segs[stays] * n_beats
+            goes_on = np.ones(len(segs), dtype=bool)
+        else:
+            goes_on = segs < self.max_beats - 1
+
+        grouped = goes_on & self.song_kept_all[self.beat_song[beats]]
+        if np.any(grouped):
+            idx = np.where(grouped)[0]
+            group = self.beat_song[beats[idx]] * (self.max_beats + 1) +\
+                next_lo[idx] // n_beats
+            idx = idx[np.argsort(group, kind='mergesort')]
+            group = np.sort(group)
+            splits = np.where(np.diff(group) != 0)[0] + 1
+            cols = np.arange(self.neighbors.shape[1])
+            for g_idx in np.split(idx, splits):
+                paths = (cost[beat_idx[g_idx], np.newaxis] +
+                         self.costs[beats[g_idx]])
+                best = np.argmin(paths, axis=0)
+                parents.append(beat_idx[g_idx[best]])
+                succs.append(next_lo[g_idx[0]] +
+                             self.neighbors[beats[g_idx[0]]])
+                costs.append(paths[best, cols])
+
+        each = goes_on & ~grouped
+        width = self.neighbors.shape[1]
+        parents.append(np.repeat(beat_idx[each], width))
+        succs.append((next_lo[each, np.newaxis] +
+                      self.neighbors[beats[each]]).ravel())
+        costs.append((cost[beat_idx[each], np.newaxis] +
+                      self.costs[beats[each]]).ravel())
+
+        # ... and/or to the first pause beat
+        if n_pauses > 0:
+            if self.no_max_beats:
+                to_pause = segs == self.max_beats - 1
+            else:
+                to_pause = segs >= self.min_beats - 1
+            parents.append(beat_idx[to_pause])
+            succs.append(np.repeat(p0_full, np.count_nonzero(to_pause)))
+            costs.append(cost[beat_idx[to_pause]] +
+                         self.to_pause[beats[to_pause]])
+
+        # pause beats other than the last go to pause beats
+        pause_idx = np.where((nodes >= p0_full) &
+                             (nodes < p0_full + n_pauses - 1))[0]
+        parents.append(np.repeat(pause_idx, n_pauses))
+        succs.append(np.tile(p0_full + np.arange(n_pauses), len(pause_idx)))
+        costs.append((cost[pause_idx, np.newaxis] + self.trans_cost[
+            p0 + nodes[pause_idx] - p0_full, p0:]).ravel())
+
+        # the last pause beat goes back to first segment beats
+        if n_pauses > 0:
+            last_idx = np.where(nodes == p0_full + n_pauses - 1)[0]
+            parents.append(np.repeat(last_idx, n_beats))
+            succs.append(np.tile(np.arange(n_beats), len(last_idx)))
+            costs.append((cost[last_idx, np.newaxis] + self.trans_cost[
+                p0 + n_pauses - 1, :n_beats]).ravel())
+
+        return (np.concatenate(parents).astype(np.intp),
+                np.concatenate(succs).astype(np.intp),
+                np.concatenate(costs))
+
+    def transition_cost(self, node, next_node):
+        """Cost of going from one node to another"""
+        return self.trans_cost[self._table_index(node),
+                               self._table_index(next_node)]
+
+    def _table_index(self, node):
+        # row/column of a node in trans_cost
+        if node >= self.p0_full:
+            return self.p0 + node - self.p0_full
+        return node % self.n_beats
+
+
+def beam_search(trans_cost, penalty, song_starts, song_ends,
+                min_beats=-1, max_beats=-1, first_pause=-1,
+                beam_width=None, margin=None, n_neighbors=None):
+    """Find a cheap (but not necessarily the cheapest) path through the
+    retargeting graph, quickly
+
+    Paths are extended one output beat at a time, only keeping the
+    ``beam_width`` cheapest paths (each ending at a different node), and
+    dropping paths that cost more than ``margin`` above the cheapest.
+
+    Each output beat costs about O(B * K) for a beam of B paths and K
+    transitions per beat, instead of the O(N * K) of the full table for N
+    nodes (music beats times segments, plus pause beats). So the beam
+    is faster than the exact solvers when B is much smaller than N, e.g.,
+    for many songs or a large ``max_beats``. For a single short song the
+    exact solvers are about as fast. ``benchmark_retarget.py`` in
+    ``radiotool/tests`` compares the two.
+
+    Takes the same arguments as :py:func:`build_table`, plus:
+
+    :param integer beam_width: Number of paths to keep at each output
+        beat (``None`` for no limit)
+    :param float margin: Drop paths that cost this much more than the
+        cheapest path (``None`` for no limit)
+    :returns: Node of each output beat, and the cost of each step of
+        the path
+    :rtype: (list of int, list of float)
+    """
+    graph = _Graph(trans_cost, penalty, song_starts, song_ends,
+                   min_beats, max_beats, first_pause, n_neighbors)
+
+    # costs of impossible transitions may overflow to inf
+    with np.errstate(over='ignore', invalid='ignore'):
+        cost = graph.pen_column(0)
+        nodes = _cheapest_distinct(cost, np.arange(len(cost)), beam_width,
+                                   margin)
+        cost = cost[nodes]
+        beams = [(nodes, None)]
+
+        for l in xrange(1, graph.n_out):
+            parents, succs, cand_cost = graph.extend(nodes, cost)
+            cand_cost += graph.pen_column(l)[succs]
+            keep = _cheapest_distinct(cand_cost, succs, beam_width, margin)
+            nodes = succs[keep]
+            cost = cand_cost[keep]
+            beams.append((nodes, parents[keep]))
+
+    # trace the cheapest path back
+    i = int(np.argmin(cost))
+    path = []
+    for nodes, parents in reversed(beams):
+        path.append(int(nodes[i]))
+        if parents is not None:
+            i = parents[i]
+    path.reverse()
+
+    path_cost = []
+    for l in xrange(graph.n_out):
+        step_cost = graph.pen_column(l)[path[l]]
+        if l < graph.n_out - 1:
+            step_cost += graph.transition_cost(path[l], path[l + 1])
+        path_cost.append(step_cost)
+
+    return path, path_cost
+
+
+def _cheapest_distinct(cost, keys, width=None, margin=None):
+    """Indices of the cheapest entry of each key, for the ``width``
+    cheapest keys whose cheapest entry is within ``margin`` of the
+    cheapest entry overall, in order of cost
+
+    Only the cheapest entries are sorted: the cheapest ``width`` keys are
+    all among the cheapest m entries for some m not much bigger than
+    ``width`` (unless many entries share a key), and each of their
+    cheapest entries is too.
+    """
+    candidates = np.arange(len(cost))
+    if margin is not None and len(cost) > 0:
+        candidates = np.where(cost <= np.min(cost) + margin)[0]
+    m = len(candidates)
+    if width is not None:
+        m = min(2 * width, m)
+
+    while True:
+        part = candidates
+        if m < len(candidates):
+            # the cheapest m entries, and any that tie with the last one
+            # (so that ties are broken in order, like a stable sort)
+            kth = np.partition(cost[candidates], m - 1)[m - 1]
+            part = candidates[cost[candidates] <= kth]
+        order = part[np.argsort(cost[part], kind='mergesort')]
+        _, first = np.unique(keys[order], return_index=True)
+        if width is None or len(first) >= width or m == len(candidates):
+            break
+        # grow by the number of entries per key so far
+        m = min(max(2 * m, 3 * m * width // (2 * max(len(first), 1))),
+                len(candidates))
+
+    return order[np.sort(first)][:width]
+
+
+def _trace(step, start, end, end_cost, start_node):
+    """Trace the path from output beat ``start`` to ``end``, keeping the
+    whole table between them
+
+    :param step: Function that computes the costs and best next nodes at
+        an output beat from the costs at the next one
+    :param end_cost: Costs at output beat ``end``
+    :param start_node: Node at output beat ``start`` (``None`` picks the
+        cheapest)
+    :returns: List of (node, cost to the end from that node) for output
+        beats ``start`` through ``end``
+    """
+    costs = [None] * (end - start)
+    prev_nodes = [None] * (end - start)
+    next_cost = end_cost
+    for l in xrange(end - 1, start - 1, -1):
+        costs[l - start], prev_nodes[l - start] = step(l, next_cost)
+        next_cost = costs[l - start]
+
+    node = start_node
+    if node is None:
+        node = int(np.argmin(costs[0]))
+    path = []
+    for l in xrange(end - start):
+        path.append((node, costs[l][node]))
+        node = int(prev_nodes[l][node])
+    path.append((node, end_cost[node]))
+    return path
+
+
+def _trace_checkpointed(step, n_out, last_cost):
+    """Like :py:func:`_trace` over all output beats, but only keeping
+    the costs at every sqrt(n_out)-th output beat"""
+    every = _checkpoint_every(n_out)
+    checkpoints = {n_out - 1: last_cost}
+    cost = last_cost
+    for l in xrange(n_out - 2, -1, -1):
+        cost = step(l, cost)[0]
+        if l % every == 0:
+            checkpoints[l] = cost
+
+    path = []
+    node = None
+    for start in xrange(0, n_out - 1, every):
+        end = min(start + every, n_out - 1)
+        part = _trace(step, start, end, checkpoints[end], node)
+        path.extend(part[:-1])
+        node = part[-1][0]
+        del checkpoints[start]
+    path.append((node, last_cost[node]))
+    return path
+
+
+def _trace_divided(step, start, end, end_cost, start_node):
+    """Like :py:func:`_trace`, but only keeping the costs at the middle
+    output beat, and tracing each half recursively"""
+    if end - start <= 2:
+        return _trace(step, start, end, end_cost, start_node)
+
+    middle = (start + end) // 2
+    cost = end_cost
+    for l in xrange(end - 1, middle - 1, -1):
+        cost = step(l, cost)[0]
+
+    first = _trace_divided(step, start, middle, cost, start_node)
+    del cost
+    second = _trace_divided(step, middle, end, end_cost, first[-1][0])
+    return first[:-1] + second
@@ -8,6 +8,7 @@ import copy
 import numpy as np
 from scipy.special import binom
 import scipy
+import scipy.spatial.distance
 
 import librosa_analysis
 import novelty
@@ -66,28 +67,12 @@ class TimbrePitchConstraint(Constraint):
         self.m = context
 
     def apply(self, transition_cost, penalty, song, beat_names):
-        timbre_dist = librosa_analysis.structure(
-            np.array(song.analysis['timbres']).T)
-        chroma_dist = librosa_analysis.structure(
-            np.array(song.analysis['chroma']).T)
-
-        dists = self.tw * timbre_dist + self.cw * chroma_dist
+        dists = self.tw * song.timbre_dist + self.cw * song.chroma_dist
 
         if self.m > 0:
-            new_dists = np.copy(dists)
-            coefs = [binom(self.m * 2, i) for i in range(self.m * 2 + 1)]
-            coefs = np.array(coefs) / np.sum(coefs)
-            for beat_i in xrange(self.m, dists.shape[0] - self.m):
-                for beat_j in xrange(self.m, dists.shape[1] - self.m):
-                    new_dists[beat_i, beat_j] = 0.0
-                    for i, c in enumerate(coefs):
-                        t = i - self.m
-                        new_dists[beat_i, beat_j] +=\
-                            c * dists[beat_i + t, beat_j + t]
-
-            dists = new_dists
-
-        # dists = np.copy(song.analysis["dense_dist"])
+            dists = self._smooth(dists)
+
+        # dists = song.dense_dist.astype(np.float64)
         # shift it over
         dists[:-1, :] = dists[1:, :]
         dists[-1, :] = np.inf
@@ -99,6 +84,28 @@ class TimbrePitchConstraint(Constraint):
 
         return transition_cost, penalty, beat_names
 
+    def _smooth(self, dists):
+        """Binomial smoothing along the diagonals of the distance matrix:
+        the distance from beat i to beat j becomes a weighted sum of the
+        distances from i + t to j + t, for t in [-context, context].
+        Beats within ``context`` of either edge are left as is."""
+        m = self.m
+        n_i = dists.shape[0] - 2 * m
+        n_j = dists.shape[1] - 2 * m
+        if n_i <= 0 or n_j <= 0:
+            return dists
+
+        coefs = [binom(m * 2, i) for i in range(m * 2 + 1)]
+        coefs = np.array(coefs) / np.sum(coefs)
+
+        smoothed = np.zeros((n_i, n_j), dtype=dists.dtype)
+        for i, c in enumerate(coefs):
+            smoothed += c * dists[i:i + n_i, i:i + n_j]
+
+        dists = np.copy(dists)
+        dists[m:m + n_i, m:m + n_j] = smoothed
+        return dists
+
     def __repr__(self):
         return "TimbrePitchConstraint:" +\
             "%f(timbre) + %f(chroma), %f(context)" % (self.tw, self.cw, self.m)
@@ -111,10 +118,11 @@ class RhythmConstraint(Constraint):
 
     def apply(self, transition_cost, penalty, song, beat_names):
         n_beats = len(song.analysis["beats"])
-        for i in range(self.time):
-            for j in set(range(self.time)) - set([(i + 1) % self.time]):
-                transition_cost[i:n_beats:self.time][j:n_beats:self.time] +=\
-                    self.p
+        # position of each beat in its measure. Going from beat i to beat
+        # j costs nothing only if j is in the position that follows i's.
+        position = np.arange(n_beats) % self.time
+        off_beat = position != ((position + 1) % self.time)[:, np.newaxis]
+        transition_cost[:n_beats, :n_beats] += self.p * off_beat
         return transition_cost, penalty, beat_names
 
 
@@ -124,10 +132,10 @@ class MinimumLoopConstraint(Constraint):
 
     def apply(self, transition_cost, penalty, song, beat_names):
         n_beats = len(song.analysis["beats"])
-        for i in range(n_beats):
-            for j in range(-(self.min_loop - 1), 1):
-                if 0 <= i + j < n_beats:
-                    transition_cost[i, i + j] += np.inf
+        # no jumps from beat i back to beats i - min_loop + 1 through i
+        back = np.subtract.outer(np.arange(n_beats), np.arange(n_beats))
+        too_short = (back >= 0) & (back < self.min_loop)
+        transition_cost[:n_beats, :n_beats][too_short] += np.inf
         return transition_cost, penalty, beat_names
 
     def __repr__(self):
@@ -143,48 +151,56 @@ class LabelConstraint(Constraint):
 
     def apply(self, transition_cost, penalty, song, beat_names):
         n_beats = len(song.analysis["beats"])
+        n_nodes = transition_cost.shape[0]
+        n_target = penalty.shape[1]
 
         # extend in_labels to work with pauses that we may have added
-        if n_beats < transition_cost.shape[0]:
-            self.in_labels.extend(
-                [None] * (transition_cost.shape[0] - n_beats))
-
-        new_pen = np.ones(penalty.shape) * np.array(self.penalty)
-        # new_pen = np.ones((n_beats, len(self.penalty))) *\
-        #       np.array(self.penalty)
-        n_target = penalty.shape[1]
-        for n_i in xrange(transition_cost.shape[0]):
-            node_label = self.in_labels[n_i]
+        in_labels = list(self.in_labels[:n_nodes])
+        in_labels.extend([None] * (n_nodes - len(in_labels)))
+
+        # label codes, with None as -1
+        codes = {}
+        for label in in_labels + list(self.out_labels[:n_target]):
+            if label is not None and label not in codes:
+                codes[label] = len(codes)
+        node_codes = np.array([codes.get(label, -1) for label in in_labels])
+        target_codes = np.array(
+            [codes.get(label, -1) for label in self.out_labels[:n_target]])
+
+        # no penalty where the node's label matches the target, or
+        # either label is missing
+        matches = ((node_codes[:, np.newaxis] == target_codes) |
+                   (node_codes[:, np.newaxis] == -1) |
+                   (target_codes == -1))
+
+        # Penalties ramp up to the full penalty over the window before
+        # and after each change in the target labels. The ramps are the
+        # same for every node. Where ramps overlap, the latest one wins:
+        # a ramp before a change is written after its beats' labels were
+        # compared, so it also replaces the matching labels' zero.
+        before = np.empty(n_target)
+        before.fill(np.nan)
+        after = np.empty(n_target)
+        after.fill(np.nan)
+        if self.window > 0:
             for l in xrange(1, n_target - 1):
-                prev_target = self.out_labels[l - 1]
-                next_target = self.out_labels[l + 1]
-                target_label = self.out_labels[l]
-
-                if node_label == target_label or target_label is None:
-                    new_pen[n_i, l] = 0.0
-                elif node_label is None:
-                    # should this have a penalty?
-                    new_pen[n_i, l] = 0.0
-
-                if self.window > 0:
-                    if target_label != prev_target:
-                        # reduce penalty for beats prior
-                        span = min(self.window, l)
-                        new_pen[n_i, l - span:l] =\
-                            np.linspace(1.0, 0.01, num=span)
-
-                    if target_label != next_target:
-                        # reduce penalty for beats later
-                        span = min(self.window, len(self.out_labels) - l - 1)
-                        new_pen[n_i, l + 1:l + span + 1] =\
-                            np.linspace(0.01, 1.0, num=span)
-
-            for l in [0, n_target - 1]:
-                target_label = self.out_labels[l]
-                if node_label == target_label or target_label is None:
-                    new_pen[n_i, l] = 0.0
-                elif node_label is None:
-                    new_pen[n_i, l] = 0.0
+                if self.out_labels[l] != self.out_labels[l - 1]:
+                    span = min(self.window, l)
+                    before[l - span:l] = np.linspace(1.0, 0.01, num=span)
+                if self.out_labels[l] != self.out_labels[l + 1]:
+                    span = min(self.window, len(self.out_labels) - l - 1)
+                    after[l + 1:l + span + 1] =\
+                        np.linspace(0.01, 1.0, num=span)
+
+        ramp = np.where(np.isnan(before), after, before)
+        new_pen = np.ones(penalty.shape) * np.array(self.penalty)
+        has_ramp = ~np.isnan(ramp)
+        new_pen[:, has_ramp] = ramp[has_ramp]
+
+        # the first and last output beats are compared after every ramp
+        can_zero = np.isnan(before)
+        can_zero[[0, -1]] = True
+        new_pen[matches & can_zero] = 0.0
 
         penalty += new_pen
 
@@ -202,25 +218,14 @@ class ValenceArousalConstraint(Constraint):
         self.window = penalty_window
 
     def apply(self, transition_cost, penalty, song, beat_names):
-        n_beats = len(song.analysis["beats"])
-
-        # extend in_va to work with pauses that have been added
-        if n_beats < transition_cost.shape[0]:
-            n_pauses = transition_cost.shape[0] - n_beats
-            extra_va = np.zeros((n_pauses, 2))
-            self.in_va = np.r_[self.in_va, extra_va]
+        n_beats = min(len(song.analysis["beats"]), transition_cost.shape[0])
+        n_target = penalty.shape[1]
 
         new_pen = np.ones(penalty.shape) * np.array(self.penalty)
-        n_target = penalty.shape[1]
-        for n_i in xrange(transition_cost.shape[0]):
-            node_va = self.in_va[n_i]
-            for l in xrange(n_target):
-                if n_i < n_beats:
-                    new_pen[n_i, l] *=\
-                        np.linalg.norm(self.target_va[l] - node_va)
-                else:
-                    # pauses have no penalty here
-                    new_pen[n_i, l] *= 0
+        new_pen[:n_beats] *= scipy.spatial.distance.cdist(
+            self.in_va[:n_beats], self.target_va[:n_target])
+        # pauses have no penalty here
+        new_pen[n_beats:] = 0.0
 
         penalty += new_pen
 
@@ -245,19 +250,14 @@ class EnergyConstraint(Constraint):
         self.penalty = penalty
 
     def apply(self, transition_cost, penalty, song, beat_names):
-        sr = song.samplerate
-        frames = song.all_as_mono()
-        n_beats = len(song.analysis["beats"])
-
-        energies = np.zeros(n_beats)
-        for i, beat in enumerate(beat_names[:n_beats - 1]):
-            start_frame = int(sr * beat)
-            end_frame = int(sr * beat_names[:n_beats][i + 1])
-            beat_frames = frames[start_frame:end_frame]
-            beat_frames *= np.hamming(len(beat_frames))
-            energies[i] = np.sqrt(np.mean(beat_frames * beat_frames))
+        beats = song.analysis["beats"]
+        n_beats = len(beats)
 
-        energies[-1] = energies[-2]
+        energies = song.analysis.get("beat_energy")
+        if energies is None:
+            # analyses from before beat energy was part of the analysis
+            energies = librosa_analysis.beat_energy(
+                song.range_as_mono, song.duration, song.samplerate, beats)
         energies = [[x] for x in energies]
 
         dist_matrix = 10 * scipy.spatial.distance.squareform(
@@ -720,76 +720,28 @@ class NoveltyVAConstraint(Constraint):
 
 
 class MusicDurationConstraint(Constraint):
+    """Limit the length of the music between pauses.
+
+    The tables are left as they are: the retargeting kernels already
+    expand each music beat into its position within the current run of
+    music, without materializing the expanded tables (see the
+    ``min_beats`` and ``max_beats`` arguments of
+    :py:func:`radiotool.algorithms.retarget.retarget`). ``apply``
+    records the limits, in beats, in ``min_beats`` and ``max_beats``,
+    which ``retarget`` passes on to the kernels.
+    """
     def __init__(self, min_length, max_length):
         self.minlen = min_length
         self.maxlen = max_length
+        self.min_beats = self.max_beats = None
 
     def apply(self, transition_cost, penalty, song, beat_names):
         beat_len = song.analysis[BEAT_DUR_KEY]
-        minlen = int(self.minlen / beat_len)
-        maxlen = int(self.maxlen / beat_len)
-        beats = song.analysis["beats"]
-        n_beats = len(beats)
-        n_pause_beats = transition_cost.shape[0] - n_beats
-
-        # basically infinity.
-        pen_val = 99999999.0
-
-        # Create new transition cost table
-        # (beat * beat index in max span) x
-        #    (beat * beat index in max span of music)
-        # Is this too large?
-        new_tc_size = n_beats * maxlen + n_pause_beats
-        p0 = n_beats * maxlen
-        new_tc = np.empty((new_tc_size, new_tc_size))
-
-        # tile the tc over this new table
-        new_tc[:p0, :p0] = np.tile(transition_cost[:n_beats, :n_beats],
-                                   (maxlen, maxlen))
-        # tile the pause information as well
-        new_tc[:p0, p0:] = np.tile(transition_cost[:n_beats, n_beats:],
-                                   (maxlen, 1))
-        new_tc[p0:, :p0] = np.tile(transition_cost[n_beats:, :n_beats],
-                                   (1, maxlen))
-        new_tc[p0:, p0:] = transition_cost[n_beats:, n_beats:]
-
-        # Create new penalty table
-        # (beat * beat index in max span) x (beats in output)
-        new_pen = np.empty((new_tc_size, penalty.shape[1]))
-
-        # tile the tc over this new table
-        new_pen[:p0, :] = np.tile(penalty[:n_beats, :],
-                                  (maxlen, 1))
-        new_pen[p0:, :] = penalty[n_beats:, :]
-
-        #--- CONSTRAINTS ---#
-        # * don't start song in segment beat other than first
-        new_pen[n_beats:(n_beats * maxlen), 0] += pen_val
-
-        # * don't go to pause before minimum length music segment
-        new_tc[:(n_beats * minlen), p0] += pen_val
-
-        # * must go to pause if we're at the maxlen-th beat
-        new_tc[n_beats * (maxlen - 1):n_beats * maxlen, :p0] += pen_val
-
-        # * after pause, don't go to non-first segment beat
-        new_tc[p0:, n_beats:p0] += pen_val
-
-        # * don't move between beats that don't follow
-        #   the segment index
-        new_tc[:p0, :p0] += pen_val
-        for i in xrange(1, maxlen):
-            new_tc[(i - 1) * n_beats:i * n_beats,
-                   i * n_beats:(i + 1) * n_beats] -= pen_val
-
-        # update beat_names
-        pause_names = beat_names[n_beats:]
-        new_beat_names = []
-        for rep in xrange(maxlen):
-            new_beat_names.extend(beat_names[:n_beats])
-        new_beat_names.extend(pause_names)
-
-        return new_tc, new_pen, new_beat_names
+        # a run of music may go to a pause from its (minlen + 1)-th
+        # beat, and must go to one after its maxlen-th beat
+        self.min_beats = int(self.minlen / beat_len) + 1
+        self.max_beats = int(self.maxlen / beat_len)
+        return transition_cost, penalty, beat_names
 
     def __repr__(self):
         return "MusicDurationConstraint"
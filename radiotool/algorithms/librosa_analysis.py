@@ -4,75 +4,192 @@ import scipy
 import scipy.signal
 import librosa
 
+# bump this when the analysis changes so that stored analyses (see
+# radiotool.analysis_store) are recomputed
+VERSION = 5
 
-def structure(X):
-    d, n = X.shape
+HOP_LENGTH = 128
+N_FFT = 2048
+N_MELS = 80
+FMAX = 8000
+N_MFCC = 40
+# librosa.logamplitude defaults
+AMIN = 1e-10
+TOP_DB = 80.0
+# resolution of the tuning estimate (in chroma bins), and of the
+# spectral peak levels that set which peaks it counts (in dB)
+TUNING_RESOLUTION = 0.01
+TUNING_LEVEL_RESOLUTION = 0.25
+
+# Analysis profiles. The spectral features (mfcc, chroma) are computed
+# at "hop_length" after resampling to "samplerate" (None keeps the
+# input rate), and beats are tracked at the finer "beat_hop_length".
+PROFILES = {
+    # the original analysis, at the input rate
+    "full": {
+        "samplerate": None,
+        "hop_length": HOP_LENGTH,
+        "beat_hop_length": HOP_LENGTH,
+    },
+    # 22.05 kHz with a coarse feature hop. Beats are still tracked at
+    # the same time resolution as "full" (at 44.1 kHz).
+    "fast": {
+        "samplerate": 22050,
+        "hop_length": 512,
+        "beat_hop_length": 64,
+    },
+}
+
+
+def analysis_params(profile="full", block_duration=None):
+    """Get the parameters that identify the analysis, for caching
+
+    :param str. profile: Name of analysis profile (see ``PROFILES``)
+    :param float block_duration: Block length of a chunked analysis (see
+        :py:func:`analyze_chunked`), or ``None`` for a whole-signal one
+    """
+    params = {
+        "version": VERSION,
+        "n_fft": N_FFT,
+        "n_mels": N_MELS,
+        "fmax": FMAX,
+        "n_mfcc": N_MFCC,
+    }
+    params.update(PROFILES[profile])
+    # chunked analyses can differ slightly from whole-signal ones (e.g.,
+    # resampling is done a block at a time), so they're stored
+    # separately
+    if block_duration is not None:
+        params["block_duration"] = float(block_duration)
+    return params
+
+
+def condensed_structure(X):
+    """Cosine distances between the (z-scored) columns of ``X``, in
+    condensed form (see ``scipy.spatial.distance.pdist``)
+
+    :rtype: 1d float32 numpy array
+    """
     X = scipy.stats.zscore(X, axis=1)
-    D = scipy.spatial.distance.squareform(
-        scipy.spatial.distance.pdist(X.T, metric="cosine"))
-    return D[:-1, :-1]
+    return scipy.spatial.distance.pdist(
+        X.T, metric="cosine").astype(np.float32)
+
+
+def structure(X):
+    """Cosine distance matrix between the columns of ``X``, without the
+    last (phantom beat) column
 
+    :rtype: 2d float32 numpy array
+    """
+    return scipy.spatial.distance.squareform(condensed_structure(X))[:-1, :-1]
 
-def analyze_file(infile, debug=False):
+
+def dense_dist(analysis):
+    """Get the beat distance matrix of an analysis, which is stored as
+    ``condensed_dist``
+
+    :rtype: 2d float32 numpy array
+    """
+    return scipy.spatial.distance.squareform(
+        np.asarray(analysis["condensed_dist"]))[:-1, :-1]
+
+
+def analyze_file(infile, debug=False, profile="full"):
     y, sr = librosa.load(infile, sr=44100)
-    return analyze_frames(y, sr, debug)
+    return analyze_frames(y, sr, debug, profile=profile)
 
 
-def analyze_frames(y, sr, debug=False):
+def analyze_frames(y, sr, debug=False, profile="full"):
     A = {}
+    y_in, sr_in = y, sr
 
-    hop_length = 128
+    params = PROFILES[profile]
+    hop_length = params["hop_length"]
+    beat_hop_length = params["beat_hop_length"]
 
     # First, get the track duration
     A['duration'] = float(len(y)) / sr
 
-    # Then, get the beats
+    if params["samplerate"] is not None and params["samplerate"] != sr:
+        if debug: print "> resampling"
+        y = librosa.resample(y, sr, params["samplerate"])
+        sr = params["samplerate"]
+
+    # Every spectral feature is derived from one magnitude spectrogram
+    if debug: print "> spectrogram"
+    S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=hop_length))
+    P = S**2
+
+    # The chroma filterbank is tuned to the whole recording
+    tuning = _TuningEstimator(sr)
+    tuning.add(S)
+
+    # Then, get the beats. At the feature hop, the onset envelope is
+    # the one beat_track would compute from y, from the shared
+    # spectrogram. Otherwise it needs its own, finer, spectrogram.
     if debug: print "> beat tracking"
-    tempo, beats = librosa.beat.beat_track(y, sr, hop_length=hop_length)
+    if beat_hop_length == hop_length:
+        onset_env = librosa.onset.onset_strength(
+            S=librosa.logamplitude(librosa.feature.melspectrogram(S=P, sr=sr)),
+            sr=sr, n_fft=N_FFT, hop_length=hop_length)
+    else:
+        onset_env = librosa.onset.onset_strength(
+            y=y, sr=sr, n_fft=N_FFT, hop_length=beat_hop_length)
+    tempo, beat_frames = beat_track(onset_env, sr, beat_hop_length)
 
     # Push the last frame as a phantom beat
     A['tempo'] = tempo
     A['beats'] = librosa.frames_to_time(
-        beats, sr, hop_length=hop_length).tolist()
+        beat_frames, sr, hop_length=beat_hop_length).tolist()
+
+    # beat locations in feature frames
+    beats = (np.asarray(beat_frames) * beat_hop_length) // hop_length
 
     if debug: print "beats count: ", len(A['beats'])
 
-    if debug: print "> spectrogram"
-    S = librosa.feature.melspectrogram(y, sr,
-                                       n_fft=2048,
-                                       hop_length=hop_length,
-                                       n_mels=80,
-                                       fmax=8000)
-    S = S / S.max()
+    if debug: print "> beat energy"
+    A['beat_energy'] = beat_energy(lambda start, end: y_in[start:end],
+                                   len(y_in), sr_in, A['beats'])
+
+    if debug: print "> mel spectrogram"
+    M = librosa.feature.melspectrogram(S=P, sr=sr,
+                                       n_mels=N_MELS,
+                                       fmax=FMAX)
+    del P
+    M = M / M.max()
 
-    # A['spectrogram'] = librosa.logamplitude(librosa.feature.sync(S, beats)**2).T.tolist()
+    # A['spectrogram'] = librosa.logamplitude(librosa.feature.sync(M, beats)**2).T.tolist()
 
     # Let's make some beat-synchronous mfccs
     if debug: print "> mfcc"
-    S = librosa.feature.mfcc(S=librosa.logamplitude(S), n_mfcc=40)
-    A['timbres'] = librosa.feature.sync(S, beats).T.tolist()
+    M = librosa.feature.mfcc(S=librosa.logamplitude(M), n_mfcc=N_MFCC)
+    A['timbres'] = librosa.feature.sync(M, beats).T.tolist()
+    del M
 
     if debug: print "timbres count: ", len(A['timbres'])
 
     # And some chroma
     if debug: print "> chroma"
-    S = np.abs(librosa.stft(y, hop_length=hop_length))
 
     # Grab the harmonic component
     H = librosa.decompose.hpss(S)[0]
+    del S
 
     # H = librosa.hpss.hpss_median(S, win_P=31, win_H=31, p=1.0)[0]
-    A['chroma'] = librosa.feature.sync(librosa.feature.chromagram(S=H, sr=sr),
-                                        beats,
-                                        aggregate=np.median).T.tolist()
-
-    # Relative loudness
-    S = S / S.max()
-    S = S**2
+    A['chroma'] = librosa.feature.sync(
+        librosa.feature.chromagram(S=H, sr=sr, tuning=tuning.tuning()),
+        beats, aggregate=np.median).T.tolist()
+    del H
 
     if debug: print "> dists"
-    dists = structure(np.vstack([np.array(A['timbres']).T, np.array(A['chroma']).T]))
-    A['dense_dist'] = dists
+    return _add_structure(A)
+
+
+def _add_structure(A):
+    """Add the (condensed) beat distances and beat duration statistics to
+    an analysis with beats, timbres and chroma"""
+    A['condensed_dist'] = condensed_structure(
+        np.vstack([np.array(A['timbres']).T, np.array(A['chroma']).T]))
 
     edge_lens = [A["beats"][i] - A["beats"][i - 1]
                  for i in xrange(1, len(A["beats"]))]
@@ -82,6 +199,342 @@ def analyze_frames(y, sr, debug=False):
     return A
 
 
+def analyze_chunked(read, n_samples, sr, block_duration=60.0, debug=False,
+                    profile="full"):
+    """Analyze a recording block by block, without holding all of it (or
+    its spectrogram) in memory
+
+    The result is the same analysis as :py:func:`analyze_frames`
+    computes, in three passes over the audio. The first pass finds the
+    peaks of the mel spectrograms, which set the floor of their log
+    amplitudes (and the mfcc normalization) over the whole recording,
+    and estimates the tuning of the recording for the chroma.
+    The second pass computes the onset envelope, which is all the beat
+    tracker needs to see of the whole recording. The third pass computes
+    the spectral features of each block (with a margin of frames on
+    either side, so that the harmonic separation at the block edges sees
+    the same neighborhood as it would in one pass) and aggregates them
+    into beat-synchronous timbres and chroma as each beat completes.
+
+    Memory use is proportional to ``block_duration``, apart from the
+    onset envelope and the beat-synchronous features themselves.
+
+    :param read: Function ``read(start, end)`` that returns samples
+        ``start`` to ``end`` (exclusive) of the mono recording
+    :param integer n_samples: Length of the recording (in samples)
+    :param integer sr: Sample rate of the recording
+    :param float block_duration: Length of each block (in seconds)
+    :param str. profile: Name of analysis profile (see ``PROFILES``)
+    """
+    A = {}
+    read_in, n_samples_in, sr_in = read, n_samples, sr
+
+    params = PROFILES[profile]
+    hop_length = params["hop_length"]
+    beat_hop_length = params["beat_hop_length"]
+
+    A['duration'] = float(n_samples) / sr
+
+    if params["samplerate"] is not None and params["samplerate"] != sr:
+        read, n_samples = _resampled_reader(read, n_samples, sr,
+                                            params["samplerate"])
+        sr = params["samplerate"]
+
+    # Pass 1: peaks of the onset and feature mel spectrograms
+    if debug: print "> mel spectrogram peaks"
+    n_beat_frames = 1 + n_samples // beat_hop_length
+    beat_block_frames = max(int(block_duration * sr) // beat_hop_length, 1)
+    onset_max = 0.0
+    mel_max = 0.0
+    tuning = _TuningEstimator(sr)
+    for f0 in xrange(0, n_beat_frames, beat_block_frames):
+        f1 = min(f0 + beat_block_frames, n_beat_frames)
+        S = _stft_frames(read, n_samples, f0, f1, beat_hop_length)
+        P = S**2
+        onset_max = max(onset_max,
+                        librosa.feature.melspectrogram(S=P, sr=sr).max())
+        if beat_hop_length == hop_length:
+            mel_max = max(mel_max, librosa.feature.melspectrogram(
+                S=P, sr=sr, n_mels=N_MELS, fmax=FMAX).max())
+            tuning.add(S)
+        del S, P
+
+    if beat_hop_length != hop_length:
+        n_frames = 1 + n_samples // hop_length
+        block_frames = max(int(block_duration * sr) // hop_length, 1)
+        for f0 in xrange(0, n_frames, block_frames):
+            f1 = min(f0 + block_frames, n_frames)
+            S = _stft_frames(read, n_samples, f0, f1, hop_length)
+            mel_max = max(mel_max, librosa.feature.melspectrogram(
+                S=S**2, sr=sr, n_mels=N_MELS, fmax=FMAX).max())
+            tuning.add(S)
+            del S
+
+    # Pass 2: onset envelope
+    if debug: print "> onset envelope"
+    onset_diffs = []
+    for f0 in xrange(0, n_beat_frames, beat_block_frames):
+        f1 = min(f0 + beat_block_frames, n_beat_frames)
+        # one extra frame before the block for the first difference
+        S = _stft_frames(read, n_samples, max(f0 - 1, 0), f1, beat_hop_length)
+        L = _log_amplitude(librosa.feature.melspectrogram(S=S**2, sr=sr),
+                           onset_max)
+        del S
+        onset_diffs.append(np.maximum(0.0, np.diff(L, axis=1)).mean(axis=0))
+        del L
+
+    # Like onset_strength, delay the envelope by the lag and by half a
+    # window, so that onsets line up with the centered frames
+    pad = 1 + N_FFT // (2 * beat_hop_length)
+    onset_env = np.concatenate([np.zeros(pad)] + onset_diffs)
+    del onset_diffs
+
+    if debug: print "> beat tracking"
+    tempo, beat_frames = beat_track(onset_env, sr, beat_hop_length)
+    del onset_env
+
+    A['tempo'] = tempo
+    A['beats'] = librosa.frames_to_time(
+        beat_frames, sr, hop_length=beat_hop_length).tolist()
+
+    if debug: print "beats count: ", len(A['beats'])
+
+    if debug: print "> beat energy"
+    A['beat_energy'] = beat_energy(
+        read_in, n_samples_in, sr_in, A['beats'],
+        block_size=max(int(block_duration * sr_in), 1))
+
+    tuning = tuning.tuning()
+
+    # Pass 3: beat-synchronous mfcc and chroma
+    if debug: print "> mfcc and chroma"
+    n_frames = 1 + n_samples // hop_length
+    block_frames = max(int(block_duration * sr) // hop_length, 1)
+    beats = (np.asarray(beat_frames) * beat_hop_length) // hop_length
+    bounds = np.unique(np.concatenate(
+        ([0], np.clip(beats, 0, n_frames), [n_frames]))).astype(int)
+    timbres = _BeatAggregator(bounds, np.mean)
+    chroma = _BeatAggregator(bounds, np.median)
+
+    # frames on either side of a block that are analyzed, but not kept
+    margin = 64
+    for f0 in xrange(0, n_frames, block_frames):
+        f1 = min(f0 + block_frames, n_frames)
+        m0 = max(f0 - margin, 0)
+        m1 = min(f1 + margin, n_frames)
+        S = _stft_frames(read, n_samples, m0, m1, hop_length)
+
+        M = librosa.feature.melspectrogram(S=S**2, sr=sr,
+                                           n_mels=N_MELS,
+                                           fmax=FMAX)
+        M = librosa.feature.mfcc(S=_log_amplitude(M / mel_max, 1.0),
+                                 n_mfcc=N_MFCC)
+        timbres.add(f0, M[:, f0 - m0:f1 - m0])
+        del M
+
+        H = librosa.decompose.hpss(S)[0]
+        del S
+        C = librosa.feature.chromagram(S=H, sr=sr, tuning=tuning)
+        chroma.add(f0, C[:, f0 - m0:f1 - m0])
+        del H, C
+
+    A['timbres'] = timbres.result().T.tolist()
+    A['chroma'] = chroma.result().T.tolist()
+
+    if debug: print "timbres count: ", len(A['timbres'])
+
+    if debug: print "> dists"
+    return _add_structure(A)
+
+
+def _log_amplitude(S, peak):
+    """``librosa.logamplitude(S)``, but with the ``top_db`` floor set by
+    the peak of the whole recording rather than the peak of ``S`` (a
+    block of it)"""
+    L = librosa.logamplitude(S, amin=AMIN, top_db=None)
+    return np.maximum(L, 10.0 * np.log10(max(AMIN, peak)) - TOP_DB)
+
+
+class _TuningEstimator(object):
+    """Estimate the tuning of a recording (in fractions of a chroma bin)
+    from blocks of its magnitude spectrogram, as
+    ``librosa.feature.estimate_tuning`` does for a whole spectrogram: the
+    most common deviation from equal temperament of the spectral peaks
+    that are louder than the median peak.
+
+    The peaks are counted by deviation and level, so the median is taken
+    over every block (to within ``TUNING_LEVEL_RESOLUTION`` dB) and the
+    estimate does not depend on how the recording is split into blocks.
+    """
+
+    def __init__(self, sr):
+        self.sr = sr
+        self.bins = np.linspace(-0.5, 0.5, int(np.ceil(1.0 / TUNING_RESOLUTION)),
+                                endpoint=False)
+        self.levels = np.arange(-200.0, 200.0, TUNING_LEVEL_RESOLUTION)
+        # peaks by level and histogram bin, with a last bin for the peaks
+        # past the last bin (which only count towards the median)
+        self.counts = np.zeros((len(self.levels) + 1, len(self.bins)),
+                               dtype=np.int64)
+
+    def add(self, S):
+        """Count the spectral peaks of some frames of the spectrogram"""
+        pitch, mag = librosa.feature.piptrack(S=S, sr=self.sr)
+        found = pitch > 0
+        residual = np.mod(12 * librosa.hz_to_octs(pitch[found]), 1.0)
+        residual[residual >= 0.5] -= 1.0
+        level = np.searchsorted(
+            self.levels, 20.0 * np.log10(np.maximum(mag[found], AMIN)))
+
+        # the bins of np.histogram(residual, self.bins)
+        bin_i = np.minimum(
+            np.searchsorted(self.bins, residual, side='right') - 1,
+            len(self.bins) - 2)
+        bin_i[residual > self.bins[-1]] = len(self.bins) - 1
+        self.counts += np.bincount(
+            level * self.counts.shape[1] + bin_i,
+            minlength=self.counts.size).reshape(self.counts.shape)
+
+    def tuning(self):
+        """Get the tuning estimate of the frames added so far"""
+        per_level = self.counts.sum(axis=1)
+        if per_level.sum() == 0:
+            return 0.0
+        median_level = np.searchsorted(np.cumsum(per_level),
+                                       per_level.sum() / 2.0)
+        counts = self.counts[median_level + 1:, :-1].sum(axis=0)
+        if counts.sum() == 0:
+            return 0.0
+        return float(self.bins[np.argmax(counts)])
+
+
+def beat_energy(read, n_samples, sr, beats, block_size=2**20):
+    """RMS energy of each beat, after a Hamming window over the beat
+
+    The recording is read ``block_size`` samples at a time. The last
+    beat (which has no end) gets the energy of the one before it.
+
+    :param read: Function ``read(start, end)`` that returns samples
+        ``start`` to ``end`` (exclusive) of the mono recording
+    :param integer n_samples: Length of the recording (in samples)
+    :param integer sr: Sample rate of the recording
+    :param beats: Beat times (in seconds)
+    :returns: Energy of each beat
+    :rtype: list of float
+    """
+    n_beats = len(beats)
+    if n_beats < 2:
+        return [0.0] * n_beats
+
+    bounds = np.clip((np.asarray(beats) * sr).astype(int), 0, n_samples)
+    bounds = np.maximum.accumulate(bounds)
+    starts = bounds[:-1]
+    lengths = np.diff(bounds)
+
+    sums = np.zeros(n_beats - 1)
+    for start in xrange(bounds[0], bounds[-1], block_size):
+        end = min(start + block_size, bounds[-1])
+        pos = np.arange(start, end)
+        idx = np.searchsorted(starts, pos, side='right') - 1
+        length = lengths[idx]
+        # np.hamming(length), evaluated at each sample's place in its beat
+        window = 0.54 - 0.46 * np.cos(
+            2.0 * np.pi * (pos - starts[idx]) / np.maximum(length - 1, 1))
+        window[length == 1] = 1.0
+        y = np.asarray(read(start, end), dtype=np.float64) * window
+        sums += np.bincount(idx, weights=y * y, minlength=n_beats - 1)
+
+    energies = np.zeros(n_beats)
+    energies[:-1] = np.sqrt(sums / np.maximum(lengths, 1))
+    energies[-1] = energies[-2]
+    return energies.tolist()
+
+
+def _stft_frames(read, n_samples, start_frame, end_frame, hop_length,
+                 n_fft=N_FFT):
+    """Magnitude stft frames ``start_frame`` to ``end_frame`` (exclusive),
+    equal to the same frames of the centered stft of the whole
+    recording"""
+    half = n_fft // 2
+    start = start_frame * hop_length - half
+    end = (end_frame - 1) * hop_length + half
+    y = read(max(start, 0), min(end, n_samples))
+    pad_left = max(-start, 0)
+    pad_right = max(end - n_samples, 0)
+    if pad_left > 0 or pad_right > 0:
+        # librosa.stft reflects the recording at its ends
+        y = np.pad(y, (pad_left, pad_right), mode='reflect')
+    return np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length,
+                               center=False))
+
+
+def _resampled_reader(read, n_samples, sr, target_sr, margin=1.0):
+    """Wrap a reader so that it returns samples at ``target_sr``. Each
+    range is resampled with ``margin`` seconds of context on either side
+    to avoid edge effects.
+
+    :returns: Resampled reader and resampled length
+    """
+    ratio = float(sr) / target_sr
+    margin = int(margin * sr)
+    n_resampled = int(np.ceil(n_samples / ratio))
+
+    def read_resampled(start, end):
+        src_start = int(start * ratio)
+        src_end = min(int(np.ceil(end * ratio)), n_samples)
+        lo = max(src_start - margin, 0)
+        hi = min(src_end + margin, n_samples)
+        y = librosa.resample(read(lo, hi), sr, target_sr)
+        offset = int(round((src_start - lo) / ratio))
+        y = y[offset:offset + end - start]
+        if len(y) < end - start:
+            y = np.pad(y, (0, end - start - len(y)), mode='constant')
+        return y
+
+    return read_resampled, n_resampled
+
+
+class _BeatAggregator(object):
+    """Aggregates feature frames, given a block at a time, over the
+    intervals between beats (like ``librosa.feature.sync``). Only the
+    frames of the beat in progress are buffered."""
+
+    def __init__(self, bounds, aggregate):
+        self.bounds = bounds
+        self.aggregate = aggregate
+        self.interval = 0
+        self.pending = []
+        self.results = []
+
+    def add(self, start, data):
+        end = start + data.shape[1]
+        while self.interval < len(self.bounds) - 1:
+            lo = max(self.bounds[self.interval], start)
+            hi = min(self.bounds[self.interval + 1], end)
+            if hi > lo:
+                self.pending.append(data[:, lo - start:hi - start])
+            if self.bounds[self.interval + 1] > end:
+                break
+            self.results.append(self.aggregate(
+                np.hstack(self.pending), axis=1))
+            self.pending = []
+            self.interval += 1
+
+    def result(self):
+        return np.array(self.results).T
+
+
+def beat_track(onset_env, sr, hop_length):
+    """Track beats from a precomputed onset envelope (the keyword for it
+    differs between librosa versions)"""
+    try:
+        return librosa.beat.beat_track(onset_envelope=onset_env, sr=sr,
+                                       hop_length=hop_length)
+    except TypeError:
+        return librosa.beat.beat_track(onsets=onset_env, sr=sr,
+                                       hop_length=hop_length)
+
+
 if __name__ == '__main__':
     import sys
     from radiotool.composer import Song
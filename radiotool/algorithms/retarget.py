@@ -9,7 +9,10 @@ import scipy.linalg
 
 from ..composer import Composition, Segment, Volume, Label, RawVolume, Track
 from novelty import novelty
+import librosa_analysis
 from . import build_table_full_backtrace
+from . import build_table_sparse
+from .build_table_sparse import beam_search, choose_strategy, table_bytes
 from . import constraints as rt_constraints
 
 Spring = namedtuple('Spring', ['time', 'duration'])
@@ -172,7 +175,8 @@ def retarget(songs, duration, music_labels=None, out_labels=None,
              springs=None, constraints=None,
              min_beats=None, max_beats=None,
              fade_in_len=3.0, fade_out_len=5.0,
-             **kwargs):
+             n_neighbors=None, n_threads=None, memory_budget=None,
+             beam_width=None, beam_margin=None, **kwargs):
     """Retarget a song to a duration given input and output labels on
     the music.
 
@@ -220,6 +224,47 @@ def retarget(songs, duration, music_labels=None, out_labels=None,
         returns the penalty for not matching the correct output label
         at that time (default is 1.0)
     :type out_penalty: function
+    :param min_beats: Minimum number of beats of music between pauses
+        (``'default'`` is 20 seconds' worth). Tightened by any
+        :py:class:`radiotool.algorithms.constraints.MusicDurationConstraint`.
+    :type min_beats: int
+    :param max_beats: Maximum number of beats of music between pauses
+        (``'default'`` is 90 seconds' worth). Tightened by any
+        :py:class:`radiotool.algorithms.constraints.MusicDurationConstraint`.
+    :type max_beats: int
+    :param n_neighbors: Only consider the ``n_neighbors`` cheapest
+        transitions from each beat (see
+        :py:mod:`radiotool.algorithms.build_table_sparse`). Much faster
+        for long songs and many songs, but the path may not be optimal.
+        ``None`` considers every transition.
+    :type n_neighbors: int
+    :param n_threads: Number of threads to run the optimization on
+        (``None`` runs it on one thread). The result is the same for any
+        number of threads. Only the exact optimization over every
+        transition is multithreaded: ``n_threads`` is ignored (with a
+        warning) when ``n_neighbors``, ``beam_width`` or ``beam_margin``
+        is given.
+    :type n_threads: int
+    :param memory_budget: Maximum memory (in bytes) for the
+        optimization's tables. If the full table doesn't fit, the path is
+        found with a checkpointed or divide-and-conquer backtrace, which
+        find the same path in less memory but more time (see
+        :py:func:`radiotool.algorithms.build_table_sparse.build_table`).
+        ``None`` always keeps the full table.
+    :type memory_budget: int
+    :param beam_width: Find a path quickly with a beam search that only
+        keeps the ``beam_width`` cheapest partial paths at each output
+        beat (see
+        :py:func:`radiotool.algorithms.build_table_sparse.beam_search`).
+        Good for previews; the path may not be optimal. Faster than the
+        exact optimization when ``beam_width`` is much smaller than the
+        number of beats (times ``max_beats``, if given), e.g., a width of
+        10 to 100 for several songs.
+    :type beam_width: int
+    :param beam_margin: Beam search, dropping partial paths that cost
+        more than ``beam_margin`` above the cheapest one. Can be combined
+        with ``beam_width``.
+    :type beam_margin: float
     :returns: Composition of retargeted song, and dictionary of
         information about the retargeting
     :rtype: (:py:class:`radiotool.composer.Composition`, dict)
@@ -304,7 +349,6 @@ def retarget(songs, duration, music_labels=None, out_labels=None,
             rt_constraints.NoveltyVAConstraint(in_va, target_va, pen),
         ) for in_va in in_vas]
     else:
-        max_pause_beats = 0
         if len(constraints) > 0:
             if isinstance(constraints[0], rt_constraints.Constraint):
                 constraints = [constraints]
@@ -322,6 +366,9 @@ def retarget(songs, duration, music_labels=None, out_labels=None,
         penalties.append(penalty)
         all_beat_names.append(bn)
 
+    # pause beats added by the constraints (e.g. a PauseConstraint)
+    max_pause_beats = trans_costs[0].shape[0] - len(beats[0])
+
     logging.info("Combining tables")
     total_music_beats = int(np.sum([len(b) for b in beats]))
     total_beats = total_music_beats + max_pause_beats
@@ -375,6 +422,17 @@ def retarget(songs, duration, music_labels=None, out_labels=None,
         max_beats = int(90. / beat_length)
         max_beats = min(max_beats, penalty.shape[1])
 
+    # music duration constraints only record their limits (the kernels
+    # expand the tables); keep the tightest ones
+    for c_set in constraints:
+        for constraint in c_set:
+            if isinstance(constraint, rt_constraints.MusicDurationConstraint):
+                min_beats = max(min_beats, constraint.min_beats)
+                if max_beats == -1:
+                    max_beats = constraint.max_beats
+                else:
+                    max_beats = min(max_beats, constraint.max_beats)
+
     tc2 = np.nan_to_num(trans_cost)
     pen2 = np.nan_to_num(penalty)
 
@@ -397,13 +455,51 @@ def retarget(songs, duration, music_labels=None, out_labels=None,
     song_ends = np.array(song_starts[1:], dtype=np.int32)
     song_starts = np.array(song_starts[:-1], dtype=np.int32)
 
+    n_segments = max_beats if max_beats != -1 else min_beats + 1
+    n_nodes = first_pause * n_segments + (total_beats - first_pause)
+    strategy = choose_strategy(n_nodes, penalty.shape[1], memory_budget)
+    logging.info("\twith a {} backtrace (tables of {:.1f} MB, "
+                 "full table {:.1f} MB, budget {})".format(
+                     strategy,
+                     table_bytes(n_nodes, penalty.shape[1], strategy) / 1e6,
+                     table_bytes(n_nodes, penalty.shape[1]) / 1e6,
+                     memory_budget))
+
+    if n_threads not in (None, 1) and (
+            n_neighbors is not None or
+            beam_width is not None or beam_margin is not None):
+        # only the exact solver over every transition is multithreaded
+        logging.warning("n_threads ({}) is ignored with n_neighbors or a "
+                        "beam search, which run on one thread"
+                        .format(n_threads))
+
     t1 = time.clock()
-    path_i, path_cost = build_table_full_backtrace(
-        tc2, pen2, song_starts, song_ends,
-        first_pause=first_pause, max_beats=max_beats, min_beats=min_beats)
+    if beam_width is not None or beam_margin is not None:
+        strategy = "beam search"
+        logging.info("\twith a beam search (width {}, margin {})"
+                     .format(beam_width, beam_margin))
+        path_i, path_cost = beam_search(
+            tc2, pen2, song_starts, song_ends,
+            first_pause=first_pause, max_beats=max_beats,
+            min_beats=min_beats, beam_width=beam_width,
+            margin=beam_margin, n_neighbors=n_neighbors)
+    elif n_neighbors is None:
+        path_i, path_cost = build_table_full_backtrace(
+            tc2, pen2, song_starts, song_ends,
+            first_pause=first_pause, max_beats=max_beats,
+            min_beats=min_beats, n_threads=n_threads or 1,
+            strategy=strategy)
+    else:
+        logging.info("\twith the {} cheapest transitions from each beat"
+                     .format(n_neighbors))
+        path_i, path_cost = build_table_sparse(
+            tc2, pen2, song_starts, song_ends,
+            first_pause=first_pause, max_beats=max_beats,
+            min_beats=min_beats, n_neighbors=n_neighbors,
+            strategy=strategy)
     t2 = time.clock()
-    logging.info("Built table (full backtrace) in {} seconds"
-                 .format(t2 - t1))
+    logging.info("Found path ({}) in {} seconds"
+                 .format(strategy, t2 - t1))
 
     path = []
     if max_beats == -1:
@@ -534,7 +630,7 @@ def _build_table_from_costs(trans_cost, penalty):
 
 def _build_table(analysis, duration, start, target, out_penalty):
     beats = analysis["beats"]
-    trans_cost = np.copy(analysis["dense_dist"])
+    trans_cost = librosa_analysis.dense_dist(analysis).astype(np.float64)
 
     # shift it over
     trans_cost[:-1, :] = trans_cost[1:, :]
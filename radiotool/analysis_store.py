@@ -0,0 +1,370 @@
+"""On-disk store for song analyses (see
+:py:mod:`radiotool.algorithms.librosa_analysis`).
+
+Each analysis is stored in its own directory, named by the checksum of
+the audio and a hash of the analysis parameters, so changing the
+analysis never returns stale features. Every array feature is a
+separate ``.npy`` file that is memory-mapped only when it is first
+looked up, and scalar features are kept together in a small json file.
+The store can be capped at a number of bytes, in which case the least
+recently used analyses are evicted. The decoded audio that tracks
+memory-map (see :py:class:`radiotool.composer.Track`) is cached in the
+store's ``frames`` directory, and counts towards the cap too.
+
+Audio files are identified by :py:func:`file_checksum`, which by
+default hashes the file size and a sample of its blocks instead of the
+whole file. :py:class:`ChecksumIndex` remembers checksums by path, size
+and modification time so that they are computed only once. Each audio
+file's checksums are kept in a separate small file, so parallel workers
+can share the index.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as N
+try:
+    import xxhash
+    XXHASH = True
+except ImportError:
+    XXHASH = False
+
+META_FILENAME = "meta.json"
+INDEX_DIRNAME = "checksums"
+FRAMES_DIRNAME = "frames"
+
+
+def file_checksum(filename, full=False, block_size=65536, n_blocks=16):
+    """Checksum an audio file
+
+    By default only the file size and ``n_blocks`` blocks spread evenly
+    through the file (including the first and last) are hashed, with
+    xxhash if it is installed. That is enough to tell audio files apart
+    and doesn't read the whole file.
+
+    :param str. filename: Path to file
+    :param bool. full: Hash the entire file with sha256 instead
+    :param integer block_size: Size of each sampled block (in bytes)
+    :param integer n_blocks: Number of blocks to sample
+    :returns: Hex digest of the file
+    :rtype: str
+    """
+    if full:
+        hasher = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            buf = f.read(block_size)
+            while len(buf) > 0:
+                hasher.update(buf)
+                buf = f.read(block_size)
+        return hasher.hexdigest()
+
+    if XXHASH:
+        hasher = xxhash.xxh64()
+    else:
+        hasher = hashlib.sha1()
+
+    size = os.path.getsize(filename)
+    hasher.update(str(size))
+    with open(filename, 'rb') as f:
+        if size <= block_size * n_blocks:
+            hasher.update(f.read())
+        else:
+            step = (size - block_size) // (n_blocks - 1)
+            for i in xrange(n_blocks):
+                f.seek(i * step)
+                hasher.update(f.read(block_size))
+    return hasher.hexdigest()
+
+
+class ChecksumIndex(object):
+    """Sidecar index of file checksums in a cache directory. A stored
+    checksum is reused as long as the file's size and modification time
+    have not changed.
+
+    Each file's checksums are kept in their own small json file, which
+    is replaced atomically, so processes that checksum different files
+    at the same time never overwrite each other's entries."""
+
+    def __init__(self, cache_dir):
+        self.index_dir = os.path.join(cache_dir, INDEX_DIRNAME)
+        if not os.path.isdir(self.index_dir):
+            try:
+                os.makedirs(self.index_dir)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(self.index_dir):
+                    raise
+
+    def _entry_path(self, path):
+        return os.path.join(self.index_dir,
+                            hashlib.sha1(path).hexdigest() + ".json")
+
+    def _load(self, path):
+        try:
+            with open(self._entry_path(path)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get("path") != path:
+            return None
+        return entry
+
+    def _save(self, path, entry):
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.index_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, self._entry_path(path))
+
+    def checksum(self, filename, full=False):
+        """Get the checksum of a file (see :py:func:`file_checksum`),
+        computing it only if the index has no up to date checksum"""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        kind = "sha256" if full else "fast"
+
+        entry = self._load(path)
+        if (entry is not None and entry["size"] == stat.st_size and
+                entry["mtime"] == stat.st_mtime and kind in entry):
+            return entry[kind]
+
+        checksum = file_checksum(path, full=full)
+
+        # re-read the entry in case another process added the other kind
+        # of checksum to it
+        entry = self._load(path)
+        if (entry is None or entry["size"] != stat.st_size or
+                entry["mtime"] != stat.st_mtime):
+            entry = {"path": path, "size": stat.st_size,
+                     "mtime": stat.st_mtime}
+        entry[kind] = checksum
+        self._save(path, entry)
+
+        return checksum
+
+
+def params_hash(params):
+    """Hash a dict of analysis parameters
+
+    :param dict params: Analysis parameters (json serializable)
+    :returns: Short hex digest that identifies the parameters
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()[:16]
+
+
+class AnalysisStore(object):
+    """Directory of song analyses, keyed by audio checksum and analysis
+    parameter hash"""
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """Open (or create) an analysis store
+
+        :param str. cache_dir: Directory to store analyses in
+        :param integer max_bytes: Maximum total size of the store (in
+            bytes). ``None`` means no limit.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_dir(self, checksum, param_hash):
+        return os.path.join(self.cache_dir,
+                            "{}-{}".format(checksum, param_hash))
+
+    def contains(self, checksum, param_hash):
+        """Check whether the store has an analysis"""
+        return os.path.isfile(os.path.join(
+            self._entry_dir(checksum, param_hash), META_FILENAME))
+
+    def load(self, checksum, param_hash, recompute=None):
+        """Get an analysis from the store
+
+        :param recompute: Function that computes the analysis again, if
+            a feature can't be loaded because the analysis has been
+            evicted since (see :py:class:`StoredAnalysis`)
+        :returns: Analysis whose features are loaded when they are
+            first looked up, or ``None`` if the store does not have it
+        :rtype: :py:class:`StoredAnalysis`
+        """
+        entry_dir = self._entry_dir(checksum, param_hash)
+        try:
+            with open(os.path.join(entry_dir, META_FILENAME)) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(entry_dir, None)
+        except OSError:
+            pass
+
+        return StoredAnalysis(entry_dir, meta, recompute=recompute)
+
+    def save(self, checksum, param_hash, analysis):
+        """Add an analysis to the store, evicting the least recently
+        used analyses if the store gets too big
+
+        1d lists (like ``beats``) are returned as lists again when the
+        analysis is loaded. Other lists and arrays are returned as
+        (read-only) numpy arrays, and everything else is stored as a
+        json scalar.
+
+        If the store already has the analysis (e.g., another process
+        saved the same song), it is kept as it is, since other processes
+        may be reading it.
+
+        :param dict analysis: Analysis of a song
+        """
+        entry_dir = self._entry_dir(checksum, param_hash)
+        if self.contains(checksum, param_hash):
+            return
+
+        # write to a temporary directory, then move it into place so
+        # that other processes never see a partial analysis
+        tmp_dir = "{}.{}.tmp".format(entry_dir, os.getpid())
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        meta = {"scalars": {}, "arrays": [], "lists": []}
+        for key, value in analysis.iteritems():
+            if isinstance(value, (list, tuple, N.ndarray)):
+                arr = N.asarray(value)
+                N.save(os.path.join(tmp_dir, key + ".npy"), arr)
+                if isinstance(value, (list, tuple)) and arr.ndim == 1:
+                    meta["lists"].append(key)
+                else:
+                    meta["arrays"].append(key)
+            else:
+                meta["scalars"][key] = N.asarray(value).item()
+
+        with open(os.path.join(tmp_dir, META_FILENAME), 'w') as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process saved it first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not self.contains(checksum, param_hash):
+                raise
+            return
+
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes, keep=entry_dir)
+
+    def entries(self):
+        """Get the analyses and frames cache files in the store
+
+        :returns: List of (last used time, size in bytes, path), least
+            recently used first
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp") or not os.path.isfile(
+                    os.path.join(entry_dir, META_FILENAME)):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, fn))
+                       for fn in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+        frames_dir = os.path.join(self.cache_dir, FRAMES_DIRNAME)
+        if os.path.isdir(frames_dir):
+            for name in os.listdir(frames_dir):
+                if not name.endswith(".frames.npy"):
+                    continue
+                path = os.path.join(frames_dir, name)
+                entries.append((os.path.getmtime(path),
+                                os.path.getsize(path), path))
+        return sorted(entries)
+
+    def evict(self, max_bytes, keep=None):
+        """Remove least recently used analyses (and frames cache files)
+        until the store is at most ``max_bytes`` bytes
+
+        :param integer max_bytes: Size to shrink the store to
+        :param str. keep: Path of an analysis (or frames cache file)
+            never to remove
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+class StoredAnalysis(object):
+    """Read-only, dict-like view of an analysis in an
+    :py:class:`AnalysisStore`. Features are loaded (memory-mapped) the
+    first time they are looked up.
+
+    If the analysis is evicted before a feature is loaded, the analysis
+    is computed again with ``recompute`` (if given), and the rest of its
+    features are looked up in the recomputed analysis."""
+
+    def __init__(self, entry_dir, meta, recompute=None):
+        self.entry_dir = entry_dir
+        self._scalars = meta["scalars"]
+        self._arrays = set(meta["arrays"])
+        self._lists = set(meta["lists"])
+        self._loaded = {}
+        self._recompute = recompute
+        self._recomputed = None
+
+    def __getitem__(self, key):
+        if key in self._scalars:
+            return self._scalars[key]
+        if key in self._loaded:
+            return self._loaded[key]
+        if key not in self._arrays and key not in self._lists:
+            raise KeyError(key)
+        if self._recomputed is not None:
+            return self._recomputed[key]
+
+        try:
+            value = N.load(os.path.join(self.entry_dir, key + ".npy"),
+                           mmap_mode='r')
+        except (IOError, OSError):
+            # evicted since the analysis was loaded
+            if self._recompute is None:
+                raise
+            self._recomputed = self._recompute()
+            return self._recomputed[key]
+        if key in self._lists:
+            value = value.tolist()
+        self._loaded[key] = value
+        return value
+
+    def __contains__(self, key):
+        return (key in self._scalars or key in self._arrays or
+                key in self._lists)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return (self._scalars.keys() + list(self._arrays) +
+                list(self._lists))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
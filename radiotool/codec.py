@@ -0,0 +1,209 @@
+"""Decode and encode mp3 audio in memory, without temporary .wav files.
+
+Decoding uses audioread and encoding uses lameenc when they are
+installed (see :py:class:`Mp3Writer` for the lame quality options
+lameenc supports). Otherwise both stream PCM through a pipe to and
+from the ``lame`` command line encoder.
+"""
+import struct
+import subprocess
+
+import numpy as N
+
+try:
+    import audioread
+    AUDIOREAD = True
+except ImportError:
+    AUDIOREAD = False
+
+try:
+    import lameenc
+    LAMEENC = True
+except ImportError:
+    LAMEENC = False
+
+# lame's default variable bit rate mode (vbr_mtrh), used by ``lame -V``
+LAME_VBR_DEFAULT = 4
+
+
+def decode(filename):
+    """Decode a compressed audio file to PCM
+
+    :param str. filename: Path to audio file (e.g., mp3)
+    :returns: Frames (1d for mono, ``(n, channels)`` otherwise) and
+        sample rate
+    :rtype: (float32 numpy array, integer)
+    :raises IOError: if the file could not be decoded
+    """
+    if AUDIOREAD:
+        try:
+            return _decode_audioread(filename)
+        except (audioread.DecodeError, EnvironmentError):
+            pass
+    return _decode_lame(filename)
+
+
+def _decode_audioread(filename):
+    with audioread.audio_open(filename) as f:
+        samplerate = f.samplerate
+        channels = f.channels
+        data = b''.join(buf for buf in f)
+    return pcm16_to_frames(data, channels), samplerate
+
+
+def _decode_lame(filename):
+    try:
+        proc = subprocess.Popen(["lame", "--quiet", "--decode", filename, "-"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError as e:
+        raise IOError("Could not decode {}: {}".format(filename, e))
+    data, err = proc.communicate()
+    if proc.returncode != 0:
+        raise IOError("Could not decode {}: {}".format(filename, err.strip()))
+    return parse_wav_stream(data)
+
+
+def parse_wav_stream(data):
+    """Parse 16-bit PCM .wav data written to a pipe, where the chunk
+    sizes in the header can't be trusted
+
+    :param str. data: Contents of the .wav stream
+    :returns: Frames (1d for mono, ``(n, channels)`` otherwise) and
+        sample rate
+    :rtype: (float32 numpy array, integer)
+    :raises IOError: if the data is not a 16-bit PCM .wav stream
+    """
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise IOError("Not a .wav stream")
+
+    pos = 12
+    channels = None
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        chunk_size = struct.unpack('<I', data[pos + 4:pos + 8])[0]
+        pos += 8
+        if chunk_id == b'fmt ':
+            audio_format, channels, samplerate, _, _, bits = struct.unpack(
+                '<HHIIHH', data[pos:pos + 16])
+            if audio_format != 1 or bits != 16:
+                raise IOError("Only 16-bit PCM .wav streams are supported")
+        elif chunk_id == b'data':
+            if channels is None:
+                raise IOError("No format chunk before the data chunk")
+            # the data runs to the end of the stream
+            return pcm16_to_frames(data[pos:], channels), samplerate
+        pos += chunk_size + (chunk_size % 2)
+
+    raise IOError("No data chunk in .wav stream")
+
+
+def pcm16_to_frames(data, channels):
+    """Convert interleaved little-endian 16-bit PCM to float32 frames"""
+    n_samples = len(data) // 2
+    n_samples -= n_samples % channels
+    frames = N.frombuffer(data, dtype='<i2', count=n_samples).astype(
+        N.float32) / 32768.0
+    if channels == 1:
+        return frames
+    return frames.reshape(-1, channels)
+
+
+def frames_to_pcm16(frames):
+    """Convert float frames to interleaved little-endian 16-bit PCM"""
+    pcm = N.clip(N.asarray(frames), -1.0, 1.0) * 32767.0
+    return pcm.astype('<i2').tostring()
+
+
+class Mp3Writer(object):
+    """Encode frames to an mp3 file as they are written. Has the same
+    ``write_frames``/``close`` interface as
+    :py:class:`scikits.audiolab.Sndfile`.
+    """
+
+    def __init__(self, filename, channels, samplerate, lame_quality="V 2"):
+        """Open an mp3 file for writing
+
+        :param str. filename: Path of the mp3 file
+        :param integer channels: Channels in the audio (1 or 2)
+        :param integer samplerate: Sample rate of the audio
+        :param str. lame_quality: lame quality option (e.g., ``"V 2"``
+            for variable bit rate quality 2, or ``"b 192"`` for a
+            constant 192 kbps). lameenc encodes ``"V n"`` with lame's
+            default variable bit rate mode at quality n, as ``lame -V n``
+            does, and ``"b n"`` at a constant n kbps. Other options, and
+            ``"V n"`` with a lameenc without variable bit rate support,
+            are passed to the ``lame`` command line encoder instead.
+        """
+        self.filename = filename
+        self.channels = channels
+        self.samplerate = samplerate
+
+        settings = _lameenc_settings(lame_quality) if LAMEENC else None
+        if settings is not None:
+            self._encoder = lameenc.Encoder()
+            self._encoder.set_in_sample_rate(samplerate)
+            self._encoder.set_channels(channels)
+            option, value = settings
+            if option == "V":
+                self._encoder.set_vbr(LAME_VBR_DEFAULT)
+                self._encoder.set_vbr_quality(value)
+            else:
+                self._encoder.set_bit_rate(value)
+            self._encoder.set_quality(2)
+            self._file = open(filename, 'wb')
+            self._proc = None
+        else:
+            mode = 'm' if channels == 1 else 'j'
+            args = ["lame", "--quiet", "-r", "-s",
+                    "{:g}".format(samplerate / 1000.0),
+                    "--bitwidth", "16", "--signed", "--little-endian",
+                    "-m", mode]
+            args.extend(_lame_quality_args(lame_quality))
+            args.extend(["-", filename])
+            try:
+                self._proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+            except OSError as e:
+                raise IOError("Could not encode {}: {}".format(filename, e))
+            self._encoder = None
+            self._file = None
+
+    def write_frames(self, frames):
+        """Encode and write frames (shape ``(n, channels)``, or 1d for
+        mono) to the mp3 file"""
+        pcm = frames_to_pcm16(frames)
+        if self._encoder is not None:
+            self._file.write(self._encoder.encode(pcm))
+        else:
+            self._proc.stdin.write(pcm)
+
+    def close(self):
+        """Finish encoding and close the mp3 file"""
+        if self._encoder is not None:
+            self._file.write(self._encoder.flush())
+            self._file.close()
+        else:
+            self._proc.stdin.close()
+            if self._proc.wait() != 0:
+                raise IOError("Could not encode {}".format(self.filename))
+
+
+def _lame_quality_args(lame_quality):
+    """Command line arguments for a lame quality option like ``"V 2"``"""
+    option = lame_quality.split()
+    option[0] = "-" + option[0]
+    return option
+
+
+def _lameenc_settings(lame_quality):
+    """lameenc equivalent of a lame quality option: ``("V", quality)``
+    for variable bit rate, ``("b", kbps)`` for constant bit rate, or
+    ``None`` if lameenc can't encode with it"""
+    option = lame_quality.split()
+    if len(option) != 2:
+        return None
+    if option[0] == "V" and hasattr(lameenc.Encoder, "set_vbr_quality"):
+        return "V", int(option[1])
+    if option[0] == "b":
+        return "b", int(option[1])
+    return None
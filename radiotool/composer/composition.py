@@ -1,5 +1,6 @@
 import sys
 from math import sqrt
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -14,7 +15,9 @@ from rawtrack import RawTrack
 from fade import Fade
 from segment import Segment
 from volume import Volume
-from ..utils import equal_power, RMS_energy, segment_array, wav_to_mp3
+from intervalindex import IntervalIndex
+from ..utils import equal_power, RMS_energy, segment_array
+from ..codec import Mp3Writer
 import radiotool.utils
 
 
@@ -25,7 +28,7 @@ class Composition(object):
     """
 
     def __init__(self, tracks=None, channels=2, segments=None, dynamics=None,
-                 labels=None):
+                 labels=None, dtype=np.float32):
         """Initialize a composition with optional starting tracks/segments.
 
         :param tracks: Initial tracks in the composition
@@ -36,6 +39,8 @@ class Composition(object):
         :type segments: list of :py:class:`radiotool.composer.Segment`
         :param dynamics: Initial dynamics in the composition
         :type dynamics: list of :py:class:`radiotool.composer.Dynamic`
+        :param dtype: Sample type of the built composition
+        :type dtype: numpy dtype
         :returns: A new composition
         :rtype: Composition
 
@@ -61,6 +66,55 @@ class Composition(object):
             self.labels = list(labels)
 
         self.channels = channels
+        self.dtype = np.dtype(dtype)
+
+        self._build_indexes()
+
+    def _build_indexes(self):
+        self._segment_index = IntervalIndex(self.segments, in_seconds=True)
+        self._dynamic_index = IntervalIndex(self.dynamics, in_seconds=True)
+        self._track_segments = {}
+        for seg in self.segments:
+            self._track_segments.setdefault(seg.track, IntervalIndex()).add(seg)
+        self._track_dynamics = {}
+        for dyn in self.dynamics:
+            self._track_dynamics.setdefault(dyn.track, IntervalIndex()).add(dyn)
+        self._n_indexed = (len(self.segments), len(self.dynamics))
+
+    def _sync_indexes(self):
+        # catch segments and dynamics added to the lists directly
+        if self._n_indexed != (len(self.segments), len(self.dynamics)):
+            self._build_indexes()
+
+    def _index_segments(self, segments):
+        self._segment_index.extend(segments)
+        for seg in segments:
+            self._track_segments.setdefault(seg.track, IntervalIndex()).add(seg)
+        self._n_indexed = (self._n_indexed[0] + len(segments),
+                           self._n_indexed[1])
+
+    def _index_dynamics(self, dyns):
+        self._dynamic_index.extend(dyns)
+        for dyn in dyns:
+            self._track_dynamics.setdefault(dyn.track, IntervalIndex()).add(dyn)
+        self._n_indexed = (self._n_indexed[0],
+                           self._n_indexed[1] + len(dyns))
+
+    def _segments_for_track(self, track, start=None, end=None):
+        index = self._track_segments.get(track)
+        if index is None:
+            return []
+        if start is None:
+            return list(index)
+        return index.overlapping(start, end)
+
+    def _dynamics_for_track(self, track, start=None, end=None):
+        index = self._track_dynamics.get(track)
+        if index is None:
+            return []
+        if start is None:
+            return list(index)
+        return index.overlapping(start, end)
 
     @property
     def duration(self):
@@ -94,6 +148,7 @@ class Composition(object):
         """
         self.tracks.add(segment.track)
         self.segments.append(segment)
+        self._index_segments([segment])
 
     def add_segments(self, segments):
         """Add a list of segments to the composition
@@ -101,8 +156,10 @@ class Composition(object):
         :param segments: Segments to add to composition
         :type segments: list of :py:class:`radiotool.composer.Segment`
         """
+        segments = list(segments)
         self.tracks.update([seg.track for seg in segments])
         self.segments.extend(segments)
+        self._index_segments(segments)
 
     def add_dynamic(self, dyn):
         """Add a dynamic to the composition
@@ -111,6 +168,7 @@ class Composition(object):
         :type dyn: :py:class:`radiotool.composer.Dynamic`
         """
         self.dynamics.append(dyn)
+        self._index_dynamics([dyn])
 
     def add_dynamics(self, dyns):
         """Add a list of dynamics to the composition
@@ -118,7 +176,9 @@ class Composition(object):
         :param dyns: Dynamics to add to composition
         :type dyns: list of :py:class:`radiotool.composer.Dynamic`
         """
+        dyns = list(dyns)
         self.dynamics.extend(dyns)
+        self._index_dynamics(dyns)
 
     def add_label(self, label):
         """Add a label to the composition
@@ -279,7 +339,8 @@ class Composition(object):
             # cf_frames = equal_power(out_frames, in_frames)
 
             raw_track = RawTrack(cf_frames, name="crossfade",
-                                 samplerate=seg1.track.samplerate)
+                                 samplerate=seg1.track.samplerate,
+                                 dtype=self.dtype)
 
             rs_comp_location = (seg1.comp_location + seg1.duration) /\
                 float(seg1.track.samplerate)
@@ -321,19 +382,18 @@ class Composition(object):
         :param duration: Duration (in seconds) of span
         :returns: `True` if there are no segments in the composition that overlap the span starting at `time` and lasting for `duration` seconds. `False` otherwise.
         """
-        for seg in self.segments:
-            # starts in range
-            if seg.comp_location_in_seconds >= time and\
-                seg.comp_location_in_seconds < time + duration:
-                return False
-            # or, ends in range
-            elif seg.comp_location_in_seconds + seg.duration_in_seconds >= time and\
-                seg.comp_location_in_seconds + seg.duration_in_seconds < time + duration:
-                return False
-            # or, spans entire range
-            elif seg.comp_location_in_seconds < time and\
-                seg.comp_location_in_seconds + seg.duration_in_seconds >= time + duration:
-                return False
+        self._sync_indexes()
+        index = self._segment_index
+        end = time + duration
+        # starts in range
+        if len(index.starts_in(time, end)) > 0:
+            return False
+        # or, ends in range
+        if len(index.ends_in(time, end)) > 0:
+            return False
+        # or, spans entire range
+        if index.max_end_before(time) >= end:
+            return False
         return True
 
     def contract(self, time, duration, min_contraction=0.0):
@@ -354,36 +414,18 @@ class Composition(object):
             contract_dur = duration
             contract_start = time
         else:
-            starts = [s.comp_location_in_seconds for s in self.segments]
-            ends = [s.comp_location_in_seconds + s.duration_in_seconds
-                    for s in self.segments]
-
-            key_starts = []
-            key_ends = []
-
-            for start in starts:
-                if start >= time and start < time + duration:
-                    # does a segment cover the location right before this start?
-                    is_key_start = True
-                    for seg in self.segments:
-                        if seg.comp_location_in_seconds < start and\
-                            seg.comp_location_in_seconds + seg.duration_in_seconds >= start:
-                            is_key_start = False
-                            break
-                    if is_key_start:
-                        key_starts.append(start)
-
-            for end in ends:
-                if end >= time and end < time + duration:
-                    # does a segment cover the location right before this start?
-                    is_key_end = True
-                    for seg in self.segments:
-                        if seg.comp_location_in_seconds <= end and\
-                            seg.comp_location_in_seconds + seg.duration_in_seconds > end:
-                            is_key_end = False
-                            break
-                    if is_key_end:
-                        key_ends.append(end)
+            index = self._segment_index
+
+            # a start is a key start if no segment covers the location
+            # right before it
+            key_starts = [start for start in
+                          index.starts_in(time, time + duration)
+                          if index.max_end_before(start) < start]
+
+            # an end is a key end if no segment covers the location
+            # right after it
+            key_ends = [end for end in index.ends_in(time, time + duration)
+                        if index.max_end_through(end) <= end]
 
             if len(key_starts) + len(key_ends) == 0: return 0, 0
 
@@ -404,14 +446,12 @@ class Composition(object):
                     contract_dur = time + duration - first_key
 
         if contract_dur > min_contraction:
-            for seg in self.segments:
-                if seg.comp_location_in_seconds > contract_start:
-                    dur_samples = int(seg.samplerate * contract_dur)
-                    seg.comp_location -= dur_samples
-            for dyn in self.dynamics:
-                if dyn.comp_location_in_seconds > contract_start:
-                    dur_samples = int(seg.samplerate * contract_dur)
-                    dyn.comp_location -= dur_samples
+            for seg in self._segment_index.starting_after(contract_start):
+                dur_samples = int(seg.samplerate * contract_dur)
+                seg.comp_location -= dur_samples
+            for dyn in self._dynamic_index.starting_after(contract_start):
+                dur_samples = int(dyn.samplerate * contract_dur)
+                dyn.comp_location -= dur_samples
             return contract_start, contract_dur
         else:
             return 0.0, 0.0
@@ -477,12 +517,8 @@ class Composition(object):
     def _remove_end_silence(self, frames):
         subwindow_n_frames = int(1/16.0 * min(s.samplerate for s in self.tracks))
 
-        segments = segment_array(frames, subwindow_n_frames, overlap=.5)
-
-        volumes = np.apply_along_axis(RMS_energy, 1, segments)
+        volumes = self._subwindow_rms(frames, subwindow_n_frames)
 
-        min_subwindow_vol = min(np.sum(np.abs(segments), 1) /\
-                            subwindow_n_frames)
         min_subwindow_vol = min(volumes)
 
         # some threshold? what if there are no zeros?
@@ -512,6 +548,36 @@ class Composition(object):
             return frames[:new_cut_point]
         return frames
     
+    @staticmethod
+    def _subwindow_rms(frames, subwindow_n_frames):
+        """RMS energy of the half-overlapping subwindows of ``frames``
+        (the subwindows of
+        ``radiotool.utils.segment_array(frames, subwindow_n_frames)``),
+        from the energy of each half subwindow instead of copying out
+        every subwindow"""
+        n = subwindow_n_frames
+        half = n // 2
+        n_subwindows = int((len(frames) - n) / (n / 2.0)) + 1
+
+        # subwindow i starts at int(i * n / 2.0), so it is made of the
+        # pieces between the starts of subwindows i, i + 1 and i + 2,
+        # which are half and n - half frames long in turn
+        i = np.arange(n_subwindows + 2)
+        bounds = (i // 2) * n + (i % 2) * half
+        squares = np.square(frames[:bounds[-1]], dtype=np.float64)
+        piece_energy = np.add.reduceat(squares, bounds[:-1])
+        return np.sqrt((piece_energy[:-1] + piece_energy[1:]) / n)
+
+    @staticmethod
+    def _rms_from_energy(energy):
+        """RMS energy from a running ``[sum of squares, count]`` (``nan``
+        if nothing was counted, like :py:func:`radiotool.utils.RMS_energy`
+        of an empty array)"""
+        sum_sq, count = energy
+        if count == 0:
+            return np.nan
+        return sqrt(sum_sq / count)
+
     def duration(self):
         return max([x.comp_location + x.duration
                     for x in self.segments])
@@ -521,7 +587,7 @@ class Composition(object):
                     for x in self.segments])
 
     def build(self, track_list=None, adjust_dynamics=False,
-        min_length=None, channels=None):
+        min_length=None, channels=None, workers=None, track_callback=None):
         """
         Create a numpy array from the composition.
 
@@ -529,6 +595,8 @@ class Composition(object):
         :type track_list: list of :py:class:`radiotool.composer.Track`
         :param int min_length: Minimum length of output array (in frames). Will zero pad extra length.
         :param bool. adjust_dynamics: Automatically adjust dynamics. Will document later.
+        :param int workers: Number of threads to render tracks with (``None`` renders tracks one at a time)
+        :param track_callback: Function called as ``track_callback(track, start, part)`` with each track's part of the composition (``None`` if the track has no segments) and the frame it starts at, as soon as the part is rendered
         """
         if track_list is None:
             track_list = self.tracks
@@ -536,72 +604,63 @@ class Composition(object):
         if channels is None:
             channels = self.channels
 
-        parts = {}
-        starts = {}
-        
-        # for universal volume adjustment
-        all_frames = np.array([])
-        song_frames = np.array([])
-        speech_frames = np.array([])
-        
-        longest_part = max([x.comp_location + x.duration
-                            for x in self.segments])
-        if len(self.dynamics) > 0:
-            longest_part = max((longest_part,
-                max([x.comp_location + x.duration
-                     for x in self.dynamics])))
+        # for universal volume adjustment: running sum of squares and
+        # number of frames for all tracks, songs and speech
+        all_energy = [0.0, 0]
+        song_energy = [0.0, 0]
+        speech_energy = [0.0, 0]
+        if adjust_dynamics:
+            from song import Song
+            from speech import Speech
         
-        for track_idx, track in enumerate(track_list):
-            segments = sorted([v for v in self.segments if v.track == track], 
-                              key=lambda k: k.comp_location + k.duration)
-            dyns = sorted([d for d in self.dynamics if d.track == track],
-                           key=lambda k: k.comp_location)
-
-            if len(segments) > 0:
-                start_loc = min([x.comp_location for x in segments])
-                end_loc = max([x.comp_location + x.duration for x in segments])
-                if len(dyns) > 0:
-                    start_loc = min((start_loc, 
-                         min([d.comp_location for d in dyns])))
-                    end_loc = max((end_loc,
-                        max([d.comp_location + d.duration for d in dyns])))
-                
-                starts[track] = start_loc
-
-                parts[track] = np.zeros((end_loc - start_loc, channels))
-                
-                for s in segments:
-
-                    frames = s.get_frames(channels=channels).\
-                        reshape(-1, channels)
-                    
-                    # for universal volume adjustment
-                    if adjust_dynamics:
-                        all_frames = np.append(all_frames,
-                            self._remove_end_silence(frames.flatten()))
-                        if isinstance(track, Song):
-                            song_frames = np.append(song_frames,
-                                self._remove_end_silence(frames.flatten()))
-                        elif isinstance(track, Speech):
-                            speech_frames = np.append(speech_frames,
-                                self._remove_end_silence(frames.flatten()))
-                                
-                    parts[track][s.comp_location - start_loc:
-                                 s.comp_location - start_loc + s.duration,
-                                 :] = frames
-
-            for d in dyns:
-                vol_frames = d.to_array(channels)
-
-                parts[track][d.comp_location - start_loc :
-                             d.comp_location - start_loc + d.duration,
-                             :] *= vol_frames
-
+        longest_part = self._length(min_length)
+        out = np.zeros((longest_part, channels), dtype=self.dtype)
+
+        # look up each track's segments and dynamics up front so that
+        # the (lazily updated) indexes are never touched by two threads
+        self._sync_indexes()
+        jobs = [(track,
+                 sorted(self._segments_for_track(track),
+                        key=lambda k: k.comp_location + k.duration),
+                 sorted(self._dynamics_for_track(track),
+                        key=lambda k: k.comp_location),
+                 channels, adjust_dynamics)
+                for track in track_list]
+
+        if workers is None:
+            results = (self._build_track_part(job) for job in jobs)
+        else:
+            pool = ThreadPool(workers)
+            results = pool.imap_unordered(self._build_track_part, jobs)
+
+        try:
+            # sum each part into the output as soon as it is rendered
+            for track, start_loc, part, energy in results:
+                if track_callback is not None:
+                    track_callback(track, start_loc, part)
+                if part is None:
+                    continue
+                out[start_loc:start_loc + len(part)] += part
+
+                # for universal volume adjustment
+                if adjust_dynamics:
+                    accumulators = [all_energy]
+                    if isinstance(track, Song):
+                        accumulators.append(song_energy)
+                    elif isinstance(track, Speech):
+                        accumulators.append(speech_energy)
+                    for acc in accumulators:
+                        acc[0] += energy[0]
+                        acc[1] += energy[1]
+        finally:
+            if workers is not None:
+                pool.close()
+                pool.join()
 
         if adjust_dynamics:
-            total_energy = RMS_energy(all_frames)
-            song_energy = RMS_energy(song_frames)
-            speech_energy = RMS_energy(speech_frames)
+            total_energy = self._rms_from_energy(all_energy)
+            song_energy = self._rms_from_energy(song_energy)
+            speech_energy = self._rms_from_energy(speech_energy)
                 
         # dyn_adj = 0.10 / total_energy
         # dyn_adj = speech_energy / sqrt(song_energy) * 5
@@ -613,25 +672,242 @@ class Composition(object):
         else:
             dyn_adj = 1
 
+        return out
+
+    def _build_track_part(self, job):
+        """Render one track of the composition on its own.
+
+        :param job: Tuple of the track, its segments (sorted by end
+            location), its dynamics, the number of channels and whether
+            to collect frames for dynamics adjustment
+        :returns: Tuple of the track, the location of the part in the
+            composition, the part (``None`` if the track has no
+            segments) and the sum of squares and number of samples of
+            the part's segments without their end silence (for dynamics
+            adjustment)
+        """
+        track, segments, dyns, channels, adjust_dynamics = job
+        if len(segments) == 0:
+            return track, 0, None, None
+
+        start_loc = min([x.comp_location for x in segments])
+        end_loc = max([x.comp_location + x.duration for x in segments])
+        if len(dyns) > 0:
+            start_loc = min((start_loc,
+                 min([d.comp_location for d in dyns])))
+            end_loc = max((end_loc,
+                max([d.comp_location + d.duration for d in dyns])))
+
+        part = np.zeros((end_loc - start_loc, channels), dtype=self.dtype)
+        sum_sq = 0.0
+        count = 0
+
+        for s in segments:
+            frames = s.get_frames(channels=channels).\
+                reshape(-1, channels)
+
+            # for universal volume adjustment
+            if adjust_dynamics:
+                trimmed = self._remove_end_silence(frames.ravel())
+                sum_sq += float(np.einsum('i,i->', trimmed, trimmed,
+                                          dtype=np.float64))
+                count += len(trimmed)
+
+            part[s.comp_location - start_loc:
+                 s.comp_location - start_loc + s.duration,
+                 :] = frames
+
+        for d in dyns:
+            vol_frames = d.to_array(channels, dtype=self.dtype)
+
+            part[d.comp_location - start_loc:
+                 d.comp_location - start_loc + d.duration,
+                 :] *= vol_frames
+
+        return track, start_loc, part, (sum_sq, count)
+    
+    def build_blocks(self, block_size=65536, track_list=None,
+                     min_length=None, channels=None, workers=None,
+                     track_callback=None):
+        """
+        Generate the composition block by block instead of creating one
+        numpy array for the entire composition. Peak memory depends on
+        ``block_size`` and the number of tracks in the composition,
+        not on the length of the composition.
+
+        Segments that are processed as a whole (time-stretched segments
+        and segments with effects, see
+        :py:attr:`radiotool.composer.Segment.whole_segment`) are
+        processed once, when their first block is built, and kept until
+        their last block is built.
+
+        :param int block_size: Number of frames in each block
+        :param track_list: List of tracks to include in composition generation (``None`` means all tracks will be used)
+        :type track_list: list of :py:class:`radiotool.composer.Track`
+        :param int min_length: Minimum length of output (in frames). Will zero pad extra length.
+        :param int channels: Number of channels in each block
+        :param int workers: Number of threads to render the tracks of each block with (``None`` renders tracks one at a time)
+        :param track_callback: Function called with each track's part of each block (see :py:meth:`build_block`)
+        :returns: Generator of numpy arrays of at most ``block_size`` frames
+        """
+        longest_part = self._length(min_length)
+
+        # processed frames of the segments that are processed as a whole
+        processed = {}
+        pool = None
+        if workers is not None:
+            pool = ThreadPool(workers)
+
+        try:
+            for start in xrange(0, longest_part, block_size):
+                n_frames = min(block_size, longest_part - start)
+                yield self._build_block(start, n_frames, track_list,
+                                        channels, track_callback,
+                                        pool=pool, processed=processed)
+                for s in [s for s in processed
+                          if s.comp_location + s.duration <= start + n_frames]:
+                    del processed[s]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def build_block(self, start, n_frames, track_list=None, channels=None,
+                    workers=None, track_callback=None):
+        """
+        Create a numpy array for a span of the composition. Only the
+        segments and dynamics that overlap the span are read.
+
+        :param int start: First frame of the span (in frames)
+        :param int n_frames: Length of the span (in frames)
+        :param track_list: List of tracks to include in composition generation (``None`` means all tracks will be used)
+        :type track_list: list of :py:class:`radiotool.composer.Track`
+        :param int channels: Number of channels in output array
+        :param int workers: Number of threads to render tracks with (``None`` renders tracks one at a time)
+        :param track_callback: Function called as ``track_callback(track, start, part)`` with each track's part of the span (``None`` if the track has no segments in the span)
+        :returns: Frames of the composition in the span
+        :rtype: numpy array of shape ``(n_frames, channels)``
+        """
+        if workers is None:
+            return self._build_block(start, n_frames, track_list, channels,
+                                     track_callback)
+        pool = ThreadPool(workers)
+        try:
+            return self._build_block(start, n_frames, track_list, channels,
+                                     track_callback, pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _build_block(self, start, n_frames, track_list, channels,
+                     track_callback, pool=None, processed=None):
+        if track_list is None:
+            track_list = self.tracks
+
+        if channels is None:
+            channels = self.channels
+
+        # look up each track's segments and dynamics up front so that
+        # the (lazily updated) indexes are never touched by two threads
+        self._sync_indexes()
+        end = start + n_frames
+        jobs = [(track, start, n_frames, channels,
+                 sorted(self._segments_for_track(track, start, end),
+                        key=lambda k: k.comp_location + k.duration),
+                 self._dynamics_for_track(track, start, end),
+                 processed)
+                for track in track_list]
+
+        if pool is None:
+            results = (self._build_track_block(job) for job in jobs)
+        else:
+            results = pool.imap(self._build_track_block, jobs)
+
+        out = np.zeros((n_frames, channels), dtype=self.dtype)
+        for track, part in results:
+            if track_callback is not None:
+                track_callback(track, start, part)
+            if part is not None:
+                out += part
+        return out
+
+    def _length(self, min_length=None):
+        """Length of the built composition (in frames)"""
+        longest_part = max([x.comp_location + x.duration
+                            for x in self.segments])
+        if len(self.dynamics) > 0:
+            longest_part = max((longest_part,
+                max([x.comp_location + x.duration
+                     for x in self.dynamics])))
         if longest_part < min_length:
             longest_part = min_length
-        out = np.zeros((longest_part, channels))
-        for track, part in parts.iteritems():
-            out[starts[track]:starts[track] + len(part)] += part
+        return longest_part
+
+    def _write_silence(self, out_file, n_frames, channels,
+                       block_size=65536):
+        """Write ``n_frames`` frames of silence to ``out_file``"""
+        if n_frames <= 0:
+            return
+        silence = np.zeros((min(block_size, n_frames), channels),
+                           dtype=self.dtype)
+        for start in xrange(0, n_frames, block_size):
+            out_file.write_frames(silence[:min(block_size, n_frames - start)])
+
+    def _build_track_block(self, job):
+        """Render one track's part of a span of the composition.
+
+        :param job: Tuple of the track, the start and length of the
+            span, the number of channels, the track's segments (sorted by
+            end location) and dynamics in the span, and a dict of the
+            processed frames of segments that are processed as a whole
+            (``None`` to process them for this span only)
+        :returns: Tuple of the track and its part (``None`` if the track
+            has no segments in the span)
+        """
+        track, start, n_frames, channels, segments, dyns, processed = job
+        if len(segments) == 0:
+            return track, None
+        end = start + n_frames
+
+        part = np.zeros((n_frames, channels), dtype=self.dtype)
+
+        for s in segments:
+            lo = max(start, s.comp_location)
+            hi = min(end, s.comp_location + s.duration)
+            if processed is not None and s.whole_segment:
+                if s not in processed:
+                    processed[s] = s.get_frames(channels=channels).\
+                        reshape(-1, channels)
+                frames = processed[s][lo - s.comp_location:
+                                      hi - s.comp_location]
+            else:
+                frames = s.get_frames(channels=channels,
+                                      offset=lo - s.comp_location,
+                                      n_frames=hi - lo).reshape(-1, channels)
+            part[lo - start:lo - start + len(frames), :] = frames
+
+        for d in dyns:
+            lo = max(start, d.comp_location)
+            hi = min(end, d.comp_location + d.duration)
+            part[lo - start:hi - start, :] *= d.to_array(
+                channels, offset=lo - d.comp_location, n_frames=hi - lo,
+                dtype=self.dtype)
+
+        return track, part
 
-        return out
-    
     def export(self, **kwargs):
         """
         Generate audio file from composition.
 
         :param str. filename: Output filename (no extension)
-        :param str. filetype: Output file type (only .wav supported for now)
+        :param str. filetype: Output file type (wav, ogg or mp3; the separate tracks of an mp3 export are .wav files)
         :param integer samplerate: Sample rate of output audio
         :param integer channels: Channels in output audio, if different than originally specified
         :param bool. separate_tracks: Also generate audio file for each track in composition
         :param int min_length: Minimum length of output array (in frames). Will zero pad extra length.
-        :param bool. adjust_dynamics: Automatically adjust dynamics (will document later)
+        :param bool. adjust_dynamics: Automatically adjust dynamics (will document later). Needs the whole composition, so it can't be combined with ``block_size``.
+        :param int block_size: If given, build and write the composition in blocks of this many frames (see :py:meth:`build_blocks`) instead of building it all at once. The composition is then not returned.
+        :param int workers: Number of threads to render tracks with (see :py:meth:`build`, or :py:meth:`build_blocks` with ``block_size``)
 
         """
         # get optional args
@@ -642,6 +918,12 @@ class Composition(object):
         channels = kwargs.pop('channels', self.channels)
         separate_tracks = kwargs.pop('separate_tracks', False)
         min_length = kwargs.pop('min_length', None)
+        block_size = kwargs.pop('block_size', None)
+        workers = kwargs.pop('workers', None)
+
+        if adjust_dynamics and block_size is not None:
+            raise ValueError(
+                "adjust_dynamics can't be used with block_size")
         
         if samplerate is None:
             samplerate = np.min([track.samplerate for track in self.tracks])
@@ -654,31 +936,63 @@ class Composition(object):
             filetype = 'wav'
             to_mp3 = True
 
+        if to_mp3:
+            # encode the mp3 as it is built, without writing a .wav first
+            out_filename = "%s.mp3" % filename
+            out_file = Mp3Writer(out_filename, channels, samplerate)
+        else:
+            out_filename = "%s.%s" % (filename, filetype)
+            out_file = Sndfile(out_filename, 'w',
+                               Format(filetype, encoding=encoding), 
+                               channels, samplerate)
+
+        stem_files = {}
         if separate_tracks:
-            # build the separate parts of the composition if desired
+            # the separate parts of the composition are written from
+            # the same pass that builds the complete composition
             for track in self.tracks:
-                out = self.build(track_list=[track],
-                                 adjust_dynamics=adjust_dynamics,
-                                 min_length=min_length,
-                                 channels=channels)
-                out_file = Sndfile("%s-%s.%s" %
-                                   (filename, track.name, filetype),
-                                   'w',
-                                   Format(filetype, encoding=encoding),
-                                   channels, samplerate)
-                out_file.write_frames(out)
-                out_file.close()
-
-        # always build the complete composition
-        out = self.build(adjust_dynamics=adjust_dynamics,
-                         min_length=min_length,
-                         channels=channels)
-
-        out_filename = "%s.%s" % (filename, filetype)
-        out_file = Sndfile(out_filename, 'w',
-                           Format(filetype, encoding=encoding), 
-                           channels, samplerate)
-        out_file.write_frames(out)
+                stem_files[track] = Sndfile("%s-%s.%s" %
+                                            (filename, track.name, filetype),
+                                            'w',
+                                            Format(filetype, encoding=encoding),
+                                            channels, samplerate)
+
+        # frames written to each separate part so far
+        stem_lengths = dict((track, 0) for track in stem_files)
+
+        def write_stem(track, start, part):
+            stem_file = stem_files[track]
+            self._write_silence(stem_file, start - stem_lengths[track],
+                                channels)
+            stem_lengths[track] = start
+            if part is not None:
+                stem_file.write_frames(part)
+                stem_lengths[track] += len(part)
+
+        if not separate_tracks:
+            write_stem = None
+
+        if block_size is None:
+            out = self.build(adjust_dynamics=adjust_dynamics,
+                             min_length=min_length,
+                             channels=channels,
+                             workers=workers,
+                             track_callback=write_stem)
+            out_file.write_frames(out)
+        else:
+            out = None
+            for block in self.build_blocks(block_size=block_size,
+                                           min_length=min_length,
+                                           channels=channels,
+                                           workers=workers,
+                                           track_callback=write_stem):
+                out_file.write_frames(block)
+
+        longest_part = self._length(min_length)
+        for track, stem_file in stem_files.iteritems():
+            self._write_silence(stem_file,
+                                longest_part - stem_lengths[track], channels)
+            stem_file.close()
         out_file.close()
 
         if LIBXMP and filetype == "wav":
@@ -710,7 +1024,4 @@ class Composition(object):
                 xmpfile.put_xmp(xmp)
             xmpfile.close_file()
 
-        if to_mp3:
-            wav_to_mp3(out_filename, delete_wav=True)
-
         return out
@@ -1,6 +1,8 @@
 import numpy as np
 
-class Dynamic(object):
+from intervalindex import Span
+
+class Dynamic(Span):
     """(Abstract) volume control for tracks"""
     def __init__(self, track, comp_location, duration):
         self.track = track
@@ -8,8 +10,11 @@ class Dynamic(object):
         self.comp_location_in_seconds = comp_location
         self.duration_in_seconds = duration
         
-    def to_array(self, channels=2):
-        return np.ones( (self.duration, channels) )
+    def to_array(self, channels=2, offset=0, n_frames=None,
+                 dtype=np.float32):
+        if n_frames is None:
+            n_frames = self.duration - offset
+        return np.ones( (n_frames, channels), dtype=dtype )
         
     def __str__(self):
         return "Dynamic at %d with duration %d" % (self.comp_location,
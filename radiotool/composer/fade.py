@@ -30,21 +30,39 @@ class Fade(Dynamic):
         self.out_volume = out_volume
         self.fade_type = fade_type
         
-    def to_array(self, channels=2):
-        """Generate the array of volume multipliers for the dynamic"""
+    def to_array(self, channels=2, offset=0, n_frames=None,
+                 dtype=np.float32):
+        """Generate the array of volume multipliers for the dynamic
+
+        :param integer channels: Number of channels in output array
+        :param integer offset: First frame of the fade to generate
+        :param integer n_frames: Number of frames to generate (default is
+            the rest of the fade after ``offset``)
+        :param dtype: Type of the multipliers
+        """
+        if n_frames is None:
+            n_frames = self.duration - offset
+
+        # position of each multiplier along the entire fade (0 to 1), so
+        # that any slice of the fade matches the fade as a whole
+        n_total = self.duration * channels
+        steps = np.arange(offset * channels, (offset + n_frames) * channels)
+        if n_total > 1:
+            pos = (steps / float(n_total - 1)).astype(dtype)
+        else:
+            pos = np.zeros(len(steps), dtype=dtype)
+
         if self.fade_type == "linear":
-            return np.linspace(self.in_volume, self.out_volume,
-                self.duration * channels)\
-                .reshape(self.duration, channels)
+            return (self.in_volume + (self.out_volume - self.in_volume) * pos
+                ).reshape(n_frames, channels)
         elif self.fade_type == "exponential":
             if self.in_volume < self.out_volume:
-                return (np.logspace(8, 1, self.duration * channels,
-                    base=.5) * (
-                        self.out_volume - self.in_volume) / 0.5 + 
-                        self.in_volume).reshape(self.duration, channels)
+                return (np.power(.5, 8 - 7 * pos) * (
+                        self.out_volume - self.in_volume) / 0.5 +
+                        self.in_volume).reshape(n_frames, channels)
             else:
-                return (np.logspace(1, 8, self.duration * channels, base=.5
-                    ) * (self.in_volume - self.out_volume) / 0.5 + 
-                    self.out_volume).reshape(self.duration, channels)
+                return (np.power(.5, 1 + 7 * pos) * (
+                    self.in_volume - self.out_volume) / 0.5 +
+                    self.out_volume).reshape(n_frames, channels)
         elif self.fade_type == "cosine":
-            return
\ No newline at end of file
+            return
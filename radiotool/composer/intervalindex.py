@@ -0,0 +1,156 @@
+from bisect import bisect_left, bisect_right
+import weakref
+
+
+class Span(object):
+    """(Abstract) something that is placed in a composition at
+    ``comp_location`` for ``duration`` frames.
+
+    Moving or resizing a span marks each
+    :py:class:`radiotool.composer.intervalindex.IntervalIndex` that
+    holds it as out of date, so indexes never return stale locations.
+    """
+
+    @property
+    def comp_location(self):
+        return self._comp_location
+
+    @comp_location.setter
+    def comp_location(self, comp_location):
+        self._comp_location = comp_location
+        self._moved()
+
+    @property
+    def duration(self):
+        return self._duration
+
+    @duration.setter
+    def duration(self, duration):
+        self._duration = duration
+        self._moved()
+
+    def _watch(self, index):
+        # indexes are held weakly, so dropped indexes aren't kept alive
+        try:
+            self._indexes.add(index)
+        except AttributeError:
+            self._indexes = weakref.WeakSet([index])
+
+    def _moved(self):
+        for index in getattr(self, "_indexes", ()):
+            index._stale = True
+
+
+class IntervalIndex(object):
+    """Sorted index over spans (segments or dynamics) that answers
+    overlap queries in O(log n + k) time.
+
+    The index is rebuilt lazily: adding a span or moving one of its
+    spans invalidates it, and the next query re-sorts the spans. Moving
+    a span doesn't invalidate indexes that don't hold it.
+    """
+
+    def __init__(self, spans=None, in_seconds=False):
+        """Create an index of spans.
+
+        :param spans: Initial spans in the index
+        :type spans: list of :py:class:`radiotool.composer.Segment` or
+            :py:class:`radiotool.composer.Dynamic`
+        :param bool in_seconds: Index locations in seconds instead of
+            frames
+        """
+        if spans is None:
+            self.spans = []
+        else:
+            self.spans = list(spans)
+        for span in self.spans:
+            span._watch(self)
+        self.in_seconds = in_seconds
+        self._stale = True
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def add(self, span):
+        self.spans.append(span)
+        span._watch(self)
+        self._stale = True
+
+    def extend(self, spans):
+        spans = list(spans)
+        self.spans.extend(spans)
+        for span in spans:
+            span._watch(self)
+        self._stale = True
+
+    def _bounds(self, span):
+        if self.in_seconds:
+            start = span.comp_location_in_seconds
+            return start, start + span.duration_in_seconds
+        return span.comp_location, span.comp_location + span.duration
+
+    def _update(self):
+        if not self._stale:
+            return
+
+        bounds = [self._bounds(s) for s in self.spans]
+        order = sorted(range(len(self.spans)), key=lambda i: bounds[i][0])
+
+        self._sorted = [self.spans[i] for i in order]
+        self._starts = [bounds[i][0] for i in order]
+        self._ends = [bounds[i][1] for i in order]
+        self._sorted_ends = sorted(b[1] for b in bounds)
+
+        # _max_ends[i] is the latest end of the first i spans by start
+        self._max_ends = [float('-inf')]
+        for i in order:
+            self._max_ends.append(max(self._max_ends[-1], bounds[i][1]))
+
+        if len(bounds) > 0:
+            self._max_duration = max(b[1] - b[0] for b in bounds)
+        else:
+            self._max_duration = 0
+
+        self._stale = False
+
+    def overlapping(self, start, end):
+        """Get the spans that overlap ``[start, end)``, sorted by start
+        location"""
+        self._update()
+        lo = bisect_left(self._starts, start - self._max_duration)
+        hi = bisect_left(self._starts, end)
+        return [self._sorted[i] for i in xrange(lo, hi)
+                if self._ends[i] > start]
+
+    def starting_after(self, location):
+        """Get the spans that start after ``location``"""
+        self._update()
+        return self._sorted[bisect_right(self._starts, location):]
+
+    def starts_in(self, start, end):
+        """Get the span start locations that fall in ``[start, end)``"""
+        self._update()
+        return self._starts[bisect_left(self._starts, start):
+                            bisect_left(self._starts, end)]
+
+    def ends_in(self, start, end):
+        """Get the span end locations that fall in ``[start, end)``"""
+        self._update()
+        return self._sorted_ends[bisect_left(self._sorted_ends, start):
+                                 bisect_left(self._sorted_ends, end)]
+
+    def max_end_before(self, location):
+        """Get the latest end location of the spans that start before
+        ``location`` (``-inf`` if there are none)"""
+        self._update()
+        return self._max_ends[bisect_left(self._starts, location)]
+
+    def max_end_through(self, location):
+        """Get the latest end location of the spans that start at or
+        before ``location`` (``-inf`` if there are none)"""
+        self._update()
+        return self._max_ends[bisect_right(self._starts, location)]
+
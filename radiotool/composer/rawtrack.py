@@ -8,17 +8,21 @@ class RawTrack(Track):
     data (as a numpy array).
     """
 
-    def __init__(self, frames, name="Raw frames name", samplerate=44100):
+    def __init__(self, frames, name="Raw frames name", samplerate=44100,
+                 dtype=np.float32):
         """Create a track with raw PCM data in array ``frames``
 
         :param frames: Raw PCM data array
         :type frames: numpy array
         :param integer samplerate: Sample rate of frames
         :param string name: Name of track
+        :param dtype: Sample type to store the frames as
+        :type dtype: numpy dtype
 
         """
         self._samplerate = samplerate
-        self.frames = frames
+        self.dtype = np.dtype(dtype)
+        self.frames = np.asarray(frames, dtype=self.dtype)
         self.name = name
         self.filename = "RAW_" + name
         try:
@@ -50,35 +54,5 @@ class RawTrack(Track):
     def reset(self):
         self.current_frame = 0
     
-    def read_frames(self, n, channels=None):
-        if channels is None:
-            channels = self.channels
-
-        if channels == 1:
-            out = np.zeros(n)
-        elif channels == 2:
-            out = np.zeros((n, 2))
-        else:
-            print "Input needs to have 1 or 2 channels"
-            return
-        if n > self.remaining_frames():
-            print "Trying to retrieve too many frames!"
-            print "Asked for", n
-            n = self.remaining_frames()
-            print "Returning", n
-
-        if self.channels == 1 and channels == 1:
-            out = self.frames[self.current_frame:self.current_frame + n]
-        elif self.channels == 1 and channels == 2:
-            frames = self.frames[self.current_frame:self.current_frame + n]
-            out[:n, :] = [frames.copy(), frames.copy()]
-        elif self.channels == 2 and channels == 1:
-            frames = self.frames[
-                self.current_frame:self.current_frame + n, :]
-            out = np.mean(frames, axis=1)
-        elif self.channels == 2 and channels == 2:
-            out[:n, :] = self.frames[
-                self.current_frame:self.current_frame + n, :]
-
-        self.current_frame += n
-        return out
\ No newline at end of file
+    def _read_raw(self, start, n):
+        return self.frames[start:start + n]
@@ -22,12 +22,17 @@ class RawVolume(Dynamic):
         if self.duration != len(volume_frames):
             raise Exception("Duration must be same as volume frame length")
     
-    def to_array(self, channels=2):
+    def to_array(self, channels=2, offset=0, n_frames=None,
+                 dtype=np.float32):
         """Return the array of multipliers for the dynamic"""
+        if n_frames is None:
+            n_frames = self.duration - offset
+        volume_frames = np.asarray(
+            self.volume_frames[offset:offset + n_frames], dtype=dtype)
         if channels == 1:
-            return self.volume_frames.reshape(-1, 1)
+            return volume_frames.reshape(-1, 1)
         if channels == 2:
-            return np.tile(self.volume_frames, (2, 1)).T
+            return np.tile(volume_frames, (2, 1)).T
         raise Exception(
             "RawVolume doesn't know what to do with %s channels" % channels)
         
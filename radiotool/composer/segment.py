@@ -1,4 +1,7 @@
-class Segment(object):
+from intervalindex import Span
+
+
+class Segment(Span):
     """A slice of a :py:class:`radiotool.composer.Track`
     """
 
@@ -50,26 +53,40 @@ class Segment(object):
     def comp_location_in_seconds(self, comp_location_in_seconds):
         self.comp_location = int(comp_location_in_seconds * self.samplerate)
 
+    @property
+    def whole_segment(self):
+        """Whether :py:meth:`get_frames` has to process the entire
+        segment to get any part of it (e.g., to apply effects)"""
+        return len(self.effects) > 0
+
     def add_effect(self, effect):
         self.effects.append(effect)
 
     def add_effects(self, effects):
         self.effects.extend(effects)
 
-    def get_frames(self, channels=2):
+    def get_frames(self, channels=2, offset=0, n_frames=None):
         """Get numpy array of frames corresponding to the segment.
 
         :param integer channels: Number of channels in output array
+        :param integer offset: First frame to get, relative to the start
+            of the segment
+        :param integer n_frames: Number of frames to get (default is the
+            rest of the segment after ``offset``)
         :returns: Array of frames in the segment
         :rtype: numpy array
 
         """
-        tmp_frame = self.track.current_frame
-        self.track.current_frame = self.start
-        frames = self.track.read_frames(self.duration, channels=channels)
-        self.track.current_frame = tmp_frame
-
-        for effect in self.effects:
-            frames = effect.apply_to(frames, self.samplerate)
-
-        return frames.copy()
+        if n_frames is None:
+            n_frames = self.duration - offset
+
+        if len(self.effects) > 0:
+            # effects (e.g., filters) need to see the entire segment
+            frames = self.track.read_range(
+                self.start, self.duration, channels=channels)
+            for effect in self.effects:
+                frames = effect.apply_to(frames, self.samplerate)
+            return frames[offset:offset + n_frames]
+
+        return self.track.read_range(
+            self.start + offset, n_frames, channels=channels)
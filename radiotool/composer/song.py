@@ -1,8 +1,8 @@
-import hashlib
-import pickle
-import os
+import numpy as np
 
 from ..algorithms import librosa_analysis
+from ..analysis_store import AnalysisStore, ChecksumIndex, params_hash,\
+    file_checksum
 from track import Track
 
 class Song(Track):
@@ -12,14 +12,54 @@ class Song(Track):
     """
 
     def __init__(self, fn, name="Song name", cache_dir=None,
-                 refresh_cache=False, labels=None, labels_in_file=False):
+                 refresh_cache=False, labels=None, labels_in_file=False,
+                 mmap=False, dtype=np.float32, cache_size=None,
+                 full_checksum=False, analysis_profile="full",
+                 analysis_block_duration=None):
+        """Create a Song object
+
+        If ``cache_dir`` is given, the song's analysis is kept in an
+        :py:class:`radiotool.analysis_store.AnalysisStore` in that
+        directory.
+
+        :param str. fn: Path to audio file
+        :param str. name: Name of song
+        :param str. cache_dir: Directory to store analyses in
+        :param bool. refresh_cache: Recompute the analysis even if it is
+            stored
+        :param integer cache_size: Maximum size of the analysis store
+            (in bytes), including the decoded frames that ``mmap``
+            caches there. Least recently used analyses are evicted.
+        :param bool. full_checksum: Identify the song by a sha256 of the
+            entire file instead of a hash of sampled blocks (see
+            :py:func:`radiotool.analysis_store.file_checksum`)
+        :param str. analysis_profile: Analysis profile, e.g., ``"fast"``
+            to analyze at a lower sample rate (see
+            :py:data:`radiotool.algorithms.librosa_analysis.PROFILES`)
+        :param float analysis_block_duration: Analyze the song in blocks
+            of this many seconds, so that long recordings can be analyzed
+            in bounded memory (see
+            :py:func:`radiotool.algorithms.librosa_analysis.analyze_chunked`).
+            ``None`` analyzes the whole song at once.
+        """
         self._analysis = None
+        self._distances = {}
         self._checksum = None
         self.refresh_cache = refresh_cache
         self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.full_checksum = full_checksum
+        self.analysis_profile = analysis_profile
+        self.analysis_block_duration = analysis_block_duration
 
         Track.__init__(self, fn, name, labels=labels,
-                       labels_in_file=labels_in_file)
+                       labels_in_file=labels_in_file,
+                       mmap=mmap, cache_dir=cache_dir, dtype=dtype)
+
+        if self._frames_cache_fn is not None and cache_size is not None:
+            # the decoded frames count towards the cache size
+            self._analysis_store().evict(cache_size,
+                                         keep=self._frames_cache_fn)
 
     @property
     def analysis(self):
@@ -29,42 +69,92 @@ class Song(Track):
             return self._analysis
 
         if self.cache_dir is not None:
-            path = os.path.join(self.cache_dir, self.checksum)
-            try:
-                if self.refresh_cache: raise IOError
-                with open(path + '.pickle', 'rb') as pickle_file:
-                    self._analysis = pickle.load(pickle_file)
-            except IOError:
-                self._analysis = librosa_analysis.analyze_frames(self.all_as_mono(), self.samplerate)
-                with open(path + '.pickle', 'wb') as pickle_file:
-                    pickle.dump(self._analysis, pickle_file, pickle.HIGHEST_PROTOCOL)
+            store = self._analysis_store()
+            param_hash = self._params_hash()
+            if not self.refresh_cache:
+                self._analysis = store.load(self.checksum, param_hash,
+                                            recompute=self._reanalyze)
+            if self._analysis is None:
+                self._analysis = self._reanalyze()
         else:
-            self._analysis = librosa_analysis.analyze_frames(self.all_as_mono(), self.samplerate)
+            self._analysis = self._analyze()
         return self._analysis
 
+    def _reanalyze(self):
+        analysis = self._analyze()
+        self._analysis_store().save(self.checksum, self._params_hash(),
+                                    analysis)
+        return analysis
+
+    def _analyze(self):
+        if self.analysis_block_duration is not None:
+            return librosa_analysis.analyze_chunked(
+                self.range_as_mono, self.duration, self.samplerate,
+                block_duration=self.analysis_block_duration,
+                profile=self.analysis_profile)
+        return librosa_analysis.analyze_frames(
+            self.all_as_mono(), self.samplerate,
+            profile=self.analysis_profile)
+
+    @property
+    def dense_dist(self):
+        """Get the distance matrix between the song's beats (by timbre and
+        chroma together). Computed from the analysis' condensed distances
+        the first time it is used.
+
+        :rtype: 2d float32 numpy array
+        """
+        if "dense" not in self._distances:
+            self._distances["dense"] = librosa_analysis.dense_dist(
+                self.analysis)
+        return self._distances["dense"]
+
+    @property
+    def timbre_dist(self):
+        """Get the timbre distance matrix between the song's beats
+        (computed once, then reused)
+
+        :rtype: 2d float32 numpy array
+        """
+        if "timbre" not in self._distances:
+            self._distances["timbre"] = librosa_analysis.structure(
+                np.array(self.analysis["timbres"]).T)
+        return self._distances["timbre"]
+
+    @property
+    def chroma_dist(self):
+        """Get the chroma distance matrix between the song's beats
+        (computed once, then reused)
+
+        :rtype: 2d float32 numpy array
+        """
+        if "chroma" not in self._distances:
+            self._distances["chroma"] = librosa_analysis.structure(
+                np.array(self.analysis["chroma"]).T)
+        return self._distances["chroma"]
+
     def features_cached(self):
-        if self.cache_dir is not None:
-            path = os.path.join(self.cache_dir, self.checksum)
-            try:
-                if self.refresh_cache: raise IOError
-                with open(path + '.pickle', 'rb') as pickle_file:
-                    return True
-            except IOError:
-                pass
+        if self.cache_dir is not None and not self.refresh_cache:
+            return self._analysis_store().contains(
+                self.checksum, self._params_hash())
         return False
 
+    def _params_hash(self):
+        return params_hash(librosa_analysis.analysis_params(
+            self.analysis_profile, self.analysis_block_duration))
+
+    def _analysis_store(self):
+        return AnalysisStore(self.cache_dir, max_bytes=self.cache_size)
+
     @property
     def checksum(self):
         if self._checksum is not None:
             return self._checksum
 
-        block_size = 65536
-        hasher = hashlib.sha256()
-        with open(self.filename, 'rb') as f:
-            buf = f.read(block_size)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = f.read(block_size)
-        self._checksum = hasher.hexdigest()
+        if self.cache_dir is not None:
+            self._checksum = ChecksumIndex(self.cache_dir).checksum(
+                self.filename, full=self.full_checksum)
+        else:
+            self._checksum = file_checksum(self.filename,
+                                           full=self.full_checksum)
         return self._checksum
-
@@ -7,18 +7,19 @@ class Speech(Track):
     """A :py:class:`radiotool.composer.Track` 
     subclass that wraps a speech .wav file"""
 
-    def __init__(self, fn, name="Speech name", labels=None, labels_in_file=False):
+    def __init__(self, fn, name="Speech name", labels=None, labels_in_file=False,
+                 mmap=False, cache_dir=None, dtype=np.float32):
         Track.__init__(self, fn, name, labels=labels,
-                       labels_in_file=labels_in_file)
+                       labels_in_file=labels_in_file,
+                       mmap=mmap, cache_dir=cache_dir, dtype=dtype)
     
     def refine_cut(self, cut_point, window_size=1):
         cut_point = max(.5 * window_size, cut_point)
 
-        cf = self.current_frame
-        self.current_frame = max(int((cut_point - window_size / 2.0) * self.samplerate), 0)
-        frames = self.read_frames(window_size * self.samplerate, channels=1)
+        frames = self.read_range(
+            max(int((cut_point - window_size / 2.0) * self.samplerate), 0),
+            window_size * self.samplerate, channels=1)
         subwindow_n_frames = int((window_size / 16.0) * self.samplerate)
-        self.current_frame = cf
 
         segments = segment_array(frames, subwindow_n_frames, overlap=.5)
 
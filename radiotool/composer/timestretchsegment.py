@@ -23,9 +23,15 @@ class TimeStretchSegment(Segment):
         Segment.__init__(self, track, comp_location, start, new_duration)
         self.orig_duration = int(orig_duration * self.samplerate)
 
-    def get_frames(self, channels=2):
-        self.track.current_frame = self.start
-        frames = self.track.read_frames(self.orig_duration, channels=channels)
+    @property
+    def whole_segment(self):
+        # the entire segment is resampled at once
+        return True
+
+    def get_frames(self, channels=2, offset=0, n_frames=None):
+        if n_frames is None:
+            n_frames = self.duration - offset
+        frames = self.track.read_range(
+            self.start, self.orig_duration, channels=channels)
         frames = resample(frames, self.duration)
-        self.track.current_frame = 0
-        return frames
\ No newline at end of file
+        return frames[offset:offset + n_frames]
@@ -1,6 +1,9 @@
+import hashlib
 import re
+import os
 import os.path
-import subprocess
+import struct
+import threading
 
 from scikits.audiolab import Sndfile
 import numpy as np
@@ -12,36 +15,163 @@ except:
     LIBXMP = False
 
 from ..utils import zero_crossing_first, zero_crossing_last
+from .. import codec
+from ..analysis_store import FRAMES_DIRNAME
 from label import Label
 
 
+def wav_data_layout(filename):
+    """Find the audio data in a .wav file whose samples numpy can read
+    in place: 8, 16 or 32-bit integer PCM, or 32 or 64-bit floating
+    point.
+
+    :param str. filename: Path to .wav file
+    :returns: Byte offset of the audio data and its numpy dtype, or
+        ``None`` if the file is not such a .wav file
+    :rtype: (integer, numpy dtype) or None
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or\
+                header[8:12] != b'WAVE':
+            return None
+
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id = chunk[:4]
+            chunk_size = struct.unpack('<I', chunk[4:])[0]
+
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                chunk_size = 0
+            elif chunk_id == b'data':
+                break
+            # chunks are padded to an even number of bytes
+            f.seek(chunk_size + (chunk_size % 2), 1)
+
+        if fmt is None or len(fmt) < 16:
+            return None
+
+        audio_format, _, _, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+        if audio_format == 0xFFFE and len(fmt) >= 26:
+            # WAVE_FORMAT_EXTENSIBLE: format is the start of the subformat
+            audio_format = struct.unpack('<H', fmt[24:26])[0]
+
+        # 1 is WAVE_FORMAT_PCM (8-bit samples are unsigned), 3 is
+        # WAVE_FORMAT_IEEE_FLOAT
+        if audio_format == 1 and bits == 8:
+            return f.tell(), np.dtype('u1')
+        if audio_format == 1 and bits in (16, 32):
+            return f.tell(), np.dtype('<i%d' % (bits / 8))
+        if audio_format == 3 and bits in (32, 64):
+            return f.tell(), np.dtype('<f%d' % (bits / 8))
+        return None
+
+
+def pcm_to_float(samples, dtype=np.float32):
+    """Convert samples read straight from a .wav file to floats, scaled
+    like libsndfile's float reads (integer full scale is -1 to 1)
+
+    :param samples: Integer PCM or floating point samples
+    :type samples: numpy array
+    :param dtype: Sample type to return
+    :type dtype: numpy dtype
+    :rtype: numpy array
+    """
+    dtype = np.dtype(dtype)
+    if samples.dtype.kind == 'f':
+        return samples.astype(dtype)
+    out = samples.astype(dtype)
+    if samples.dtype.kind == 'u':
+        out -= 128
+        out /= 128
+    else:
+        out /= 2 ** (8 * samples.dtype.itemsize - 1)
+    return out
+
+
+def frames_with_channels(frames, channels):
+    """Get ``frames`` with a different number of channels. Mono to stereo
+    is a (read-only) broadcast view of the mono frames, not a copy.
+
+    :param frames: Frames with 1 (1d array) or 2 channels
+    :type frames: numpy array
+    :param integer channels: Number of channels to return (1 or 2)
+    :returns: Frames with ``channels`` channels
+    :rtype: numpy array
+    """
+    if frames.ndim == 1:
+        if channels == 1:
+            return frames
+        return np.broadcast_to(frames[:, np.newaxis],
+                               (frames.shape[0], channels))
+    if channels == 1:
+        return np.mean(frames, axis=1)
+    return frames
+
+
 class Track(object):
     """Represents a wrapped .wav file."""
 
-    def __init__(self, fn, name="No name", labels=None, labels_in_file=False):
+    def __init__(self, fn, name="No name", labels=None, labels_in_file=False,
+                 mmap=False, cache_dir=None, dtype=np.float32):
         """Create a Track object
 
+        If ``mmap`` is set, the track's audio is memory-mapped and
+        :py:meth:`read_frames` reads from the mapped data instead of the
+        file. 8, 16 and 32-bit PCM and floating point .wav files are
+        mapped directly (integer samples are converted to floats as
+        they're read). Other files are decoded once into a float32
+        ``.frames.npy`` file in the ``frames`` directory of
+        ``cache_dir`` that is mapped instead (and that counts towards
+        the size of an :py:class:`radiotool.analysis_store.AnalysisStore`
+        in ``cache_dir``). If there is no ``cache_dir``, or it can't be
+        written to, they're read from the file as usual.
+
+        .mp3 files are decoded (see :py:mod:`radiotool.codec`) when the
+        track is created. With ``mmap`` and a ``cache_dir``, the decoded
+        frames are cached and mapped like other files, so the mp3 is
+        only decoded once. Otherwise they're kept in memory.
+
         :param str. fn: Path to audio file (wav preferred, mp3 ok)
         :param str. name: Name of track
+        :param bool. mmap: Memory-map the track's audio
+        :param str. cache_dir: Where to store decoded cache files for
+            ``mmap``
+        :param dtype: Sample type of the frames the track returns
+        :type dtype: numpy dtype
         """
         self.filename = fn
         self.name = name
 
+        self.current_frame = 0
+        self.dtype = np.dtype(dtype)
+        # the sound file has one read position shared by every reader
+        self._sound_lock = threading.Lock()
+        self._frames_cache_dir = cache_dir
+
+        # the frames cache file that is mapped, if any
+        self._frames_cache_fn = None
+
         (base, extension) = os.path.splitext(self.filename)
         if extension == ".mp3":
-            try:
-                print "Creating wav from {}".format(self.filename)
-                new_fn = base + '.wav'
-                subprocess.check_output("lame --decode \"{}\" \"{}\"".format(
-                    self.filename, new_fn), shell=True)
-                self.filename = new_fn
-            except:
-                print "Could not create wav from mp3"
-                raise
-
-        self.sound = Sndfile(self.filename, 'r')
-        self.current_frame = 0
-        self.channels = self.sound.channels
+            self.sound = None
+            self._frames, self._samplerate = self._decode(mmap)
+            self._total_frames = len(self._frames)
+            self.channels = 1 if self._frames.ndim == 1 else\
+                self._frames.shape[1]
+        else:
+            self.sound = Sndfile(self.filename, 'r')
+            self._samplerate = self.sound.samplerate
+            self._total_frames = self.sound.nframes
+            self.channels = self.sound.channels
+            if mmap:
+                self._frames = self._map_frames()
+            else:
+                self._frames = None
 
         if labels is not None and labels_in_file:
             raise Exception(
@@ -64,37 +194,63 @@ class Track(object):
         :returns: Next ``n`` frames from the track, starting with ``current_frame``
         :rtype: numpy array
         """
+        out = self.read_range(self.current_frame, n, channels=channels)
+        if out is not None:
+            self.current_frame += min(n, self.remaining_frames())
+        return out
+
+    def read_range(self, start, n, channels=None):
+        """Read ``n`` frames from the track, starting with frame
+        ``start``.
+
+        Unlike :py:meth:`read_frames`, this neither uses nor changes
+        ``current_frame``, so many threads can read from the same track
+        at once.
+
+        :param integer start: First frame to read
+        :param integer n: Number of frames to read
+        :param integer channels: Number of channels to return (default
+            is number of channels in track)
+        :returns: ``n`` frames from the track, starting with ``start``
+        :rtype: numpy array
+        """
         if channels is None:
             channels = self.channels
 
-        if channels == 1:
-            out = np.zeros(n)
-        elif channels == 2:
-            out = np.zeros((n, 2))
-        else:
+        if channels not in (1, 2):
             print "Input needs to be 1 or 2 channels"
             return
-        if n > self.remaining_frames():
+        n_requested = n
+        if start + n > self.duration:
             print "Trying to retrieve too many frames!"
             print "Asked for", n
-            n = self.remaining_frames()
+            n = max(self.duration - start, 0)
             print "Returning", n
 
-        if self.channels == 1 and channels == 1:
-            out = self.sound.read_frames(n)
-        elif self.channels == 1 and channels == 2:
-            frames = self.sound.read_frames(n)
-            out = np.vstack((frames.copy(), frames.copy())).T
-        elif self.channels == 2 and channels == 1:
-            frames = self.sound.read_frames(n)
-            out = np.mean(frames, axis=1)
-        elif self.channels == 2 and channels == 2:
-            out[:n, :] = self.sound.read_frames(n)
+        frames = self._read_raw(start, n)
+        if frames.dtype != self.dtype:
+            frames = frames.astype(self.dtype)
+        out = frames_with_channels(frames, channels)
 
-        self.current_frame += n
+        if channels == 2 and n < n_requested:
+            # pad stereo output to the requested length
+            padded = np.zeros((n_requested, 2), dtype=out.dtype)
+            padded[:n, :] = out
+            out = padded
 
         return out
 
+    def _read_raw(self, start, n):
+        """Read ``n`` frames with the track's own channels"""
+        if self._frames is not None:
+            frames = self._frames[start:start + n]
+            if frames.dtype.kind != 'f':
+                frames = pcm_to_float(frames, self.dtype)
+            return frames
+        with self._sound_lock:
+            self.sound.seek(start)
+            return self.sound.read_frames(n, dtype=self.dtype)
+
     @property
     def current_frame(self):
         """Get and set the current frame of the track"""
@@ -106,7 +262,6 @@ class Track(object):
 
         :param integer n: Frame to set to ``current_frame``
         """
-        self.sound.seek(n)
         self._current_frame = n
 
     def reset(self):
@@ -114,6 +269,133 @@ class Track(object):
         """
         self.current_frame = 0
 
+    def _map_frames(self):
+        """Memory-map the audio data of the track, decoding it to a
+        float32 cache file first if it can't be mapped directly
+
+        :returns: Mapped frames, or ``None`` if the track has to be read
+            from the file
+        """
+        shape = (self.duration, self.channels)
+        if self.channels == 1:
+            shape = (self.duration,)
+
+        layout = wav_data_layout(self.filename)
+        if layout is not None:
+            offset, dtype = layout
+            return np.memmap(self.filename, dtype=dtype, mode='r',
+                             offset=offset, shape=shape)
+
+        if self._frames_cache_dir is None:
+            return None
+        cache_fn = "%s%d.frames.npy" % (self._frames_cache_prefix(),
+                                        self._samplerate)
+        frames = self._load_frames_cache(cache_fn)
+        if frames is not None and frames.shape == shape:
+            return frames
+
+        def fill(frames):
+            block_size = 65536
+            with self._sound_lock:
+                self.sound.seek(0)
+                for start in xrange(0, self.duration, block_size):
+                    n = min(block_size, self.duration - start)
+                    frames[start:start + n] = self.sound.read_frames(
+                        n, dtype=np.float32)
+
+        return self._write_frames_cache(cache_fn, shape, fill)
+
+    def _decode(self, mmap):
+        """Decode a compressed track, through a float32 cache file that is
+        mapped if ``mmap`` is set
+
+        :returns: Frames and sample rate
+        """
+        if not mmap or self._frames_cache_dir is None:
+            frames, samplerate = codec.decode(self.filename)
+            return frames.astype(self.dtype, copy=False), samplerate
+
+        # the sample rate is only known from the name of the cache file
+        prefix = self._frames_cache_prefix()
+        cache_dir, name = os.path.split(prefix)
+        try:
+            names = os.listdir(cache_dir)
+        except OSError:
+            names = []
+        for cached in names:
+            match = re.match(re.escape(name) + r"(\d+)\.frames\.npy$", cached)
+            if match is None:
+                continue
+            frames = self._load_frames_cache(os.path.join(cache_dir, cached))
+            if frames is not None:
+                return frames, int(match.group(1))
+
+        frames, samplerate = codec.decode(self.filename)
+
+        def fill(out):
+            out[:] = frames
+
+        mapped = self._write_frames_cache(
+            "%s%d.frames.npy" % (prefix, samplerate), frames.shape, fill)
+        if mapped is None:
+            return frames.astype(self.dtype, copy=False), samplerate
+        return mapped, samplerate
+
+    def _frames_cache_prefix(self):
+        # the cache directory may be shared by files with the same name
+        path = os.path.abspath(self.filename)
+        return os.path.join(
+            self._frames_cache_dir, FRAMES_DIRNAME, "%s-%s." % (
+                os.path.basename(path), hashlib.md5(path).hexdigest()[:12]))
+
+    def _load_frames_cache(self, cache_fn):
+        """Map a frames cache file if it is newer than the track's file
+
+        :returns: Mapped frames, or ``None``
+        """
+        try:
+            if os.path.getmtime(cache_fn) < os.path.getmtime(self.filename):
+                return None
+            frames = np.load(cache_fn, mmap_mode='r')
+            # mark as recently used
+            os.utime(cache_fn, None)
+        except (IOError, OSError, ValueError):
+            return None
+        self._frames_cache_fn = cache_fn
+        return frames
+
+    def _write_frames_cache(self, cache_fn, shape, fill):
+        """Write a frames cache file with ``fill(frames)``, then map it
+
+        :returns: Mapped frames, or ``None`` if the cache can't be written
+        """
+        # write to a temporary file, then move it into place so that
+        # other processes never see a partial cache file
+        tmp_fn = "%s.%d.tmp" % (cache_fn, os.getpid())
+        try:
+            cache_dir = os.path.dirname(cache_fn)
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError:
+                    # created by another process in the meantime
+                    if not os.path.isdir(cache_dir):
+                        raise
+            frames = np.lib.format.open_memmap(
+                tmp_fn, mode='w+', dtype=np.float32, shape=shape)
+            fill(frames)
+            frames.flush()
+            del frames
+            os.rename(tmp_fn, cache_fn)
+        except (IOError, OSError):
+            # can't write the cache, so read from the file instead
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            return None
+
+        self._frames_cache_fn = cache_fn
+        return np.load(cache_fn, mmap_mode='r')
+
     def all_as_mono(self):
         """Get the entire track as 1 combined channel
 
@@ -130,31 +412,24 @@ class Track(object):
         :returns: Track frames in range as 1 combined channel
         :rtype: 1d numpy array of length ``end_sample - start_sample``
         """
-        tmp_current = self.current_frame
-        self.current_frame = start_sample
-        tmp_frames = self.read_frames(end_sample - start_sample)
-        if self.channels == 2:
-            frames = np.mean(tmp_frames, axis=1)
-        elif self.channels == 1:
-            frames = tmp_frames
-        else:
+        if self.channels not in (1, 2):
             raise IOError("Input audio must have either 1 or 2 channels")
-        self.current_frame = tmp_current
-        return frames
+        return self.read_range(start_sample, end_sample - start_sample,
+                               channels=1)
 
     @property
     def samplerate(self):
         """Get the sample rate of the track"""
-        return self.sound.samplerate
+        return self._samplerate
 
     def remaining_frames(self):
         """Get the number of frames remaining in the track"""
-        return self.sound.nframes - self.current_frame
+        return self.duration - self.current_frame
 
     @property
     def duration(self):
         """Get the duration of total frames in the track"""
-        return self.sound.nframes
+        return self._total_frames
 
     @property
     def duration_in_seconds(self):
@@ -172,9 +447,8 @@ class Track(object):
         :rtype: integer
         """
         if duration == 0:
-            duration = self.sound.nframes
-        self.current_frame = start
-        arr = self.read_frames(duration)
+            duration = self.duration
+        arr = self.read_range(start, duration)
         # get the frame of the maximum amplitude
         # different names for the same thing...
         # max_amp_sample = a.argmax(axis=0)[a.max(axis=0).argmax()]
@@ -26,10 +26,19 @@ class Volume(Dynamic):
         Dynamic.__init__(self, track, comp_location, duration)
         self.volume = volume
         
-    def to_array(self, channels=2):
-        """Generate the array of multipliers for the dynamic"""
-        return np.linspace(self.volume, self.volume,
-            self.duration * channels).reshape(self.duration, channels)
+    def to_array(self, channels=2, offset=0, n_frames=None,
+                 dtype=np.float32):
+        """Generate the array of multipliers for the dynamic
+
+        :param integer channels: Number of channels in output array
+        :param integer offset: First frame of the dynamic to generate
+        :param integer n_frames: Number of frames to generate (default is
+            the rest of the dynamic after ``offset``)
+        :param dtype: Type of the multipliers
+        """
+        if n_frames is None:
+            n_frames = self.duration - offset
+        return np.full((n_frames, channels), self.volume, dtype=dtype)
 
     @staticmethod
     def from_segment(segment, volume):
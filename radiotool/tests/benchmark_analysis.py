@@ -0,0 +1,104 @@
+"""Compare the "fast" analysis profile with the "full" one: analysis
+time, beat positions, and the quality of a retargeting that uses each
+analysis.
+
+Usage: python benchmark_analysis.py song.wav [duration]
+
+Retargeting quality is measured by scoring the jumps in each
+retargeted path with the "full" analysis' beat distances, so both
+results are judged by the same features.
+"""
+import sys
+import time
+
+import numpy as np
+
+from radiotool.composer import Song
+from radiotool.algorithms import librosa_analysis
+from radiotool.algorithms import constraints as rt_constraints
+from radiotool.algorithms import retarget as rt_retarget
+
+
+def analyze(song_fn, profile):
+    song = Song(song_fn, analysis_profile=profile)
+    frames = song.all_as_mono()
+    start = time.time()
+    song._analysis = librosa_analysis.analyze_frames(
+        frames, song.samplerate, profile=profile)
+    return song, time.time() - start
+
+
+def beat_agreement(beats, ref_beats, tolerance=.03):
+    """Fraction of reference beats with a beat within ``tolerance``
+    seconds, and the mean offset of those beats"""
+    beats = np.array(beats)
+    offsets = np.array([np.min(np.abs(beats - b)) for b in ref_beats])
+    hits = offsets <= tolerance
+    return np.mean(hits), np.mean(offsets[hits])
+
+
+def jump_cost(path, ref_beats, ref_dist):
+    """Total distance (in the reference analysis) between the beat that
+    would have followed each jump and the beat jumped to"""
+    ref_beats = np.array(ref_beats)
+
+    def nearest(t):
+        return np.argmin(np.abs(ref_beats - t))
+
+    n = ref_dist.shape[0]
+    cost = 0.0
+    n_jumps = 0
+    for (_, t1), (_, t2) in zip(path[:-1], path[1:]):
+        if t1 == 'p' or t2 == 'p':
+            continue
+        i, j = nearest(t1), nearest(t2)
+        if j == i + 1:
+            continue
+        n_jumps += 1
+        if i + 1 < n and j < n:
+            cost += ref_dist[i + 1, j]
+    return cost, n_jumps
+
+
+def retarget(song, duration):
+    constraints = [
+        rt_constraints.TimbrePitchConstraint(
+            context=0, timbre_weight=1.0, chroma_weight=1.0),
+        rt_constraints.EnergyConstraint(penalty=.5),
+        rt_constraints.MinimumLoopConstraint(8),
+    ]
+    start = time.time()
+    comp, info = rt_retarget.retarget(
+        [song], duration, constraints=[constraints],
+        fade_in_len=None, fade_out_len=None)
+    return info, time.time() - start
+
+
+if __name__ == '__main__':
+    song_fn = sys.argv[1]
+    duration = 60.0
+    if len(sys.argv) > 2:
+        duration = float(sys.argv[2])
+
+    results = {}
+    for profile in ("full", "fast"):
+        song, elapsed = analyze(song_fn, profile)
+        info, retarget_time = retarget(song, duration)
+        results[profile] = (song.analysis, info)
+        print "{:5s} analysis {:6.2f} s  {:4d} beats  retarget {:6.2f} s".\
+            format(profile, elapsed, len(song.analysis["beats"]),
+                   retarget_time)
+
+    full_analysis, full_info = results["full"]
+    fast_analysis, fast_info = results["fast"]
+
+    hit_rate, mean_offset = beat_agreement(
+        fast_analysis["beats"], full_analysis["beats"])
+    print "fast beats within 30 ms of full beats: {:.1%} " \
+        "(mean offset {:.1f} ms)".format(hit_rate, mean_offset * 1000)
+
+    for profile, (_, info) in sorted(results.items()):
+        cost, n_jumps = jump_cost(info["path"], full_analysis["beats"],
+                                  librosa_analysis.dense_dist(full_analysis))
+        print "{:5s} retarget: {} jumps, jump cost {:.3f} (full features)," \
+            " path cost {:.3f}".format(profile, n_jumps, cost, info["cost"])
@@ -0,0 +1,72 @@
+"""Compare render time and peak memory of building a long composition
+with float32 and float64 samples.
+
+Usage: python benchmark_render.py [audio_file] [minutes]
+
+Each sample type is rendered in a fresh process so that the peak RSS
+of one run does not hide the other.
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from radiotool.composer import Composition, Segment, Track
+
+
+def long_composition(track_fn, minutes, dtype):
+    """Loop a track for ``minutes`` minutes, crossfading each loop into
+    the next one"""
+    track = Track(track_fn, "benchmark", dtype=dtype)
+    comp = Composition(channels=2, dtype=dtype)
+    comp.add_track(track)
+
+    seg_start = 0.5
+    seg_len = track.duration_in_seconds - seg_start
+    prev = None
+    loc = 0.0
+    while loc < minutes * 60.0:
+        seg = Segment(track, loc, seg_start, seg_len)
+        comp.add_segment(seg)
+        if prev is not None:
+            comp.cross_fade(prev, seg, .2)
+        prev = seg
+        loc += seg_len
+
+    comp.fade_in(comp.segments[0], 1.0)
+    comp.fade_out(prev, 1.0)
+    return comp
+
+
+def run(track_fn, minutes, dtype_name):
+    comp = long_composition(track_fn, minutes, np.dtype(dtype_name))
+
+    start = time.time()
+    out = comp.build()
+    elapsed = time.time() - start
+
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print "{:8s} render {:6.2f} s  peak RSS {:7.1f} MB  output {:7.1f} MB".\
+        format(dtype_name, elapsed, peak_rss, out.nbytes / 1024.0 ** 2)
+
+
+if __name__ == '__main__':
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    track_fn = os.path.join(dirname, "test.wav")
+    minutes = 10.0
+    if len(sys.argv) > 1:
+        track_fn = sys.argv[1]
+    if len(sys.argv) > 2:
+        minutes = float(sys.argv[2])
+
+    if len(sys.argv) > 3:
+        run(track_fn, minutes, sys.argv[3])
+    else:
+        print "Rendering {} minutes from {}".format(minutes, track_fn)
+        for dtype_name in ("float32", "float64"):
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   track_fn, str(minutes), dtype_name])
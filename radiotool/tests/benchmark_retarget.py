@@ -0,0 +1,124 @@
+"""Compare the beam search retargeting solver with the exact one: the
+cost of the path each finds, and how long each takes.
+
+Usage: python benchmark_retarget.py [song.wav [duration]]
+
+Without a song, the solvers are run on synthetic problems of a few
+sizes (random transition costs within each of several songs, and a
+run of pause beats). With a song, the song is retargeted to
+``duration`` seconds with each solver.
+"""
+import sys
+import time
+
+import numpy as np
+
+import radiotool.algorithms
+from radiotool.composer import Song
+from radiotool.algorithms import constraints as rt_constraints
+from radiotool.algorithms import retarget as rt_retarget
+
+build_table_full_backtrace = sys.modules[
+    "radiotool.algorithms.build_table_full_backtrace"]
+build_table_sparse = sys.modules["radiotool.algorithms.build_table_sparse"]
+
+# (beam width, margin, number of transitions kept from each beat)
+BEAMS = [(10, None, None), (100, None, None), (100, 1.0, None),
+         (1000, None, None), (100, None, 16)]
+
+
+def synthetic_problem(n_songs, song_beats, n_pauses, n_out, seed=0):
+    """Transition costs and penalties shaped like the ones
+    :py:func:`radiotool.algorithms.retarget.retarget` builds"""
+    rng = np.random.RandomState(seed)
+    n_beats = n_songs * song_beats
+    n = n_beats + n_pauses
+
+    tc = np.zeros((n, n))
+    for i in xrange(n_songs):
+        lo = i * song_beats
+        hi = lo + song_beats
+        tc[lo:hi, lo:hi] = rng.rand(song_beats, song_beats)
+        # different songs don't connect
+        tc[lo:hi, :lo] = np.finfo(np.float64).max
+        tc[lo:hi, hi:n_beats] = np.finfo(np.float64).max
+    tc[n_beats:, :] = np.finfo(np.float64).max
+    tc[:n_beats, n_beats] = 1.4
+    for i in xrange(n_beats, n - 1):
+        tc[i, i + 1] = .05
+    tc[n - 1, :n_beats] = rng.rand(n_beats) * .1
+
+    pen = rng.rand(n, n_out)
+    song_starts = np.arange(0, n_beats, song_beats, dtype=np.int32)
+    song_ends = song_starts + song_beats
+    return tc, pen, song_starts, song_ends, n_beats
+
+
+def report(beam_width, margin, n_neighbors, cost, elapsed, exact_cost):
+    print "  beam {:5d} m {:4s} k {:4s}  cost {:8.3f}  {:6.2f} s  " \
+        "({:+.1%})".format(beam_width, str(margin), str(n_neighbors), cost,
+                           elapsed, cost / exact_cost - 1)
+
+
+def run_synthetic(n_songs, song_beats, n_pauses, n_out):
+    tc, pen, starts, ends, n_beats = synthetic_problem(
+        n_songs, song_beats, n_pauses, n_out)
+    kwargs = dict(first_pause=n_beats, min_beats=0, max_beats=-1)
+
+    start = time.time()
+    _, cost = build_table_full_backtrace.build_table(
+        tc, pen, starts, ends, **kwargs)
+    exact_time = time.time() - start
+    exact_cost = sum(cost)
+
+    print "{} songs x {} beats, {} pauses, {} output beats".format(
+        n_songs, song_beats, n_pauses, n_out)
+    print "  exact                      cost {:8.3f}  {:6.2f} s".format(
+        exact_cost, exact_time)
+    for beam_width, margin, n_neighbors in BEAMS:
+        start = time.time()
+        _, cost = build_table_sparse.beam_search(
+            tc, pen, starts, ends, beam_width=beam_width, margin=margin,
+            n_neighbors=n_neighbors, **kwargs)
+        report(beam_width, margin, n_neighbors, sum(cost),
+               time.time() - start, exact_cost)
+
+
+def run_song(song_fn, duration):
+    song = Song(song_fn)
+    song.analysis
+    constraints = [
+        rt_constraints.TimbrePitchConstraint(
+            context=0, timbre_weight=1.0, chroma_weight=1.0),
+        rt_constraints.EnergyConstraint(penalty=.5),
+        rt_constraints.MinimumLoopConstraint(8),
+    ]
+
+    def retarget(**kwargs):
+        start = time.time()
+        _, info = rt_retarget.retarget(
+            [song], duration, constraints=[constraints],
+            fade_in_len=None, fade_out_len=None, **kwargs)
+        return info["cost"], time.time() - start
+
+    exact_cost, exact_time = retarget()
+    print "{} to {:.0f} s".format(song_fn, duration)
+    print "  exact                      cost {:8.3f}  {:6.2f} s".format(
+        exact_cost, exact_time)
+    for beam_width, margin, n_neighbors in BEAMS:
+        cost, elapsed = retarget(beam_width=beam_width, beam_margin=margin,
+                                 n_neighbors=n_neighbors)
+        report(beam_width, margin, n_neighbors, cost, elapsed, exact_cost)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        duration = 120.0
+        if len(sys.argv) > 2:
+            duration = float(sys.argv[2])
+        run_song(sys.argv[1], duration)
+    else:
+        for n_songs, song_beats, n_pauses, n_out in ((1, 300, 20, 200),
+                                                     (5, 300, 40, 400),
+                                                     (20, 200, 60, 400)):
+            run_synthetic(n_songs, song_beats, n_pauses, n_out)
@@ -0,0 +1,149 @@
+from unittest import TestCase
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as N
+
+from radiotool.analysis_store import AnalysisStore, ChecksumIndex,\
+    file_checksum, params_hash
+
+
+class TestAnalysisStore(TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = AnalysisStore(self.dirname)
+        self.analysis = {
+            "duration": 12.5,
+            "tempo": N.float64(120.0),
+            "beats": [0.5, 1.0, 1.5],
+            "timbres": [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]],
+            "dense_dist": N.arange(9.0).reshape(3, 3),
+        }
+        self.param_hash = params_hash({"hop_length": 128})
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_round_trip(self):
+        assert self.store.load("abc", self.param_hash) is None
+        self.store.save("abc", self.param_hash, self.analysis)
+        assert self.store.contains("abc", self.param_hash)
+
+        loaded = self.store.load("abc", self.param_hash)
+        assert loaded["duration"] == 12.5
+        assert loaded["tempo"] == 120.0
+        assert loaded["beats"] == [0.5, 1.0, 1.5]
+        assert N.allclose(loaded["timbres"], self.analysis["timbres"])
+        assert N.allclose(loaded["dense_dist"], self.analysis["dense_dist"])
+        assert set(loaded.keys()) == set(self.analysis.keys())
+
+    def test_params_change_key(self):
+        self.store.save("abc", self.param_hash, self.analysis)
+        other_hash = params_hash({"hop_length": 512})
+        assert other_hash != self.param_hash
+        assert self.store.load("abc", other_hash) is None
+
+    def test_evict_least_recently_used(self):
+        self.store.save("a", self.param_hash, self.analysis)
+        self.store.save("b", self.param_hash, self.analysis)
+        entry_size = self.store.entries()[0][1]
+
+        # use "a" after "b", so "b" is least recently used
+        os.utime(os.path.join(self.dirname, "b-" + self.param_hash),
+                 (1, 1))
+        self.store.load("a", self.param_hash)
+
+        capped = AnalysisStore(self.dirname, max_bytes=2 * entry_size)
+        capped.save("c", self.param_hash, self.analysis)
+        assert capped.contains("a", self.param_hash)
+        assert not capped.contains("b", self.param_hash)
+        assert capped.contains("c", self.param_hash)
+
+    def test_save_existing_keeps_readers(self):
+        self.store.save("abc", self.param_hash, self.analysis)
+        loaded = self.store.load("abc", self.param_hash)
+        inode = os.stat(loaded.entry_dir).st_ino
+
+        # e.g., another process analyzed a duplicate of the same song
+        self.store.save("abc", self.param_hash, self.analysis)
+        assert os.stat(loaded.entry_dir).st_ino == inode
+        assert N.allclose(loaded["timbres"], self.analysis["timbres"])
+        assert not [fn for fn in os.listdir(self.dirname)
+                    if fn.endswith(".tmp")]
+
+    def test_evicted_features_are_recomputed(self):
+        self.store.save("abc", self.param_hash, self.analysis)
+        recomputed = []
+
+        def recompute():
+            recomputed.append(True)
+            return self.analysis
+
+        loaded = self.store.load("abc", self.param_hash, recompute=recompute)
+        assert loaded["beats"] == [0.5, 1.0, 1.5]
+        self.store.evict(0)
+        assert loaded["beats"] == [0.5, 1.0, 1.5]
+        assert N.allclose(loaded["timbres"], self.analysis["timbres"])
+        assert recomputed == [True]
+
+
+class TestChecksum(TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "audio.wav")
+        with open(self.filename, 'wb') as f:
+            f.write(os.urandom(2000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_sampled_checksum_sees_changes(self):
+        checksum = file_checksum(self.filename)
+        assert checksum == file_checksum(self.filename)
+        assert checksum != file_checksum(self.filename, full=True)
+
+        with open(self.filename, 'r+b') as f:
+            f.write(b"changed")
+        assert checksum != file_checksum(self.filename)
+
+    def test_index(self):
+        os.utime(self.filename, (1000000, 1000000))
+        index = ChecksumIndex(self.dirname)
+        checksum = index.checksum(self.filename)
+        assert checksum == file_checksum(self.filename)
+
+        # reused while size and mtime are unchanged
+        with open(self.filename, 'r+b') as f:
+            f.write(b"changed")
+        os.utime(self.filename, (1000000, 1000000))
+        assert ChecksumIndex(self.dirname).checksum(
+            self.filename) == checksum
+
+        os.utime(self.filename, (1000000, 1000010))
+        assert ChecksumIndex(self.dirname).checksum(
+            self.filename) != checksum
+
+    def test_index_entries_are_separate(self):
+        other = os.path.join(self.dirname, "other.wav")
+        with open(other, 'wb') as f:
+            f.write(os.urandom(1000))
+
+        # an index opened before another file was added doesn't drop it
+        index = ChecksumIndex(self.dirname)
+        ChecksumIndex(self.dirname).checksum(other)
+        index.checksum(self.filename)
+        assert len(os.listdir(index.index_dir)) == 2
+
+        # a half-written entry is recomputed
+        entry_path = index._entry_path(os.path.abspath(other))
+        with open(entry_path, 'w') as f:
+            f.write('{"path": ')
+        assert index.checksum(other) == file_checksum(other)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+from unittest import TestCase
+import unittest
+import sys
+
+import numpy as N
+
+import radiotool.algorithms
+build_table_full_backtrace = sys.modules[
+    "radiotool.algorithms.build_table_full_backtrace"]
+build_table_sparse = sys.modules["radiotool.algorithms.build_table_sparse"]
+
+
+class TestBuildTable(TestCase):
+
+    def setUp(self):
+        # two songs, followed by pause beats
+        rng = N.random.RandomState(0)
+        sizes = [9, 6]
+        self.n_beats = sum(sizes)
+        n_pauses = 4
+        n = self.n_beats + n_pauses
+
+        tc = N.ones((n, n)) * N.inf
+        start = 0
+        for size in sizes:
+            tc[start:start + size, start:start + size] = rng.rand(size, size)
+            start += size
+        p0 = self.n_beats
+        tc[:p0, p0] = 1.4
+        for i in xrange(p0, n - 1):
+            tc[i, i + 1] = .05
+        tc[n - 1, :p0] = 0.0
+
+        self.tc = N.nan_to_num(tc)
+        self.pen = rng.rand(n, 25)
+        self.song_starts = N.array([0, sizes[0]], dtype=N.int32)
+        self.song_ends = N.array([sizes[0], self.n_beats], dtype=N.int32)
+
+    def build(self, module, **kwargs):
+        return module.build_table(
+            self.tc, self.pen, self.song_starts, self.song_ends,
+            first_pause=self.n_beats, **kwargs)
+
+    def test_all_transitions_match_full_backtrace(self):
+        for kwargs in ({"min_beats": 0, "max_beats": -1},
+                       {"min_beats": 2, "max_beats": 5}):
+            path, cost = self.build(build_table_full_backtrace, **kwargs)
+            sparse_path, sparse_cost = self.build(build_table_sparse,
+                                                  **kwargs)
+            assert sparse_path == path
+            assert N.allclose(sparse_cost, cost)
+
+    def test_threads(self):
+        for kwargs in ({"min_beats": 0, "max_beats": -1},
+                       {"min_beats": 2, "max_beats": 5}):
+            serial = self.build(build_table_full_backtrace, **kwargs)
+            for n_threads in (2, 4):
+                assert self.build(build_table_full_backtrace,
+                                  n_threads=n_threads, **kwargs) == serial
+
+    def test_strategies(self):
+        for kwargs in ({"min_beats": 0, "max_beats": -1},
+                       {"min_beats": 2, "max_beats": 5}):
+            full = self.build(build_table_sparse, strategy="full", **kwargs)
+            for strategy in ("checkpoint", "divide"):
+                assert self.build(build_table_sparse, strategy=strategy,
+                                  **kwargs) == full
+            for strategy in ("full", "checkpoint", "divide"):
+                path, cost = self.build(build_table_full_backtrace,
+                                        strategy=strategy, n_threads=2,
+                                        **kwargs)
+                assert path == full[0]
+                assert N.allclose(cost, full[1])
+
+        n_nodes, n_out = 1000, 400
+        full_bytes = build_table_sparse.table_bytes(n_nodes, n_out)
+        assert build_table_sparse.choose_strategy(
+            n_nodes, n_out, full_bytes) == "full"
+        assert build_table_sparse.choose_strategy(
+            n_nodes, n_out, full_bytes / 2) == "checkpoint"
+        assert build_table_sparse.choose_strategy(
+            n_nodes, n_out, 1) == "divide"
+
+    def test_beam_search(self):
+        for kwargs in ({"min_beats": 0, "max_beats": -1},
+                       {"min_beats": 2, "max_beats": 5}):
+            path, cost = self.build(build_table_sparse, **kwargs)
+
+            # a beam wide enough to hold every node is exact
+            beam_path, beam_cost = build_table_sparse.beam_search(
+                self.tc, self.pen, self.song_starts, self.song_ends,
+                first_pause=self.n_beats, beam_width=1000, **kwargs)
+            assert N.allclose(sum(beam_cost), sum(cost))
+
+            beam_path, beam_cost = build_table_sparse.beam_search(
+                self.tc, self.pen, self.song_starts, self.song_ends,
+                first_pause=self.n_beats, beam_width=3, margin=1.0,
+                **kwargs)
+            assert len(beam_path) == len(path)
+            assert sum(beam_cost) >= sum(cost) - 1e-9
+
+    def test_neighbors(self):
+        neighbors, costs = build_table_sparse.sparse_transitions(
+            self.tc, self.song_starts, self.song_ends, self.n_beats,
+            n_neighbors=3)
+        assert neighbors.shape == (self.n_beats, 3)
+        for i in xrange(self.n_beats):
+            song = 0 if i < self.song_ends[0] else 1
+            row = self.tc[i, self.song_starts[song]:self.song_ends[song]]
+            assert N.allclose(sorted(costs[i]), sorted(row)[:3])
+            assert N.all(N.diff(neighbors[i]) > 0)
+
+        path, cost = self.build(build_table_sparse, min_beats=0,
+                                max_beats=-1, n_neighbors=3)
+        assert len(path) == self.pen.shape[1]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+from unittest import TestCase
+import unittest
+import os
+
+import numpy as N
+
+from radiotool.composer import Composition, Segment, TimeStretchSegment,\
+    Track
+from radiotool.utils import RMS_energy
+
+
+class TestBuildBlocks(TestCase):
+
+    def setUp(self):
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        self.track = Track(os.path.join(dirname, "test.wav"), "test_track")
+        self.comp = Composition(tracks=[self.track])
+        self.comp.add_segments([
+            Segment(self.track, 0.0, 0.0, 0.5),
+            TimeStretchSegment(self.track, 0.5, 0.5, 0.5, 0.75),
+        ])
+
+    def test_blocks_match_build(self):
+        whole = self.comp.build()
+        for workers in (None, 2):
+            blocks = N.concatenate(list(self.comp.build_blocks(
+                block_size=1000, workers=workers)))
+            assert N.allclose(blocks, whole)
+
+    def test_stretched_segment_processed_once(self):
+        stretched = self.comp.segments[1]
+        calls = []
+        get_frames = stretched.get_frames
+
+        def counted_get_frames(*args, **kwargs):
+            calls.append(kwargs.get('n_frames'))
+            return get_frames(*args, **kwargs)
+
+        stretched.get_frames = counted_get_frames
+        list(self.comp.build_blocks(block_size=1000))
+        assert calls == [None]
+
+    def test_export_rejects_adjust_dynamics_in_blocks(self):
+        with self.assertRaises(ValueError):
+            self.comp.export(filename="unused", block_size=1000,
+                             adjust_dynamics=True)
+
+
+class TestRemoveEndSilence(TestCase):
+
+    def test_subwindow_rms_matches_segment_loop(self):
+        rng = N.random.RandomState(0)
+        frames = rng.randn(40000).astype(N.float32)
+        frames[30000:] *= 1e-3
+        # subwindows of 44.1 kHz and (odd length) 11025 Hz tracks
+        for length in (2756, 689):
+            offset = length / 2.0
+            n_subwindows = int((len(frames) - length) / offset) + 1
+            expected = [RMS_energy(frames[int(i * offset):
+                                          int(i * offset) + length])
+                        for i in xrange(n_subwindows)]
+            assert N.allclose(Composition._subwindow_rms(frames, length),
+                              expected, rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+from unittest import TestCase
+import unittest
+
+import numpy as N
+
+from radiotool.algorithms import constraints
+
+
+class FakeSong(object):
+    def __init__(self, n_beats):
+        self.analysis = {"beats": [.5 * i for i in xrange(n_beats)]}
+
+
+class TestConstraints(TestCase):
+
+    def setUp(self):
+        self.n_beats = 12
+        self.song = FakeSong(self.n_beats)
+        # two pause nodes after the beats
+        self.transition_cost = N.zeros((self.n_beats + 2, self.n_beats + 2))
+        self.penalty = N.zeros((self.n_beats + 2, 5))
+
+    def apply(self, constraint):
+        return constraint.apply(self.transition_cost, self.penalty,
+                                self.song, list(self.song.analysis["beats"]))
+
+    def test_minimum_loop(self):
+        tc, pen, names = self.apply(constraints.MinimumLoopConstraint(4))
+        assert pen is self.penalty
+        for i in xrange(self.n_beats):
+            for j in xrange(self.n_beats):
+                if 0 <= i - j < 4:
+                    assert tc[i, j] == N.inf
+                else:
+                    assert tc[i, j] == 0.0
+        # pauses are untouched
+        assert not N.any(tc[self.n_beats:, :])
+        assert not N.any(tc[:, self.n_beats:])
+
+    def test_rhythm(self):
+        tc, pen, names = self.apply(constraints.RhythmConstraint(4, .5))
+        for i in xrange(self.n_beats):
+            for j in xrange(self.n_beats):
+                if j % 4 == (i + 1) % 4:
+                    assert tc[i, j] == 0.0
+                else:
+                    assert tc[i, j] == .5
+        assert not N.any(tc[self.n_beats:, :])
+        assert not N.any(tc[:, self.n_beats:])
+
+    def test_music_duration(self):
+        self.song.analysis["med_beat_duration"] = .5
+        constraint = constraints.MusicDurationConstraint(2.0, 5.0)
+        tc, pen, names = self.apply(constraint)
+        # the tables aren't expanded, only the limits are recorded
+        assert tc is self.transition_cost
+        assert pen is self.penalty
+        assert len(names) == self.n_beats
+        assert constraint.min_beats == 5
+        assert constraint.max_beats == 10
+
+
+if __name__ == '__main__':
+    unittest.main()
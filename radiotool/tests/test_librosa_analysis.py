@@ -0,0 +1,96 @@
+from unittest import TestCase
+import unittest
+
+import numpy as N
+
+try:
+    import librosa
+    from radiotool.algorithms import librosa_analysis
+    LIBROSA = True
+except ImportError:
+    LIBROSA = False
+
+
+def separate_passes_analysis(y, sr):
+    """The analysis as it was computed before the spectrogram was shared:
+    beat_track, the mel spectrogram and the chroma STFT each ran over the
+    signal on their own"""
+    hop_length = librosa_analysis.HOP_LENGTH
+    tempo, beats = librosa.beat.beat_track(y, sr, hop_length=hop_length)
+
+    S = librosa.feature.melspectrogram(y, sr,
+                                       n_fft=librosa_analysis.N_FFT,
+                                       hop_length=hop_length,
+                                       n_mels=librosa_analysis.N_MELS,
+                                       fmax=librosa_analysis.FMAX)
+    S = S / S.max()
+    S = librosa.feature.mfcc(S=librosa.logamplitude(S),
+                             n_mfcc=librosa_analysis.N_MFCC)
+    timbres = librosa.feature.sync(S, beats).T
+
+    S = N.abs(librosa.stft(y, hop_length=hop_length))
+    tuning = librosa_analysis._TuningEstimator(sr)
+    tuning.add(S)
+    H = librosa.decompose.hpss(S)[0]
+    chroma = librosa.feature.sync(
+        librosa.feature.chromagram(S=H, sr=sr, tuning=tuning.tuning()),
+        beats, aggregate=N.median).T
+
+    beat_times = librosa.frames_to_time(beats, sr, hop_length=hop_length)
+    return beat_times, timbres, chroma
+
+
+@unittest.skipIf(not LIBROSA, "librosa is not installed")
+class TestLibrosaAnalysis(TestCase):
+
+    def setUp(self):
+        # a few seconds of clicks at 120 bpm over a chord
+        self.sr = 22050
+        t = N.arange(8 * self.sr) / float(self.sr)
+        y = .1 * (N.sin(2 * N.pi * 220 * t) +
+                  N.sin(2 * N.pi * 277.2 * t) +
+                  N.sin(2 * N.pi * 329.6 * t))
+        clicks = N.zeros_like(y)
+        for i in xrange(0, len(y), self.sr / 2):
+            clicks[i:i + 200] = N.hanning(200)[:len(clicks[i:i + 200])]
+        self.y = (y + clicks).astype(N.float32)
+
+    def test_shared_spectrogram_matches_separate_passes(self):
+        analysis = librosa_analysis.analyze_frames(self.y, self.sr)
+        beats, timbres, chroma = separate_passes_analysis(self.y, self.sr)
+
+        assert N.allclose(analysis["beats"], beats)
+        assert N.allclose(analysis["timbres"], timbres, atol=1e-4)
+        assert N.allclose(analysis["chroma"], chroma, atol=1e-5)
+
+    def test_chunked_matches_whole_signal(self):
+        analysis = librosa_analysis.analyze_frames(self.y, self.sr)
+        chunked = librosa_analysis.analyze_chunked(
+            lambda start, end: self.y[start:end], len(self.y), self.sr,
+            block_duration=1.5)
+
+        assert N.allclose(chunked["beats"], analysis["beats"])
+        assert N.allclose(chunked["timbres"], analysis["timbres"], atol=1e-3)
+        assert N.allclose(chunked["chroma"], analysis["chroma"], atol=1e-3)
+
+    def test_chunked_tuning_matches_whole_signal(self):
+        # the chord a third of a semitone sharp, after a near-silent
+        # block whose own tuning estimate would be arbitrary
+        t = N.arange(len(self.y)) / float(self.sr)
+        sharp = 2 ** (.3 / 12)
+        y = .1 * (N.sin(2 * N.pi * 220 * sharp * t) +
+                  N.sin(2 * N.pi * 277.2 * sharp * t) +
+                  N.sin(2 * N.pi * 329.6 * sharp * t))
+        y[:2 * self.sr] = 1e-4 * N.random.RandomState(0).randn(2 * self.sr)
+        y = y.astype(N.float32)
+
+        analysis = librosa_analysis.analyze_frames(y, self.sr)
+        chunked = librosa_analysis.analyze_chunked(
+            lambda start, end: y[start:end], len(y), self.sr,
+            block_duration=1.5)
+
+        assert N.allclose(chunked["chroma"], analysis["chroma"], atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
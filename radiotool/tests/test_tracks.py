@@ -1,9 +1,13 @@
 from unittest import TestCase
 import unittest
 import os
+import shutil
+import tempfile
 
 import numpy as N
 
+from radiotool.analysis_store import AnalysisStore
+from radiotool.composer import track as track_module
 from radiotool.composer.track import Track
 
 
@@ -31,6 +35,57 @@ class TestTrack(TestCase):
         assert N.allclose(frames_read, frames_real)
         assert self.track.current_frame == 1002
 
+    def test_read_range(self):
+        self.track.current_frame = 1000
+        frames_read = self.track.read_frames(2)
+        self.track.current_frame = 10
+        assert N.allclose(self.track.read_range(1000, 2), frames_read)
+        assert self.track.current_frame == 10
+        assert N.allclose(self.track.read_range(10, 2),
+                          self.track.read_frames(2))
+        assert self.track.current_frame == 12
+
+    def test_mmap_pcm(self):
+        # 16-bit PCM is mapped in place, and converted as it's read
+        mapped = Track(self.track.filename, "mapped", mmap=True)
+        assert mapped._frames.dtype == N.dtype('<i2')
+        assert N.allclose(mapped.read_range(1000, 50),
+                          self.track.read_range(1000, 50))
+        assert mapped.read_range(1000, 50).dtype == N.float32
+
+    def test_mmap_decoded_cache(self):
+        # decoded frames are cached (and counted) in the store's
+        # frames directory, and the mp3 is only decoded once
+        cache_dir = tempfile.mkdtemp()
+        mp3_filename = os.path.join(cache_dir, "song.mp3")
+        with open(mp3_filename, 'wb') as f:
+            f.write(b"not really an mp3")
+        frames = N.linspace(-1, 1, 2000).astype(N.float32).reshape(-1, 2)
+        decoded = []
+
+        def decode(filename):
+            decoded.append(filename)
+            return frames, 22050
+
+        original_decode = track_module.codec.decode
+        track_module.codec.decode = decode
+        try:
+            for i in xrange(2):
+                mp3 = Track(mp3_filename, "mp3", mmap=True,
+                            cache_dir=cache_dir)
+                assert mp3.samplerate == 22050
+                assert isinstance(mp3._frames, N.memmap)
+                assert N.allclose(mp3.read_range(10, 5), frames[10:15])
+            assert decoded == [mp3_filename]
+
+            entries = AnalysisStore(cache_dir).entries()
+            assert [path for _, _, path in entries] == [mp3._frames_cache_fn]
+            assert os.path.dirname(mp3._frames_cache_fn) == os.path.join(
+                cache_dir, "frames")
+        finally:
+            track_module.codec.decode = original_decode
+            shutil.rmtree(cache_dir)
+
     def test_read_mp3(self):
         mp3_filename = os.path.join(self.dirname, "test.mp3")
         with self.assertRaises(IOError) as ctx:
@@ -1,7 +1,7 @@
 """A set of utility functions that are used elsewhere in radiotool
 """
+import os
 import sys
-from subprocess import check_output
 
 try:
     import libxmp
@@ -10,6 +10,8 @@ except ImportError:
     LIBXMP = False
 import numpy as N
 
+from codec import Mp3Writer
+
 
 def log_magnitude_spectrum(frames):
     """Compute the log of the magnitude spectrum of frames"""
@@ -93,20 +95,18 @@ def linear(arr1, arr2):
     Create a linear blend of arr1 (fading out) and arr2 (fading in)
     """
     n = N.shape(arr1)[0]
-    try:
-        channels = N.shape(arr1)[1]
-    except:
-        channels = 1
+    dtype = N.result_type(arr1, arr2)
 
-    f_in = N.linspace(0, 1, num=n)
-    f_out = N.linspace(1, 0, num=n)
+    f_in = N.linspace(0, 1, num=n).astype(dtype)
+    f_out = N.linspace(1, 0, num=n).astype(dtype)
 
     # f_in = N.arange(n) / float(n - 1)
     # f_out = N.arange(n - 1, -1, -1) / float(n)
 
-    if channels > 1:
-        f_in = N.tile(f_in, (channels, 1)).T
-        f_out = N.tile(f_out, (channels, 1)).T
+    if N.ndim(arr1) > 1:
+        # broadcast the fades across channels
+        f_in = f_in[:, N.newaxis]
+        f_out = f_out[:, N.newaxis]
 
     vals = f_out * arr1 + f_in * arr2
     return vals
@@ -117,17 +117,15 @@ def equal_power(arr1, arr2):
     Create an equal power blend of arr1 (fading out) and arr2 (fading in)
     """
     n = N.shape(arr1)[0]
-    try:
-        channels = N.shape(arr1)[1]
-    except:
-        channels = 1
+    dtype = N.result_type(arr1, arr2)
 
-    f_in = N.arange(n) / float(n - 1)
-    f_out = N.arange(n - 1, -1, -1) / float(n)
+    f_in = (N.arange(n) / float(n - 1)).astype(dtype)
+    f_out = (N.arange(n - 1, -1, -1) / float(n)).astype(dtype)
 
-    if channels > 1:
-        f_in = N.tile(f_in, (channels, 1)).T
-        f_out = N.tile(f_out, (channels, 1)).T
+    if N.ndim(arr1) > 1:
+        # broadcast the fades across channels
+        f_in = f_in[:, N.newaxis]
+        f_out = f_out[:, N.newaxis]
 
     vals = log_factor(f_out) * arr1 + log_factor(f_in) * arr2
 
@@ -164,8 +162,20 @@ def segment_array(arr, length, overlap=.5):
 
 
 def wav_to_mp3(wavfn, delete_wav=False, lame_quality="V 2"):
+    from scikits.audiolab import Sndfile
+
     mp3fn = ".".join(wavfn.split('.')[:-1]) + '.mp3'
-    check_output('lame -{} "{}"'.format(lame_quality, wavfn), shell=True)
+
+    # stream the wav through the encoder in blocks
+    wav = Sndfile(wavfn, 'r')
+    mp3 = Mp3Writer(mp3fn, wav.channels, wav.samplerate,
+                    lame_quality=lame_quality)
+    block_size = 65536
+    for start in xrange(0, wav.nframes, block_size):
+        mp3.write_frames(wav.read_frames(
+            min(block_size, wav.nframes - start), dtype=N.float32))
+    mp3.close()
+    wav.close()
 
     if LIBXMP:
         xmpfile = libxmp.XMPFiles(file_path=wavfn)
@@ -185,4 +195,4 @@ def wav_to_mp3(wavfn, delete_wav=False, lame_quality="V 2"):
         xmpfile2.close_file()
 
     if delete_wav:
-        check_output('rm "{}"'.format(wavfn), shell=True)
+        os.remove(wavfn)
@@ -19,6 +19,34 @@ else:
 
 script_args.extend(sys.argv[1:])
 
+
+def openmp_flags():
+    """Get the flags to build with OpenMP, if the compiler supports it"""
+    import shutil
+    import tempfile
+    from distutils.ccompiler import new_compiler
+    from distutils.errors import CompileError, LinkError
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp_dir, 'test_openmp.c')
+        with open(src, 'w') as f:
+            f.write('#include <omp.h>\n'
+                    'int main(void) { return omp_get_max_threads() < 1; }\n')
+        compiler = new_compiler()
+        objects = compiler.compile([src], output_dir=tmp_dir,
+                                   extra_postargs=['-fopenmp'])
+        compiler.link_executable(objects, os.path.join(tmp_dir, 'test_openmp'),
+                                 extra_postargs=['-fopenmp'])
+    except (CompileError, LinkError):
+        return []
+    finally:
+        shutil.rmtree(tmp_dir)
+    return ['-fopenmp']
+
+# build_table_full_backtrace runs on multiple threads with OpenMP
+openmp = [] if on_rtd else openmp_flags()
+
 if have_cython:
     build_table_mem_efficient = Extension(
         'radiotool.algorithms.build_table_mem_efficient',
@@ -28,7 +56,8 @@ if have_cython:
     build_table_full_backtrace = Extension(
         'radiotool.algorithms.build_table_full_backtrace',
         ['radiotool/algorithms/build_table_full_backtrace.pyx'],
-        extra_compile_args=['-O3'])
+        extra_compile_args=['-O3'] + openmp,
+        extra_link_args=openmp)
 else:
     build_table_mem_efficient = Extension(
         'radiotool.algorithms.build_table_mem_efficient',
@@ -38,7 +67,8 @@ else:
     build_table_full_backtrace = Extension(
         'radiotool.algorithms.build_table_full_backtrace',
         ['radiotool/algorithms/build_table_full_backtrace.c'],
-        extra_compile_args=['-O3'])
+        extra_compile_args=['-O3'] + openmp,
+        extra_link_args=openmp)
 
 setup(
     name='radiotool',
@@ -69,7 +99,8 @@ setup(
         'librosa'
     ],
     extras_require={
-        'xmp': ['python-xmp-toolkit']
+        'xmp': ['python-xmp-toolkit'],
+        'mp3': ['audioread', 'lameenc']
     },
     # test_suite='nose.collector',
     # tests_require=['nose']